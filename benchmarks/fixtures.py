@@ -0,0 +1,167 @@
+"""
+Seeded generators for synthetic market data, shaped like the raw API payloads the bot consumes:
+
+- coinmarketcap `listings/latest`
+- binance `get_exchange_info` and `get_all_tickers`
+- a user portfolio
+
+The same seed always produces the same market, so results from different commits are comparable.
+"""
+
+import random
+import time
+import typing as t
+from decimal import Decimal
+
+from bot import caching, exchanges, market_cap
+from bot.data_types import CryptoBalance
+
+PURCHASING_CURRENCY = "USD"
+DEPRIORITIZED_COINS = ["BNB", "DOGE", "XRP"]
+EXCLUDED_TAGS = ["wrapped-tokens", "stablecoin"]
+
+# fraction of coinmarketcap listings which trade on binance, and which of those are not currently trading
+BINANCE_LISTING_RATE = 0.6
+BINANCE_HALTED_RATE = 0.02
+
+TAGS = ["defi", "platform", "pos", "pow", "smart-contracts", "layer-2", "gaming", "memes"]
+
+
+def symbols(size: int) -> t.List[str]:
+    return DEPRIORITIZED_COINS + [f"COIN{i}" for i in range(size - len(DEPRIORITIZED_COINS))]
+
+
+def coinmarketcap_listings(size: int, seed: int = 42) -> t.Dict:
+    rng = random.Random(seed)
+    listings = []
+
+    for rank, symbol in enumerate(symbols(size)):
+        # market caps roughly follow a power law, a handful of coins make up most of the index
+        market_cap = Decimal(int(1e12 / (rank + 1) ** 1.5))
+        price = Decimal(str(round(rng.lognormvariate(0, 3), 6))) or Decimal("0.000001")
+
+        tags = rng.sample(TAGS, rng.randint(0, 3))
+
+        # excluded tags are common enough in the real listings to matter when filtering
+        if rng.random() < 0.05:
+            tags.append(rng.choice(EXCLUDED_TAGS))
+
+        listings.append(
+            {
+                "id": rank + 1,
+                "symbol": symbol,
+                "name": symbol.title(),
+                "cmc_rank": rank + 1,
+                "tags": tags,
+                "circulating_supply": market_cap / price,
+                "quote": {
+                    PURCHASING_CURRENCY: {
+                        "price": price,
+                        "market_cap": market_cap,
+                        "volume_24h": market_cap * Decimal(str(round(rng.uniform(0.01, 0.2), 4))),
+                        "percent_change_1h": Decimal(str(round(rng.uniform(-2, 2), 4))),
+                        "percent_change_24h": Decimal(str(round(rng.uniform(-10, 10), 4))),
+                        # rounded so some coins share the same change and the lower precedence sort keys are exercised
+                        "percent_change_7d": Decimal(round(rng.uniform(-30, 30))),
+                        "percent_change_30d": Decimal(round(rng.uniform(-60, 60))),
+                    }
+                },
+            }
+        )
+
+    return {"status": {"timestamp": "2021-09-28T20:34:07.000Z", "error_code": 0}, "data": listings}
+
+
+def binance_exchange_info(listings: t.Dict, seed: int = 42) -> t.Dict:
+    rng = random.Random(seed)
+    symbol_info = []
+
+    for coin in listings["data"]:
+        if rng.random() > BINANCE_LISTING_RATE:
+            continue
+
+        price = coin["quote"][PURCHASING_CURRENCY]["price"]
+        step_size = Decimal(10) ** -rng.randint(0, 8)
+        tick_size = Decimal(10) ** -rng.randint(2, 8)
+
+        symbol_info.append(
+            {
+                "symbol": coin["symbol"] + PURCHASING_CURRENCY,
+                "status": "BREAK" if rng.random() < BINANCE_HALTED_RATE else "TRADING",
+                "baseAsset": coin["symbol"],
+                "baseAssetPrecision": 8,
+                "quoteAsset": PURCHASING_CURRENCY,
+                "quotePrecision": 4,
+                "quoteAssetPrecision": 4,
+                "orderTypes": ["LIMIT", "LIMIT_MAKER", "MARKET", "STOP_LOSS_LIMIT", "TAKE_PROFIT_LIMIT"],
+                "filters": [
+                    {"filterType": "PRICE_FILTER", "minPrice": str(tick_size), "maxPrice": str(price * 1000), "tickSize": str(tick_size)},
+                    {"filterType": "LOT_SIZE", "minQty": str(step_size), "maxQty": "9000000.00000000", "stepSize": str(step_size)},
+                    {"filterType": "MIN_NOTIONAL", "minNotional": "10.00000000", "applyToMarket": True, "avgPriceMins": 5},
+                ],
+            }
+        )
+
+    return {"timezone": "UTC", "serverTime": int(time.time() * 1000), "rateLimits": [], "symbols": symbol_info}
+
+
+def binance_tickers(listings: t.Dict, exchange_info: t.Dict) -> t.List[t.Dict]:
+    prices = {coin["symbol"] + PURCHASING_CURRENCY: coin["quote"][PURCHASING_CURRENCY]["price"] for coin in listings["data"]}
+    return [{"symbol": symbol_info["symbol"], "price": str(prices[symbol_info["symbol"]])} for symbol_info in exchange_info["symbols"]]
+
+
+def portfolio(listings: t.Dict, size: int, seed: int = 42) -> t.List[CryptoBalance]:
+    "a portfolio of `size` assets, with the purchasing currency and a skew towards the largest coins"
+
+    rng = random.Random(seed)
+    coins = listings["data"]
+
+    # most portfolios hold the top of the index plus a long tail
+    held = coins[: size // 2] + rng.sample(coins[size // 2 :], min(size - size // 2, len(coins) - size // 2))
+
+    balances = [
+        CryptoBalance(
+            symbol=coin["symbol"],
+            amount=Decimal(str(round(rng.uniform(0.01, 1000), 6))),
+            usd_price=coin["quote"][PURCHASING_CURRENCY]["price"],
+            usd_total=Decimal(0),
+            percentage=Decimal(0),
+            target_percentage=Decimal(0),
+        )
+        for coin in held[: size - 1]
+    ]
+
+    balances.append(
+        CryptoBalance(
+            symbol=PURCHASING_CURRENCY,
+            amount=Decimal(1000),
+            usd_price=Decimal(1),
+            usd_total=Decimal(0),
+            percentage=Decimal(0),
+            target_percentage=Decimal(0),
+        )
+    )
+
+    return balances
+
+
+class Market(t.NamedTuple):
+    listings: t.Dict
+    exchange_info: t.Dict
+    tickers: t.List[t.Dict]
+
+
+def market(size: int, seed: int = 42) -> Market:
+    listings = coinmarketcap_listings(size, seed)
+    exchange_info = binance_exchange_info(listings, seed)
+    return Market(listings=listings, exchange_info=exchange_info, tickers=binance_tickers(listings, exchange_info))
+
+
+def install(market: Market):
+    "serve the synthetic market from the cache, in the same way a `MarketSnapshot` is installed, so nothing hits an API"
+
+    fresh_until = time.time() + 60 * 60
+
+    caching.prime("coinmarketcap_data", market_cap.CoinMarketCapListings.from_response(market.listings), fresh_until)
+    caching.prime("binance_symbol_registry", exchanges.SymbolRegistry(market.exchange_info["symbols"]), fresh_until)
+    caching.prime("binance_all_prices", {ticker["symbol"]: Decimal(ticker["price"]) for ticker in market.tickers}, fresh_until)
@@ -0,0 +1,128 @@
+"""
+Compares `calculate_market_buy_preferences` against the original five-sort implementation.
+
+Run with `python -m benchmarks.market_buy_preferences`
+"""
+
+import random
+import timeit
+import typing as t
+from decimal import Decimal
+
+from bot.data_types import CryptoBalance, CryptoData
+from bot.market_buy import calculate_market_buy_preferences
+
+INDEX_SIZE = 1000
+PORTFOLIO_SIZE = 500
+DEPRIORITIZED_COINS = ["BNB", "DOGE", "XRP"]
+
+
+def legacy_calculate_market_buy_preferences(
+    target_index: t.List[CryptoData],
+    current_portfolio: t.List[CryptoBalance],
+    deprioritized_coins: t.List[str],
+) -> t.List[CryptoData]:
+    coins_below_index_target: t.List[CryptoData] = []
+
+    for coin_data in target_index:
+        current_percentage = next((balance["percentage"] for balance in current_portfolio if balance["symbol"] == coin_data["symbol"]), 0)
+
+        if current_percentage < coin_data["percentage"]:
+            coins_below_index_target.append(coin_data)
+
+    sorted_by_largest_target_delta = sorted(
+        coins_below_index_target,
+        key=lambda coin_data: next((balance["percentage"] for balance in current_portfolio if balance["symbol"] == coin_data["symbol"]), Decimal(0))
+        - coin_data["percentage"],
+    )
+
+    sorted_by_largest_recent_drop = sorted(sorted_by_largest_target_delta, key=lambda coin_data: coin_data["change_30d"])
+
+    symbols_in_current_allocation = [item["symbol"] for item in current_portfolio]
+    sorted_by_unowned_coins = sorted(
+        sorted_by_largest_recent_drop, key=lambda coin_data: 1 if coin_data["symbol"] in symbols_in_current_allocation else 0
+    )
+
+    def should_token_be_treated_as_unowned(coin_data: CryptoData) -> int:
+        if coin_data["percentage"] < 1:
+            return 1
+
+        current_percentage = next((balance["percentage"] for balance in current_portfolio if balance["symbol"] == coin_data["symbol"]), 0)
+
+        if current_percentage == 0:
+            return 0
+
+        current_allocation_delta = coin_data["percentage"] / current_percentage
+        if current_allocation_delta > 6:
+            return 0
+        else:
+            return 1
+
+    sorted_by_large_market_cap_coins = sorted(sorted_by_unowned_coins, key=should_token_be_treated_as_unowned)
+
+    return sorted(sorted_by_large_market_cap_coins, key=lambda coin_data: 1 if coin_data["symbol"] in deprioritized_coins else 0)
+
+
+def generate_market(index_size: int, portfolio_size: int, seed: int = 42) -> t.Tuple[t.List[CryptoData], t.List[CryptoBalance]]:
+    rng = random.Random(seed)
+
+    symbols = DEPRIORITIZED_COINS + [f"COIN{i}" for i in range(index_size - len(DEPRIORITIZED_COINS))]
+
+    # market caps roughly follow a power law, a handful of coins make up most of the index
+    market_caps = [Decimal(int(1e12 / (rank + 1) ** 1.5)) for rank in range(index_size)]
+    total_market_cap = sum(market_caps)
+
+    target_index = [
+        CryptoData(
+            symbol=symbol,
+            market_cap=market_cap,
+            percentage=market_cap / total_market_cap * 100,
+            # rounded so some coins share the same change and the lower precedence keys are exercised
+            change_7d=round(rng.uniform(-30, 30)),
+            change_30d=round(rng.uniform(-60, 60)),
+        )
+        for symbol, market_cap in zip(symbols, market_caps)
+    ]
+
+    current_portfolio = [
+        CryptoBalance(
+            symbol=coin["symbol"],
+            amount=Decimal(1),
+            usd_price=Decimal(1),
+            usd_total=Decimal(1),
+            percentage=coin["percentage"] * Decimal(rng.uniform(0, 2)),
+            target_percentage=Decimal(0),
+        )
+        for coin in rng.sample(target_index, portfolio_size)
+    ]
+
+    return target_index, current_portfolio
+
+
+def run(index_size: int = INDEX_SIZE, portfolio_size: int = PORTFOLIO_SIZE, number: int = 5) -> t.Dict[str, float]:
+    target_index, current_portfolio = generate_market(index_size, portfolio_size)
+
+    legacy_result = legacy_calculate_market_buy_preferences(target_index, current_portfolio, DEPRIORITIZED_COINS)
+    result = calculate_market_buy_preferences(target_index, current_portfolio, DEPRIORITIZED_COINS)
+
+    assert [coin["symbol"] for coin in result] == [coin["symbol"] for coin in legacy_result], "buy preference order changed"
+
+    legacy_seconds = timeit.timeit(
+        lambda: legacy_calculate_market_buy_preferences(target_index, current_portfolio, DEPRIORITIZED_COINS), number=number
+    )
+    seconds = timeit.timeit(lambda: calculate_market_buy_preferences(target_index, current_portfolio, DEPRIORITIZED_COINS), number=number)
+
+    return {
+        "legacy_seconds": legacy_seconds / number,
+        "seconds": seconds / number,
+        "speedup": legacy_seconds / seconds,
+    }
+
+
+if __name__ == "__main__":
+    results = run()
+
+    print(f"index: {INDEX_SIZE} coins, portfolio: {PORTFOLIO_SIZE} assets")
+    print(f"legacy:\t{results['legacy_seconds'] * 1000:.2f}ms")
+    print(f"current:\t{results['seconds'] * 1000:.2f}ms")
+    print(f"speedup:\t{results['speedup']:.1f}x")
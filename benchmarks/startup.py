@@ -0,0 +1,47 @@
+"""
+Measures process startup time for the CLI and the celery worker entrypoint.
+
+Each command is run in a fresh interpreter, so this includes all import-time work. Importing the bot must not make
+any network requests; the `bot.commands` and worker imports are run with sockets disabled to enforce that.
+
+Run with `python -m benchmarks.startup`
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+import typing as t
+
+RUNS = 5
+
+# raise if anything attempts to open a connection while importing
+NO_NETWORK = "import socket; socket.socket.connect = lambda *args, **kwargs: (_ for _ in ()).throw(RuntimeError('network access on import'));"
+
+COMMANDS = {
+    "main.py --help": [sys.executable, "main.py", "--help"],
+    "import bot.commands": [sys.executable, "-c", NO_NETWORK + "import bot.commands"],
+    # the celery app is configured when `users.tasks` is imported, this is the bulk of worker boot
+    "worker boot": [sys.executable, "-c", NO_NETWORK + "import django; django.setup(); import users.tasks"],
+}
+
+
+def time_command(command: t.List[str], runs: int = RUNS) -> t.Dict[str, float]:
+    durations = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, env=os.environ)
+        durations.append(time.perf_counter() - start)
+
+    return {"median_seconds": statistics.median(durations), "min_seconds": min(durations)}
+
+
+def run(runs: int = RUNS) -> t.Dict[str, t.Dict[str, float]]:
+    return {name: time_command(command, runs) for name, command in COMMANDS.items()}
+
+
+if __name__ == "__main__":
+    for name, result in run().items():
+        print(f"{name}:\t{result['median_seconds'] * 1000:.0f}ms median, {result['min_seconds'] * 1000:.0f}ms min")
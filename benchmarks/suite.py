@@ -0,0 +1,214 @@
+"""
+Benchmarks for the index and allocation hot paths against synthetic markets of 100 to 10,000 coins and portfolios
+of 10 to 1,000 assets. No external APIs are used: the market fixtures are installed into the cache before running.
+
+Results are written as JSON so runs from different commits can be compared:
+
+    python -m benchmarks.suite run --output base.json
+    git checkout my-branch
+    python -m benchmarks.suite run --output head.json
+    python -m benchmarks.suite compare base.json head.json
+"""
+
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import typing as t
+
+import click
+
+from bot import market_buy, market_cap, portfolio
+from bot.backtest import SimulatedAccount
+from bot.data_types import SupportedExchanges
+from bot.user import User
+
+from . import fixtures
+
+COIN_SIZES = [100, 1000, 10000]
+PORTFOLIO_SIZES = [10, 100, 1000]
+
+# each case is timed `REPEAT` times and the fastest run is reported, which is the least noisy estimate
+REPEAT = 5
+
+# a case is reported as a regression if it is this much slower than the baseline. Timings on a shared machine are noisy
+# by +/-15%, a tighter threshold results in false positives
+REGRESSION_THRESHOLD = 0.25
+
+Case = t.Callable[[], t.Any]
+
+
+def _user() -> User:
+    user = User()
+    user.purchasing_currency = fixtures.PURCHASING_CURRENCY
+    user.deprioritized_coins = fixtures.DEPRIORITIZED_COINS
+    user.excluded_tags = fixtures.EXCLUDED_TAGS
+    user.exchanges = [SupportedExchanges.BINANCE]
+    return user
+
+
+def cases(coin_sizes: t.List[int], portfolio_sizes: t.List[int]) -> t.Iterator[t.Tuple[str, Case]]:
+    """
+    Yields (name, case). Fixtures for a market size are generated and installed right before its cases are yielded,
+    so each case must be run before the next one is requested.
+    """
+
+    user = _user()
+    purchasing_currency = user.purchasing_currency
+
+    for coin_size in coin_sizes:
+        market = fixtures.market(coin_size)
+        fixtures.install(market)
+
+        listings = market_cap.CoinMarketCapListings.from_response(market.listings)
+
+        filter_coins = lambda: market_cap.filtered_coins_by_market_cap(
+            listings,
+            purchasing_currency,
+            enabled_exchanges=user.exchanges,
+            exclude_tags=user.excluded_tags,
+            exclude_coins=user.excluded_coins,
+            limit=user.index_limit,
+        )
+        filtered_coins = filter_coins()
+
+        calculate_index = lambda: market_cap.calculate_market_cap_from_coin_list(purchasing_currency, filtered_coins, user.index_strategy)
+        target_index = calculate_index()
+
+        yield f"filtered_coins_by_market_cap[coins={coin_size}]", filter_coins
+        yield f"calculate_market_cap_from_coin_list[coins={coin_size}]", calculate_index
+
+        for portfolio_size in portfolio_sizes:
+            if portfolio_size > coin_size:
+                continue
+
+            exchange_portfolio = fixtures.portfolio(market.listings, portfolio_size)
+            external_portfolio = fixtures.portfolio(market.listings, portfolio_size, seed=7)
+
+            merge = lambda: portfolio.merge_portfolio(exchange_portfolio, external_portfolio)
+            current_portfolio = portfolio.portfolio_with_allocation_percentages(merge())
+
+            preferences = lambda: market_buy.calculate_market_buy_preferences(target_index, current_portfolio, user.deprioritized_coins)
+            sorted_market_buys = preferences()
+
+            purchase_balance = market_buy.purchasing_currency_in_portfolio(user, current_portfolio)
+            account = SimulatedAccount(user, SupportedExchanges.BINANCE)
+
+            determine_buys = lambda: market_buy.determine_market_buys(
+                user, sorted_market_buys, current_portfolio, target_index, purchase_balance, account
+            )
+
+            sizes = f"coins={coin_size},portfolio={portfolio_size}"
+
+            # merging doesn't depend on the index, only report it once per portfolio size
+            if coin_size == max(coin_sizes):
+                yield f"merge_portfolio[portfolio={portfolio_size}]", merge
+
+            yield f"calculate_market_buy_preferences[{sizes}]", preferences
+            yield f"determine_market_buys[{sizes}]", determine_buys
+
+
+def time_case(case: Case, repeat: int = REPEAT) -> t.Dict[str, float]:
+    timer = timeit.Timer(case)
+
+    # pick a number of iterations which takes at least 0.2s, so fast cases are not dominated by timer overhead
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    return {"seconds": seconds, "number": number}
+
+
+def _git_commit() -> t.Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(coin_sizes: t.List[int] = COIN_SIZES, portfolio_sizes: t.List[int] = PORTFOLIO_SIZES, repeat: int = REPEAT, match: str = "") -> t.Dict:
+    results = {}
+
+    for name, case in cases(coin_sizes, portfolio_sizes):
+        if match not in name:
+            continue
+
+        results[name] = time_case(case, repeat)
+        click.echo(f"{name}:\t{results[name]['seconds'] * 1000:.3f}ms", err=True)
+
+    return {
+        "commit": _git_commit(),
+        "created_at": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def compare(baseline: t.Dict, current: t.Dict, threshold: float = REGRESSION_THRESHOLD) -> t.List[t.Dict]:
+    "relative change of each case present in both result sets, a positive change is slower"
+
+    comparisons = []
+
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+
+        baseline_seconds = baseline["results"][name]["seconds"]
+        change = result["seconds"] / baseline_seconds - 1
+
+        comparisons.append(
+            {
+                "name": name,
+                "baseline_seconds": baseline_seconds,
+                "seconds": result["seconds"],
+                "change": change,
+                "regression": change > threshold,
+            }
+        )
+
+    return comparisons
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("run", help="Run the benchmark suite and write JSON results")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Results file, defaults to stdout")
+@click.option("--coins", "coin_sizes", type=int, multiple=True, default=COIN_SIZES, show_default=True, help="Index sizes")
+@click.option("--portfolio", "portfolio_sizes", type=int, multiple=True, default=PORTFOLIO_SIZES, show_default=True, help="Portfolio sizes")
+@click.option("--repeat", type=int, default=REPEAT, show_default=True)
+@click.option("-k", "--match", default="", help="Only run cases whose name contains this string")
+def run_command(output, coin_sizes, portfolio_sizes, repeat, match):
+    results = run(list(coin_sizes), list(portfolio_sizes), repeat, match)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        click.echo(json.dumps(results, indent=2))
+
+
+@cli.command("compare", help="Compare two result files, exits with an error if any case regressed")
+@click.argument("baseline", type=click.File())
+@click.argument("current", type=click.File())
+@click.option("--threshold", type=float, default=REGRESSION_THRESHOLD, show_default=True, help="Allowed slowdown, 0.25 is 25%")
+def compare_command(baseline, current, threshold):
+    comparisons = compare(json.load(baseline), json.load(current), threshold)
+
+    for comparison in comparisons:
+        click.secho(
+            f"{comparison['name']}:\t{comparison['baseline_seconds'] * 1000:.3f}ms -> {comparison['seconds'] * 1000:.3f}ms "
+            f"({comparison['change']:+.1%})",
+            fg="red" if comparison["regression"] else None,
+        )
+
+    if any(comparison["regression"] for comparison in comparisons):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,103 @@
+import typing as t
+from decimal import Decimal
+
+from . import exchanges
+from .data_types import (
+    CryptoBalance,
+    ExchangeOrder,
+    OrderTimeInForce,
+    SupportedExchanges,
+)
+from .user import User
+from .utils import log
+
+
+class AccountSnapshot:
+    """
+    Balances and open orders for a user on a single exchange, loaded once per run. Both are signed requests which count
+    against the exchange's request weight budget, so they are not refetched for each step of a run.
+
+    Orders the bot places or cancels are applied to the snapshot locally. Anything else that changes the account
+    (i.e. filled stablecoin conversions) requires an explicit `invalidate`.
+    """
+
+    def __init__(self, user: User, exchange: SupportedExchanges):
+        self.user = user
+        self.exchange = exchange
+
+        self._portfolio: t.Optional[t.List[CryptoBalance]] = None
+        self._open_orders: t.Optional[t.List[ExchangeOrder]] = None
+
+    def portfolio(self) -> t.List[CryptoBalance]:
+        if (portfolio := self._portfolio) is None:
+            portfolio = self._portfolio = exchanges.portfolio(self.exchange, self.user)
+
+        return portfolio
+
+    def open_orders(self) -> t.List[ExchangeOrder]:
+        if (open_orders := self._open_orders) is None:
+            open_orders = self._open_orders = exchanges.open_orders(self.exchange, self.user)
+
+        return open_orders
+
+    def invalidate(self):
+        log.debug("invalidating account snapshot", exchange=self.exchange)
+
+        self._portfolio = None
+        self._open_orders = None
+
+    def record_placed_order(self, order: ExchangeOrder, quote_amount: Decimal):
+        """
+        `quote_amount` is the amount of purchasing currency spent (market orders) or locked (limit orders) by the order
+        """
+
+        # test mode orders are never executed, so the account does not change
+        if not self.user.livemode:
+            return
+
+        # market orders are filled immediately and have no price, limit orders stay open
+        is_open_order = order["time_in_force"] == OrderTimeInForce.GTC and Decimal(order["price"]) > 0
+
+        if self._open_orders is not None and is_open_order:
+            self._open_orders = self._open_orders + [order]
+
+        self._adjust_balance(self.user.purchasing_currency, -quote_amount)
+
+    def record_cancelled_order(self, order: ExchangeOrder):
+        if not self.user.livemode:
+            return
+
+        if self._open_orders is not None:
+            self._open_orders = [open_order for open_order in self._open_orders if open_order["id"] != order["id"]]
+
+        # the purchasing currency locked by the order is free again
+        self._adjust_balance(self.user.purchasing_currency, Decimal(order["quantity"]) * Decimal(order["price"]))
+
+    def _adjust_balance(self, symbol: str, amount: Decimal):
+        # if the balances have not been loaded yet they will reflect the change once they are
+        if self._portfolio is None:
+            return
+
+        portfolio = []
+        found = False
+
+        for balance in self._portfolio:
+            if balance["symbol"] == symbol:
+                balance = t.cast(CryptoBalance, balance | {"amount": max(balance["amount"] + amount, Decimal(0))})
+                found = True
+
+            portfolio.append(balance)
+
+        if not found and amount > 0:
+            portfolio.append(
+                CryptoBalance(
+                    symbol=symbol,
+                    amount=amount,
+                    usd_price=Decimal(0),
+                    usd_total=Decimal(0),
+                    percentage=Decimal(0),
+                    target_percentage=Decimal(0),
+                )
+            )
+
+        self._portfolio = portfolio
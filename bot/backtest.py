@@ -0,0 +1,391 @@
+import datetime
+import json
+import math
+import os
+import time
+import typing as t
+from decimal import Decimal
+
+import numpy as np
+
+from . import caching, exchanges, klines, market_buy, market_cap, portfolio
+from .account_snapshot import AccountSnapshot
+from .data_types import (
+    CryptoBalance,
+    CryptoData,
+    MarketBuy,
+    MarketIndexStrategy,
+    SupportedExchanges,
+)
+from .user import User
+from .utils import log
+
+# https://www.binance.us/en/fee/schedule
+TRADING_FEE = Decimal("0.001")
+
+YEAR_MILLISECONDS = 365 * 24 * 60 * 60 * 1000
+
+
+class CoinMarketCapSnapshot(t.NamedTuple):
+    # milliseconds, to line up with kline open times
+    timestamp: int
+    data: market_cap.CoinMarketCapListings
+
+
+class BacktestResult(t.NamedTuple):
+    steps: int
+    total_deposited: Decimal
+    final_value: Decimal
+    order_count: int
+    # annualized standard deviation of the difference between portfolio and target index returns
+    tracking_error: float
+    # half the sum of absolute differences between portfolio and target weights at the last step, 0 is a perfect match
+    allocation_drift: float
+    portfolio: t.List[CryptoBalance]
+    elapsed: float
+
+
+def record_coinmarketcap_snapshot(directory: str) -> str:
+    "save the current coinmarketcap listings to `directory` so they can be replayed later"
+
+    data = market_cap.coinmarketcap_data()
+    path = os.path.join(directory, f"{int(time.time())}.json")
+
+    os.makedirs(directory, exist_ok=True)
+
+    # only the fields the bot uses are recorded, in the shape of the original response
+    with open(path, "w") as f:
+        json.dump(data.as_response(), f)
+
+    return path
+
+
+def _parse_timestamp(timestamp: str) -> int:
+    # coinmarketcap timestamps look like `2021-09-28T20:34:07.000Z`, `fromisoformat` does not accept `Z`
+    return int(datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def load_coinmarketcap_snapshots(directory: str) -> t.List[CoinMarketCapSnapshot]:
+    snapshots = []
+
+    for file_name in os.listdir(directory):
+        if not file_name.endswith(".json"):
+            continue
+
+        with open(os.path.join(directory, file_name), "rb") as f:
+            data = market_cap.CoinMarketCapListings.from_json(f.read())
+
+        snapshots.append(CoinMarketCapSnapshot(timestamp=_parse_timestamp(t.cast(str, data.timestamp)), data=data))
+
+    return sorted(snapshots, key=lambda snapshot: snapshot.timestamp)
+
+
+def _forward_fill(matrix: np.ndarray) -> np.ndarray:
+    "fill NaN gaps in each row with the last known value"
+
+    indexes = np.where(np.isnan(matrix), 0, np.arange(matrix.shape[1]))
+    np.maximum.accumulate(indexes, axis=1, out=indexes)
+    return matrix[np.arange(matrix.shape[0])[:, None], indexes]
+
+
+class PriceHistory:
+    """
+    Close price of each trading pair at each step as a `(len(trading_pairs), len(step_times))` matrix. A pair can only be
+    traded at steps where it has a candle, but gaps are forward filled when valuing the portfolio.
+    """
+
+    def __init__(self, trading_pairs: t.List[str], step_times: np.ndarray, closes: np.ndarray):
+        self.trading_pairs = trading_pairs
+        self.step_times = step_times
+        self.closes = closes
+        self.valuation_closes = _forward_fill(closes)
+        self.rows = {trading_pair: row for row, trading_pair in enumerate(trading_pairs)}
+
+        # float copies used to track the portfolio against the index: pairs which are not listed yet are worth nothing
+        self.valuation_prices = np.nan_to_num(self.valuation_closes)
+        # return of each pair from the previous step to each step
+        self.returns = np.zeros_like(self.valuation_prices)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.returns[:, 1:] = np.nan_to_num(self.valuation_closes[:, 1:] / self.valuation_closes[:, :-1] - 1)
+
+    @classmethod
+    def from_kline_store(cls, store: klines.KlineStore, trading_pairs: t.List[str], interval: str, start: int, end: int) -> "PriceHistory":
+        interval_milliseconds = klines.INTERVAL_MILLISECONDS[interval]
+        step_times = np.arange(start, end + 1, interval_milliseconds, dtype=np.int64)
+        closes = np.full((len(trading_pairs), len(step_times)), np.nan)
+
+        for row, trading_pair in enumerate(trading_pairs):
+            candles = store.load(trading_pair, interval)
+            steps = (candles[klines.OPEN_TIME].astype(np.int64) - start) // interval_milliseconds
+            in_range = (steps >= 0) & (steps < len(step_times))
+            closes[row, steps[in_range]] = candles[klines.CLOSE, in_range]
+
+        return cls(trading_pairs, step_times, closes)
+
+    def tradeable_pairs(self, step: int) -> t.List[str]:
+        return [trading_pair for trading_pair, close in zip(self.trading_pairs, self.closes[:, step]) if not np.isnan(close)]
+
+
+def _symbol_registry(trading_pairs: t.List[str], purchasing_currency: str) -> exchanges.SymbolRegistry:
+    "stand-in for binance's exchange info which lists every pair with price history as trading"
+
+    return exchanges.SymbolRegistry(
+        [
+            {
+                "symbol": trading_pair,
+                "baseAsset": trading_pair[: -len(purchasing_currency)],
+                "quoteAsset": purchasing_currency,
+                "status": "TRADING",
+                "filters": [],
+                "quoteAssetPrecision": 8,
+            }
+            for trading_pair in trading_pairs
+        ]
+    )
+
+
+class TargetIndex(t.NamedTuple):
+    first_step: int
+    symbol_registry: exchanges.SymbolRegistry
+    coins: t.List[CryptoData]
+    # fraction of the index for each row in the price history
+    weights: np.ndarray
+
+
+class SimulatedAccount(AccountSnapshot):
+    # simulated market buys are filled immediately, so there are never any open orders
+    def open_orders(self):
+        return []
+
+
+class Backtest:
+    """
+    Replay historical market data through the index and allocation code without touching any external API.
+
+    Inputs are coinmarketcap listings snapshots (raw `listings/latest` responses, see `record_coinmarketcap_snapshot`)
+    and a `KlineStore` with candles for each trading pair. The target index is computed once per coinmarketcap snapshot
+    and reused by every step until the next snapshot, so each step only runs the buy preference and market buy
+    calculations against the simulated portfolio. A deposit of `deposit_amount` is made at every step.
+    """
+
+    def __init__(
+        self,
+        user: User,
+        coinmarketcap_snapshots: t.List[CoinMarketCapSnapshot],
+        store: klines.KlineStore,
+        deposit_amount: Decimal,
+        interval: str = "1h",
+        fee: Decimal = TRADING_FEE,
+    ):
+        if MarketIndexStrategy(user.index_strategy) == MarketIndexStrategy.SMA:
+            # the SMA strategy updates the kline store from the exchange as of today, it can't be replayed
+            raise ValueError("the SMA index strategy is not supported in backtests")
+
+        if not coinmarketcap_snapshots:
+            raise ValueError("at least one coinmarketcap snapshot is required")
+
+        self.user = user
+        self.coinmarketcap_snapshots = coinmarketcap_snapshots
+        self.store = store
+        self.deposit_amount = deposit_amount
+        self.interval = interval
+        self.fee = fee
+
+    def _price_history(self, start: t.Optional[int], end: t.Optional[int]) -> PriceHistory:
+        purchasing_currency = self.user.purchasing_currency
+        trading_pairs = [trading_pair for trading_pair in self.store.trading_pairs(self.interval) if trading_pair.endswith(purchasing_currency)]
+
+        if not trading_pairs:
+            raise ValueError(f"no {purchasing_currency} klines in {self.store.directory}")
+
+        interval_milliseconds = klines.INTERVAL_MILLISECONDS[self.interval]
+
+        if start is None:
+            start = self.coinmarketcap_snapshots[0].timestamp
+
+        if end is None:
+            # a pair can have an empty file, i.e. a new listing without any candles yet
+            open_times = [self.store.load(trading_pair, self.interval)[klines.OPEN_TIME] for trading_pair in trading_pairs]
+            last_open_times = [int(pair_open_times[-1]) for pair_open_times in open_times if pair_open_times.size]
+
+            if not last_open_times:
+                raise ValueError(f"no {purchasing_currency} candles in {self.store.directory}")
+
+            end = max(last_open_times)
+
+        # steps line up with candle open times
+        start = -(-start // interval_milliseconds) * interval_milliseconds
+
+        return PriceHistory.from_kline_store(self.store, trading_pairs, self.interval, start, end)
+
+    def _target_indexes(self, prices: PriceHistory) -> t.List[TargetIndex]:
+        "target index for each coinmarketcap snapshot"
+
+        user = self.user
+        target_indexes = []
+
+        for snapshot in self.coinmarketcap_snapshots:
+            step = int(np.searchsorted(prices.step_times, snapshot.timestamp))
+
+            if step >= len(prices.step_times):
+                break
+
+            symbol_registry = _symbol_registry(prices.tradeable_pairs(step), user.purchasing_currency)
+            caching.prime("binance_symbol_registry", symbol_registry, float("inf"))
+
+            filtered_coins = market_cap.filtered_coins_by_market_cap(
+                snapshot.data,
+                user.purchasing_currency,
+                enabled_exchanges=[SupportedExchanges.BINANCE],
+                exclude_tags=user.excluded_tags,
+                limit=user.index_limit,
+                exclude_coins=user.excluded_coins,
+            )
+
+            target_index = market_cap.calculate_market_cap_from_coin_list(user.purchasing_currency, filtered_coins, user.index_strategy)
+
+            weights = np.zeros(len(prices.trading_pairs))
+            for coin in target_index:
+                weights[prices.rows[coin["symbol"] + user.purchasing_currency]] = float(coin["percentage"]) / 100
+
+            target_indexes.append(TargetIndex(first_step=step, symbol_registry=symbol_registry, coins=target_index, weights=weights))
+
+        return target_indexes
+
+    def run(self, start: t.Optional[int] = None, end: t.Optional[int] = None) -> BacktestResult:
+        # the simulated symbol registry is primed into the process cache, it must not outlive the run
+        with caching.restore_local_entry("binance_symbol_registry"):
+            return self._run(start, end)
+
+    def _run(self, start: t.Optional[int], end: t.Optional[int]) -> BacktestResult:
+        started_at = time.perf_counter()
+
+        user = self.user
+        purchasing_currency = user.purchasing_currency
+        account = SimulatedAccount(user, SupportedExchanges.BINANCE)
+        exchange_purchase_minimum = exchanges.purchase_minimum(SupportedExchanges.BINANCE)
+
+        prices = self._price_history(start, end)
+        target_indexes = self._target_indexes(prices)
+
+        holdings: t.Dict[str, Decimal] = {purchasing_currency: Decimal(0)}
+        # float copy of the holdings for each row in the price history, for tracking against the index
+        quantities = np.zeros(len(prices.trading_pairs))
+        total_deposited = Decimal(0)
+        order_count = 0
+
+        active_returns: t.List[float] = []
+        target_weights = np.zeros(len(prices.trading_pairs))
+        target_index: t.List[CryptoData] = []
+
+        next_index = 0
+        first_step = target_indexes[0].first_step if target_indexes else len(prices.step_times)
+
+        for step in range(first_step, len(prices.step_times)):
+            if step > first_step:
+                # deposits and purchases are excluded: returns are calculated on the holdings at the end of the previous step
+                previous_prices = prices.valuation_prices[:, step - 1]
+                previous_value = quantities @ previous_prices + float(holdings[purchasing_currency])
+                portfolio_return = quantities @ (prices.valuation_prices[:, step] - previous_prices) / previous_value if previous_value else 0.0
+
+                active_returns.append(float(portfolio_return - target_weights @ prices.returns[:, step]))
+
+            # multiple snapshots can fall within a single step, the most recent one wins
+            while next_index < len(target_indexes) and target_indexes[next_index].first_step <= step:
+                target_index = target_indexes[next_index].coins
+                target_weights = target_indexes[next_index].weights
+                caching.prime("binance_symbol_registry", target_indexes[next_index].symbol_registry, float("inf"))
+                next_index += 1
+
+            holdings[purchasing_currency] += self.deposit_amount
+            total_deposited += self.deposit_amount
+
+            current_portfolio = self._portfolio(holdings, prices, step)
+            purchase_balance = market_buy.purchasing_currency_in_portfolio(user, current_portfolio)
+
+            # `determine_market_buys` won't buy anything below the exchange minimum, skip the preference calculation
+            if purchase_balance >= exchange_purchase_minimum:
+                sorted_market_buys = market_buy.calculate_market_buy_preferences(
+                    target_index, current_portfolio, deprioritized_coins=user.deprioritized_coins
+                )
+                market_buys = market_buy.determine_market_buys(user, sorted_market_buys, current_portfolio, target_index, purchase_balance, account)
+
+                order_count += self._fill(holdings, quantities, market_buys, prices, step)
+
+        last_step = len(prices.step_times) - 1
+        current_portfolio = portfolio.add_percentage_target_to_portfolio(self._portfolio(holdings, prices, last_step), target_index)
+
+        result = BacktestResult(
+            steps=len(prices.step_times) - first_step,
+            total_deposited=total_deposited,
+            final_value=sum((balance["usd_total"] for balance in current_portfolio), Decimal(0)),
+            order_count=order_count,
+            tracking_error=self._annualize(float(np.std(active_returns))) if active_returns else 0.0,
+            allocation_drift=self._allocation_drift(quantities * prices.valuation_prices[:, last_step], target_weights),
+            portfolio=current_portfolio,
+            elapsed=time.perf_counter() - started_at,
+        )
+
+        log.info("backtest complete", steps=result.steps, orders=result.order_count, elapsed=result.elapsed)
+
+        return result
+
+    def _portfolio(self, holdings: t.Dict[str, Decimal], prices: PriceHistory, step: int) -> t.List[CryptoBalance]:
+        purchasing_currency = self.user.purchasing_currency
+        step_prices = prices.valuation_closes[:, step]
+
+        def price(symbol: str) -> Decimal:
+            if symbol == purchasing_currency:
+                return Decimal(1)
+
+            return market_cap._to_decimal(step_prices[prices.rows[symbol + purchasing_currency]])
+
+        return portfolio.portfolio_with_allocation_percentages(
+            [
+                CryptoBalance(
+                    symbol=symbol,
+                    amount=amount,
+                    usd_price=price(symbol),
+                    usd_total=Decimal(0),
+                    percentage=Decimal(0),
+                    target_percentage=Decimal(0),
+                )
+                for symbol, amount in holdings.items()
+                if amount > 0
+            ]
+        )
+
+    def _fill(self, holdings: t.Dict[str, Decimal], quantities: np.ndarray, market_buys: t.List[MarketBuy], prices: PriceHistory, step: int) -> int:
+        "market buys are filled at the close of the step, minus fees"
+
+        purchasing_currency = self.user.purchasing_currency
+        filled = 0
+
+        for buy in market_buys:
+            row = prices.rows[buy["symbol"] + purchasing_currency]
+            close = prices.closes[row, step]
+
+            if np.isnan(close):
+                log.debug("no price for market buy, skipping", symbol=buy["symbol"], step=step)
+                continue
+
+            amount = Decimal(buy["amount"])
+            holdings[buy["symbol"]] = holdings.get(buy["symbol"], Decimal(0)) + amount * (1 - self.fee) / market_cap._to_decimal(close)
+            holdings[purchasing_currency] -= amount
+            quantities[row] = float(holdings[buy["symbol"]])
+            filled += 1
+
+        return filled
+
+    def _annualize(self, step_deviation: float) -> float:
+        return step_deviation * math.sqrt(YEAR_MILLISECONDS / klines.INTERVAL_MILLISECONDS[self.interval])
+
+    def _allocation_drift(self, invested: np.ndarray, target_weights: np.ndarray) -> float:
+        # the purchasing currency is waiting to be invested, it isn't part of the index
+        invested_total = invested.sum()
+
+        if not invested_total:
+            return 1.0
+
+        return float(np.abs(invested / invested_total - target_weights).sum() / 2)
@@ -0,0 +1,357 @@
+import collections
+import contextlib
+import hashlib
+import threading
+import time
+import typing as t
+import uuid
+
+from decouple import config
+
+from .utils import in_django_environment, log
+
+# default freshness for cached values, individual keys should specify their own timeout
+DEFAULT_TIMEOUT = 60 * 30
+
+# how long a process-local copy of a redis value is trusted before revalidating it against the version stamp in redis
+LOCAL_CACHE_TIMEOUT = config("LOCAL_CACHE_TIMEOUT", default=60, cast=int)
+LOCAL_CACHE_MAX_SIZE = config("LOCAL_CACHE_MAX_SIZE", default=128, cast=int)
+
+# maximum amount of time a single worker is allowed to spend refreshing a key before others give up waiting on it
+LOCK_TIMEOUT = config("CACHE_LOCK_TIMEOUT", default=30, cast=int)
+LOCK_POLL_INTERVAL = 0.1
+
+
+class CacheEntry(t.NamedTuple):
+    value: t.Any
+    version: str
+    # wall clock timestamps, since entries are shared across processes
+    fresh_until: float
+    # a stale value can still be served while a single worker refreshes it
+    stale_until: float
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.fresh_until
+
+    def is_expired(self, now: float) -> bool:
+        return now >= self.stale_until
+
+
+_cache_statistics: t.Counter[str] = collections.Counter()
+
+
+class LocalCache:
+    """
+    Size-bounded LRU cache of `CacheEntry`s for a single process. Used directly when running outside of django and as
+    the process-local tier in front of redis when running inside of django.
+    """
+
+    def __init__(self, max_size: int = LOCAL_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        # key => (entry, revalidate_at)
+        self._entries: "collections.OrderedDict[str, t.Tuple[CacheEntry, float]]" = collections.OrderedDict()
+        self._refreshing: t.Set[str] = set()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> t.Optional[t.Tuple[CacheEntry, float]]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+
+            entry, revalidate_at = self._entries[key]
+
+            if entry.is_expired(time.time()):
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return (entry, revalidate_at)
+
+    def set(self, key: str, entry: CacheEntry, revalidate_at: float = float("inf")):
+        with self._lock:
+            self._entries[key] = (entry, revalidate_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                log.debug("evicting cache key", key=evicted_key)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def acquire_lock(self, key: str) -> bool:
+        with self._lock:
+            if key in self._refreshing:
+                return False
+
+            self._refreshing.add(key)
+            return True
+
+    def release_lock(self, key: str):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._refreshing.clear()
+
+
+ClientT = t.TypeVar("ClientT")
+
+
+class ClientPool(t.Generic[ClientT]):
+    """
+    Bounded pool of exchange clients keyed by a fingerprint of the API credentials, so secrets are never kept as keys in
+    a process-wide cache. A long-lived celery worker processes many users, so clients are evicted when the pool is full
+    (least recently used first) or when they expire. Subclasses create the clients.
+    """
+
+    def __init__(self, max_size: int, timeout: int):
+        self.timeout = timeout
+        self._clients = LocalCache(max_size=max_size)
+
+    def create_client(self, *credentials: str) -> ClientT:
+        raise NotImplementedError
+
+    def client(self, *credentials: str) -> ClientT:
+        fingerprint = hashlib.sha256(":".join(credentials).encode()).hexdigest()
+
+        if cached_client := self._clients.get(fingerprint):
+            return cached_client[0].value
+
+        now = time.time()
+        client = self.create_client(*credentials)
+
+        self._clients.set(
+            fingerprint,
+            CacheEntry(value=client, version=fingerprint, fresh_until=now + self.timeout, stale_until=now + self.timeout),
+        )
+
+        return client
+
+    def clear(self):
+        self._clients.clear()
+
+
+class InProcessBackend:
+    def __init__(self, local_cache: LocalCache):
+        self.local_cache = local_cache
+
+    def get(self, key: str) -> t.Optional[CacheEntry]:
+        if not (local_entry := self.local_cache.get(key)):
+            return None
+
+        entry, _ = local_entry
+
+        if entry.is_fresh(time.time()):
+            _cache_statistics["local_hit"] += 1
+
+        return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        self.local_cache.set(key, entry)
+
+    def acquire_lock(self, key: str) -> bool:
+        return self.local_cache.acquire_lock(key)
+
+    def release_lock(self, key: str):
+        self.local_cache.release_lock(key)
+
+
+class RedisBackend:
+    """
+    Each entry in redis is stored alongside a small version stamp. Without the process-local tier, every lookup against a
+    cached value (i.e. a single price out of the full ticker map) would be a redis GET + unpickle of the entire value.
+    Once the local copy is due for revalidation we only fetch the version stamp; the full value is only transferred when
+    another process has refreshed it.
+
+    Locks are taken with `cache.add`, which is atomic in redis, so only a single worker across the fleet refreshes a key.
+    """
+
+    def __init__(self, local_cache: LocalCache):
+        self.local_cache = local_cache
+
+    def get(self, key: str) -> t.Optional[CacheEntry]:
+        from django.core.cache import cache
+
+        now = time.time()
+        version_key = f"{key}:version"
+
+        local_entry = self.local_cache.get(key)
+
+        if local_entry:
+            entry, revalidate_at = local_entry
+
+            if now < revalidate_at and entry.is_fresh(now):
+                _cache_statistics["local_hit"] += 1
+                return entry
+
+            version = cache.get(version_key)
+
+            if version is not None and version == entry.version:
+                _cache_statistics["version_hit"] += 1
+                self.local_cache.set(key, entry, now + LOCAL_CACHE_TIMEOUT)
+                return entry
+
+            entry = cache.get(key) if version is not None else None
+        else:
+            # nothing local to revalidate, pull the version and value in a single round-trip
+            cached_values = cache.get_many([key, version_key])
+            entry = cached_values.get(key)
+
+        if entry is None or entry.is_expired(now):
+            return None
+
+        _cache_statistics["redis_hit"] += 1
+        self.local_cache.set(key, entry, now + LOCAL_CACHE_TIMEOUT)
+        return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        from django.core.cache import cache
+
+        now = time.time()
+        timeout = max(int(entry.stale_until - now), 1)
+
+        cache.set_many({key: entry, f"{key}:version": entry.version}, timeout=timeout)
+        self.local_cache.set(key, entry, now + LOCAL_CACHE_TIMEOUT)
+
+    def acquire_lock(self, key: str) -> bool:
+        from django.core.cache import cache
+
+        return cache.add(f"{key}:lock", 1, timeout=LOCK_TIMEOUT)
+
+    def release_lock(self, key: str):
+        from django.core.cache import cache
+
+        cache.delete(f"{key}:lock")
+
+
+_local_cache = LocalCache()
+
+
+def _backend() -> t.Union[InProcessBackend, RedisBackend]:
+    if in_django_environment():
+        return RedisBackend(_local_cache)
+    else:
+        # if no django, then use a simple in-process cache to avoid
+        # hitting the APIs too many times within a single process
+        return InProcessBackend(_local_cache)
+
+
+def _refresh(backend, key: str, func: t.Callable, timeout: int, stale_timeout: int):
+    now = time.time()
+    value = func()
+
+    backend.set(
+        key,
+        CacheEntry(
+            value=value,
+            version=uuid.uuid4().hex,
+            fresh_until=now + timeout,
+            stale_until=now + timeout + stale_timeout,
+        ),
+    )
+
+    return value
+
+
+def cached_result(key: str, func: t.Callable, timeout: int = DEFAULT_TIMEOUT, stale_timeout: int = 0):
+    """
+    Return the cached value for `key`, calling `func` to refresh it once it is older than `timeout` seconds.
+
+    Only a single caller (across all workers when running under django) refreshes an expired key. If `stale_timeout`
+    is specified the other callers are served the previous value for up to `stale_timeout` seconds past its expiration
+    while the refresh is in flight (stale-while-revalidate). Otherwise they wait for the refreshed value.
+    """
+
+    backend = _backend()
+    entry = backend.get(key)
+
+    if entry and entry.is_fresh(time.time()):
+        return entry.value
+
+    if backend.acquire_lock(key):
+        try:
+            # another worker may have refreshed the value while we were checking the lock
+            entry = backend.get(key)
+
+            if entry and entry.is_fresh(time.time()):
+                return entry.value
+
+            _cache_statistics["miss"] += 1
+            return _refresh(backend, key, func, timeout, stale_timeout)
+        finally:
+            backend.release_lock(key)
+
+    # expired entries are never returned by the backend, so any entry here is within the stale window
+    if entry:
+        _cache_statistics["stale_hit"] += 1
+        return entry.value
+
+    _cache_statistics["lock_wait"] += 1
+    log.debug("waiting for cache refresh", key=key)
+
+    deadline = time.monotonic() + LOCK_TIMEOUT
+
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+
+        entry = backend.get(key)
+
+        if entry and entry.is_fresh(time.time()):
+            return entry.value
+
+    # the worker holding the lock most likely died, don't block on it any longer
+    log.warning("cache refresh lock timed out", key=key)
+    _cache_statistics["miss"] += 1
+    return _refresh(backend, key, func, timeout, stale_timeout)
+
+
+def prime(key: str, value: t.Any, fresh_until: float):
+    """
+    Seed the process-local tier with a value that was fetched elsewhere, i.e. a shared market snapshot.
+    The value is served locally until `fresh_until` and then refreshed through the normal backend.
+    """
+
+    entry = CacheEntry(value=value, version=uuid.uuid4().hex, fresh_until=fresh_until, stale_until=fresh_until)
+    _local_cache.set(key, entry, revalidate_at=fresh_until)
+
+
+@contextlib.contextmanager
+def restore_local_entry(key: str):
+    """
+    Put back the process-local entry for `key` (or remove it if there wasn't one) when the block exits. Values primed
+    within the block, i.e. the simulated exchange info of a backtest, are never served to the rest of the process.
+    """
+
+    previous_entry = _local_cache.get(key)
+
+    try:
+        yield
+    finally:
+        if previous_entry:
+            _local_cache.set(key, *previous_entry)
+        else:
+            _local_cache.delete(key)
+
+
+def cache_statistics() -> t.Dict[str, int]:
+    """
+    Hit/miss counters for `cached_result` in this process.
+
+    - local_hit: served from process memory
+    - version_hit: local copy revalidated against the version stamp in redis
+    - redis_hit: full value pulled from redis
+    - stale_hit: stale value served while another worker refreshed it
+    - lock_wait: waited for another worker to refresh the value
+    - miss: value was recomputed
+    """
+
+    return dict(_cache_statistics)
+
+
+def clear_cached_results():
+    _local_cache.clear()
+    _cache_statistics.clear()
@@ -3,77 +3,134 @@ from decimal import Decimal
 
 from . import (
     convert_stablecoins,
-    exchanges,
     market_buy,
     market_cap,
     open_orders,
     portfolio,
+    tracing,
 )
+from .account_snapshot import AccountSnapshot
 from .data_types import CryptoBalance, MarketBuyStrategy, SupportedExchanges
+from .market_snapshot import MarketSnapshot
 from .user import User
+from .utils import log
 
 
 # TODO not really sure the best pattern for implementing the command/interactor pattern but we are going to give this a try
+# each stage of a command is recorded as a `tracing.span`, open a span around `execute` to collect a summary of the run
 class PortfolioCommand:
     @classmethod
-    def execute(cls, user: User) -> t.List[CryptoBalance]:
-        portfolio_target = market_cap.coins_with_market_cap(user)
-        external_portfolio = user.external_portfolio
-        user_portfolio = []
+    def execute(cls, user: User, market_snapshot: t.Optional[MarketSnapshot] = None) -> t.List[CryptoBalance]:
+        with tracing.span("portfolio_command"):
+            # prices and exchange info are served from the snapshot, like `BuyCommand`
+            if market_snapshot:
+                market_snapshot.install()
 
-        # pull a raw binance reportfolio from exchanges.py and add percentage allocations to it
-        for exchange in user.exchanges:
-            user_portfolio = exchanges.portfolio(exchange, user)
-            # TODO when we actually support multiple exchanges we'll need to do something like this
-            # user_portfolio = portfolio.merge_portfolio(user_portfolio, external_portfolio)
+            with tracing.span("target_index"):
+                if market_snapshot:
+                    portfolio_target = market_snapshot.target_index(user)
+                else:
+                    portfolio_target = market_cap.coins_with_market_cap(user)
 
-        user_portfolio = portfolio.merge_portfolio(user_portfolio, external_portfolio)
-        user_portfolio = portfolio.add_price_to_portfolio(user_portfolio, user.purchasing_currency)
-        user_portfolio = portfolio.portfolio_with_allocation_percentages(user_portfolio)
-        user_portfolio = portfolio.add_missing_assets_to_portfolio(user, user_portfolio, portfolio_target)
-        user_portfolio = portfolio.add_percentage_target_to_portfolio(user_portfolio, portfolio_target)
+            external_portfolio = user.external_portfolio
 
-        # TODO https://github.com/python/typing/issues/760
-        # highest percentages first in the output table
-        user_portfolio.sort(key=lambda balance: balance["target_percentage"], reverse=True)
+            with tracing.span("exchange_portfolio"):
+                # raw balances from every exchange, merged by symbol, percentage allocations are added below
+                user_portfolio = portfolio.exchange_portfolio(user)
 
-        return user_portfolio
+            with tracing.span("price_portfolio"):
+                user_portfolio = portfolio.merge_portfolio(user_portfolio, external_portfolio)
+                user_portfolio = portfolio.add_price_to_portfolio(user_portfolio, user.purchasing_currency)
+                user_portfolio = portfolio.portfolio_with_allocation_percentages(user_portfolio)
+                user_portfolio = portfolio.add_missing_assets_to_portfolio(user, user_portfolio, portfolio_target)
+                user_portfolio = portfolio.add_percentage_target_to_portfolio(user_portfolio, portfolio_target)
+
+            # TODO https://github.com/python/typing/issues/760
+            # highest percentages first in the output table
+            user_portfolio.sort(key=lambda balance: balance["target_percentage"], reverse=True)
+
+            return user_portfolio
 
 
 class BuyCommand:
     # TODO we should break this up into smaller functions
     @classmethod
-    def execute(cls, user: User, purchase_balance: t.Optional[Decimal] = None) -> t.Tuple[Decimal, t.List, t.List]:
-        if user.buy_strategy == MarketBuyStrategy.LIMIT and user.cancel_stale_orders:
-            open_orders.cancel_stale_open_orders(user, SupportedExchanges.BINANCE)
-
-        # TODO support multiple exchanges here
-        current_portfolio = exchanges.portfolio(SupportedExchanges.BINANCE, user)
-
-        if user.convert_stablecoins:
-            convert_stablecoins.convert_stablecoins(user, SupportedExchanges.BINANCE, current_portfolio)
-
-        # TODO we should wait for the stablecoin sells to clear and then refresh the portfolio
-
-        external_portfolio = user.external_portfolio
-        external_portfolio = portfolio.add_price_to_portfolio(external_portfolio, user.purchasing_currency)
-
-        current_portfolio = portfolio.merge_portfolio(current_portfolio, external_portfolio)
-        current_portfolio = portfolio.add_price_to_portfolio(current_portfolio, user.purchasing_currency)
-        current_portfolio = portfolio.portfolio_with_allocation_percentages(current_portfolio)
-
-        # TODO we should protect against specifying purchasing currency when in livemode
-        #      also, I don't love that this parameter is passed in, feels odd
-        # TODO this needs to be adjusted for a particular exchange
-        if not purchase_balance:
-            purchase_balance = market_buy.purchasing_currency_in_portfolio(user, current_portfolio)
-
-        portfolio_target = market_cap.coins_with_market_cap(user)
-        sorted_market_buys = market_buy.calculate_market_buy_preferences(
-            portfolio_target, current_portfolio, deprioritized_coins=user.deprioritized_coins
-        )
-        market_buys = market_buy.determine_market_buys(user, sorted_market_buys, current_portfolio, portfolio_target, purchase_balance)
-
-        completed_orders = market_buy.make_market_buys(user, market_buys)
-
-        return (purchase_balance, market_buys, completed_orders)
+    def execute(
+        cls,
+        user: User,
+        purchase_balance: t.Optional[Decimal] = None,
+        market_snapshot: t.Optional[t.Union[MarketSnapshot, t.Callable[[], t.Optional[MarketSnapshot]]]] = None,
+    ) -> t.Tuple[Decimal, t.List, t.List]:
+        """
+        `market_snapshot` can be a function which loads the snapshot, it's only called once the run gets past the
+        balance check, so runs without anything to buy don't load any market data.
+        """
+
+        with tracing.span("buy_command") as command_span:
+            # TODO support multiple exchanges here
+            # balances and open orders are loaded once and kept up to date with the orders placed during this run
+            account = AccountSnapshot(user, SupportedExchanges.BINANCE)
+
+            if user.buy_strategy == MarketBuyStrategy.LIMIT and user.cancel_stale_orders:
+                with tracing.span("cancel_stale_orders"):
+                    open_orders.cancel_stale_open_orders(user, SupportedExchanges.BINANCE, account)
+
+            with tracing.span("exchange_portfolio"):
+                current_portfolio = account.portfolio()
+
+            # most runs have nothing to buy, stop before any market data is loaded
+            if not purchase_balance and (skip_reason := market_buy.buy_skip_reason(user, current_portfolio)):
+                log.info("skipping buy, nothing to purchase", reason=skip_reason.value)
+                command_span.tags["skip_reason"] = skip_reason.value
+                return (market_buy.unpriced_purchasing_currency_in_portfolio(user, current_portfolio), [], [])
+
+            if callable(market_snapshot):
+                market_snapshot = market_snapshot()
+
+            # when processing multiple users, market data is pulled once and shared across all of them
+            if market_snapshot:
+                market_snapshot.install()
+
+            if user.convert_stablecoins:
+                with tracing.span("convert_stablecoins"):
+                    conversion_orders = convert_stablecoins.convert_stablecoins(user, SupportedExchanges.BINANCE, current_portfolio)
+
+                    # stablecoin sells are market orders and fill immediately, the balances need to be reloaded to pick up the proceeds
+                    if conversion_orders and user.livemode:
+                        account.invalidate()
+                        current_portfolio = account.portfolio()
+
+            with tracing.span("price_portfolio"):
+                external_portfolio = user.external_portfolio
+                external_portfolio = portfolio.add_price_to_portfolio(external_portfolio, user.purchasing_currency)
+
+                current_portfolio = portfolio.merge_portfolio(current_portfolio, external_portfolio)
+                current_portfolio = portfolio.add_price_to_portfolio(current_portfolio, user.purchasing_currency)
+                current_portfolio = portfolio.portfolio_with_allocation_percentages(current_portfolio)
+
+            # TODO we should protect against specifying purchasing currency when in livemode
+            #      also, I don't love that this parameter is passed in, feels odd
+            # TODO this needs to be adjusted for a particular exchange
+            if not purchase_balance:
+                purchase_balance = market_buy.purchasing_currency_in_portfolio(user, current_portfolio)
+
+            with tracing.span("target_index"):
+                if market_snapshot:
+                    portfolio_target = market_snapshot.target_index(user)
+                else:
+                    portfolio_target = market_cap.coins_with_market_cap(user)
+
+            with tracing.span("market_buy_preferences"):
+                sorted_market_buys = market_buy.calculate_market_buy_preferences(
+                    portfolio_target, current_portfolio, deprioritized_coins=user.deprioritized_coins
+                )
+
+            with tracing.span("determine_market_buys"):
+                market_buys = market_buy.determine_market_buys(
+                    user, sorted_market_buys, current_portfolio, portfolio_target, purchase_balance, account
+                )
+
+            with tracing.span("make_market_buys"):
+                completed_orders = market_buy.make_market_buys(user, market_buys, account)
+
+            return (purchase_balance, market_buys, completed_orders)
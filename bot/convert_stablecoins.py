@@ -5,17 +5,21 @@ from .data_types import CryptoBalance, SupportedExchanges
 from .user import User
 from .utils import log
 
+# stablecoins which can be converted into each purchasing currency
+STABLECOINS = {
+    "USD": ["USDC", "USDT", "BUSD"],
+}
+
 
 # convert all stablecoins of the purchasing currency into the purchasing currency so we can use it
 # in binance, you need to purchase in USD and cannot purchase most currencies from a stablecoin
 def convert_stablecoins(user: User, exchange: SupportedExchanges, portfolio: t.List[CryptoBalance]) -> t.List[t.Dict]:
     purchasing_currency = user.purchasing_currency
-    stablecoin_symbols = []
 
     # TODO check if currency is a stablecoin?
 
-    if purchasing_currency == "USD":
-        stablecoin_symbols = ["USDC", "USDT", "BUSD"]
+    if purchasing_currency in STABLECOINS:
+        stablecoin_symbols = STABLECOINS[purchasing_currency]
     else:
         raise Exception("unexpected purchasing currency input")
 
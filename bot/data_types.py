@@ -20,6 +20,12 @@ class MarketIndexStrategy(str, enum.Enum):
     SMA = "sma"
 
 
+# why a buy was skipped before any market data was loaded, see `market_buy.buy_skip_reason`
+class BuySkipReason(str, enum.Enum):
+    NO_PURCHASING_CURRENCY = "no_purchasing_currency"
+    BELOW_PURCHASE_MINIMUM = "below_purchase_minimum"
+
+
 class OrderType(str, enum.Enum):
     BUY = "BUY"
     SELL = "SELL"
@@ -46,6 +52,7 @@ ExchangeOrder = typing.TypedDict(
 
 # TODO right now it's not possib to mark specific fields as optional
 # https://www.python.org/dev/peps/pep-0655/
+# balances aggregated across exchanges also include `exchanges`: the amount held in each exchange, keyed by exchange name
 CryptoBalance = typing.TypedDict(
     "CryptoBalance",
     {
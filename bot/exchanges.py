@@ -9,7 +9,7 @@ from decimal import Decimal
 from binance.client import Client as BinanceClient
 
 from . import utils
-from .data_types import CryptoBalance, CryptoData, SupportedExchanges
+from .data_types import CryptoBalance, CryptoData, MarketBuy, SupportedExchanges
 from .supported_exchanges.binance import *
 from .supported_exchanges.coinbase import *
 from .user import User
@@ -19,7 +19,7 @@ from .utils import log
 def portfolio(exchange: SupportedExchanges, user: User) -> t.List[CryptoBalance]:
     mapping = {
         SupportedExchanges.BINANCE: binance_portfolio,
-        # SupportedExchanges.COINBASE: coinbase_portfolio,
+        SupportedExchanges.COINBASE: coinbase_portfolio,
     }
 
     return mapping[exchange](user)
@@ -34,6 +34,15 @@ def purchase_minimum(exchange: SupportedExchanges) -> Decimal:
     return mapping[exchange]()
 
 
+def purchasing_currency_decimals(exchange: SupportedExchanges, purchasing_currency: str) -> int:
+    mapping = {
+        SupportedExchanges.BINANCE: binance_purchasing_currency_decimals,
+        # SupportedExchanges.COINBASE: coinbase_purchasing_currency_decimals,
+    }
+
+    return mapping[exchange](purchasing_currency)
+
+
 def open_orders(exchange: SupportedExchanges, user: User) -> t.List[ExchangeOrder]:
     mapping = {
         SupportedExchanges.BINANCE: binance_open_orders,
@@ -61,6 +70,17 @@ def cancel_order(exchange: SupportedExchanges, user: User, order: ExchangeOrder)
     return mapping[exchange](user, order)
 
 
+def validate_buys(
+    exchange: SupportedExchanges, purchasing_currency: str, market_buys: t.List[MarketBuy], limit_prices: t.List[t.Optional[Decimal]]
+) -> t.List[t.Tuple[MarketBuy, t.Optional[Decimal]]]:
+    mapping = {
+        SupportedExchanges.BINANCE: binance_validate_buys,
+        # SupportedExchanges.COINBASE: coinbase_validate_buys,
+    }
+
+    return mapping[exchange](purchasing_currency, market_buys, limit_prices)
+
+
 def limit_buy(exchange: SupportedExchanges, user: User, purchasing_currency: str, symbol: str, quantity: Decimal, price: Decimal):
     mapping = {
         SupportedExchanges.BINANCE: binance_limit_buy,
@@ -123,4 +143,5 @@ def price_of_symbol(symbol: str, purchasing_currency: str) -> Decimal:
 
         from . import market_cap
 
-        return Decimal(market_cap.coinmarketcap_data_for_symbol(symbol)["quote"][purchasing_currency]["price"])
+        # listings are floats, `str` is the shortest representation of the price
+        return Decimal(str(market_cap.coinmarketcap_data_for_symbol(symbol)["quote"][purchasing_currency]["price"]))
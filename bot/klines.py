@@ -0,0 +1,161 @@
+import os
+import tempfile
+import time
+import typing as t
+
+import numpy as np
+from decouple import config
+
+from .utils import log
+
+# https://binance-docs.github.io/apidocs/spot/en/#kline-candlestick-data
+# the API returns an ordered array for each candle, these are the numeric fields we keep
+"""
+[
+  1499040000000,      // Open time
+  "0.01634790",       // Open
+  "0.80000000",       // High
+  "0.01575800",       // Low
+  "0.01577100",       // Close
+  "148976.11427815",  // Volume
+  ...
+]
+"""
+KLINE_COLUMNS = ("open_time", "open", "high", "low", "close", "volume")
+OPEN_TIME, OPEN, HIGH, LOW, CLOSE, VOLUME = range(len(KLINE_COLUMNS))
+
+INTERVAL_MILLISECONDS = {
+    "1h": 60 * 60 * 1000,
+    "4h": 4 * 60 * 60 * 1000,
+    "1d": 24 * 60 * 60 * 1000,
+}
+
+# binance returns at most 1000 candles per request
+KLINES_REQUEST_LIMIT = 1000
+
+KLINES_DIRECTORY = t.cast(str, config("KLINES_DIRECTORY", default=os.path.join(tempfile.gettempdir(), "crypto-index-fund-bot", "klines")))
+
+
+class KlineStore:
+    """
+    Local, columnar candle store. Each (trading pair, interval) is a single `.npy` file containing a
+    `(len(KLINE_COLUMNS), candle_count)` float64 array so each column is contiguous in memory.
+
+    The store is updated incrementally: only candles newer than the last stored candle are requested from the exchange.
+    """
+
+    def __init__(self, directory: str = KLINES_DIRECTORY):
+        self.directory = directory
+
+    def path(self, trading_pair: str, interval: str) -> str:
+        return os.path.join(self.directory, interval, f"{trading_pair}.npy")
+
+    def load(self, trading_pair: str, interval: str) -> np.ndarray:
+        try:
+            return np.load(self.path(trading_pair, interval))
+        except FileNotFoundError:
+            return np.empty((len(KLINE_COLUMNS), 0))
+
+    def trading_pairs(self, interval: str) -> t.List[str]:
+        "all trading pairs with candles stored for `interval`"
+
+        try:
+            file_names = os.listdir(os.path.join(self.directory, interval))
+        except FileNotFoundError:
+            return []
+
+        return sorted(file_name[: -len(".npy")] for file_name in file_names if file_name.endswith(".npy"))
+
+    def save(self, trading_pair: str, interval: str, candles: np.ndarray):
+        path = self.path(trading_pair, interval)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file and atomically replace so concurrent readers never see a partial file
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, candles)
+
+        os.replace(temporary_path, path)
+
+    def append(self, trading_pair: str, interval: str, raw_klines: t.List[t.List]) -> np.ndarray:
+        """
+        Merge raw binance klines into the stored candles. Candles are keyed by open time and newer data wins, which
+        replaces the previously stored (incomplete) candle for the current interval.
+        """
+
+        candles = self.load(trading_pair, interval)
+
+        if raw_klines:
+            new_candles = np.array([kline[: len(KLINE_COLUMNS)] for kline in raw_klines], dtype=np.float64).T
+            candles = candles[:, candles[OPEN_TIME] < new_candles[OPEN_TIME].min()]
+            candles = np.concatenate([candles, new_candles], axis=1)
+
+            self.save(trading_pair, interval, candles)
+
+        return candles
+
+    def is_current(self, candles: np.ndarray, interval: str, now: t.Optional[float] = None) -> bool:
+        "is the latest interval already in the store?"
+
+        if candles.shape[1] == 0:
+            return False
+
+        now_milliseconds = (now or time.time()) * 1000
+        return candles[OPEN_TIME, -1] + INTERVAL_MILLISECONDS[interval] > now_milliseconds
+
+    def update(self, client, trading_pair: str, interval: str, window: int) -> np.ndarray:
+        """
+        Fetch any candles missing from the store, making sure at least `window` candles are available
+        """
+
+        candles = self.load(trading_pair, interval)
+
+        if self.is_current(candles, interval):
+            return candles
+
+        if candles.shape[1] > 0:
+            # the last stored candle may have been incomplete when it was fetched, so request it again
+            start_time = int(candles[OPEN_TIME, -1])
+        else:
+            start_time = int(time.time() * 1000) - INTERVAL_MILLISECONDS[interval] * window
+
+        log.debug("updating klines", trading_pair=trading_pair, interval=interval, start_time=start_time)
+
+        while True:
+            raw_klines = client.get_klines(symbol=trading_pair, interval=interval, startTime=start_time, limit=KLINES_REQUEST_LIMIT)
+            candles = self.append(trading_pair, interval, raw_klines)
+
+            if len(raw_klines) < KLINES_REQUEST_LIMIT:
+                return candles
+
+            start_time = int(raw_klines[-1][OPEN_TIME]) + 1
+
+    def column_matrix(self, trading_pairs: t.List[str], interval: str, window: int, column: int = CLOSE) -> np.ndarray:
+        """
+        Returns a `(len(trading_pairs), window)` matrix of the most recent values of `column` for each trading pair,
+        aligned on the most recent candle. Pairs without enough history are padded with NaN.
+        """
+
+        matrix = np.full((len(trading_pairs), window), np.nan)
+
+        for row, trading_pair in enumerate(trading_pairs):
+            values = self.load(trading_pair, interval)[column, -window:]
+
+            if values.size:
+                matrix[row, -values.size :] = values
+
+        return matrix
+
+    def simple_moving_averages(self, trading_pairs: t.List[str], interval: str, window: int) -> np.ndarray:
+        """
+        SMA of the closing price for each trading pair, calculated across all pairs at once. NaN if a pair has no candles.
+        """
+
+        closes = self.column_matrix(trading_pairs, interval, window)
+
+        # pairs with no history at all are all-NaN rows, which would emit a warning from `nanmean`
+        sums = np.nansum(closes, axis=1)
+        counts = np.count_nonzero(~np.isnan(closes), axis=1)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, sums / counts, np.nan)
@@ -1,94 +1,285 @@
+import threading
+import typing as t
 from decimal import Decimal
 
-from . import exchanges
+import numpy as np
+from decouple import config
+
+from . import klines, utils
+from .data_types import MarketBuy
+from .price_book import price_book
 from .user import User
 from .utils import log
 
-# TODO this logic isn't scientific in any way, mostly a playground
+# binance weights the order book request by its limit, 100 levels is the largest limit with the minimum weight
+ORDER_BOOK_DEPTH = 100
 
+# limit prices are chosen so the order is expected to fill with at least this probability before it's cancelled
+LIMIT_FILL_PROBABILITY = config("LIMIT_FILL_PROBABILITY", default=0.9, cast=float)
 
-def determine_limit_price(user: User, symbol: str, purchasing_currency: str) -> Decimal:
-    # TODO this is binance-specific right now, refactor this out
+# the fill model looks at how often the price dipped over the last day of hourly candles
+FILL_MODEL_INTERVAL = "1h"
+FILL_MODEL_WINDOW = 24
+
+# order books and candles are fetched concurrently when pricing a batch of buys
+PRICING_CONCURRENCY = config("PRICING_CONCURRENCY", default=4, cast=int)
+
+
+class OrderBook:
+    """
+    Array view of a binance order book (`get_order_book`). Asks are sorted from the lowest price and bids from the highest,
+    the cumulative depth of each side is calculated once so depth and VWAP lookups don't iterate over the levels.
+    """
+
+    def __init__(self, raw_order_book: t.Dict):
+        # each level is a `[price, quantity]` pair of strings
+        asks = np.array(raw_order_book["asks"], dtype=np.float64).reshape(-1, 2)
+        bids = np.array(raw_order_book["bids"], dtype=np.float64).reshape(-1, 2)
+
+        self.ask_prices, self.ask_quantities = asks[:, 0], asks[:, 1]
+        self.bid_prices, self.bid_quantities = bids[:, 0], bids[:, 1]
+
+        # cumulative quantity and purchasing currency value available up to and including each level
+        self.ask_depth = np.cumsum(self.ask_quantities)
+        self.ask_quote_depth = np.cumsum(self.ask_prices * self.ask_quantities)
+        self.bid_depth = np.cumsum(self.bid_quantities)
+
+    @property
+    def best_ask(self) -> t.Optional[float]:
+        return float(self.ask_prices[0]) if self.ask_prices.size else None
+
+    @property
+    def best_bid(self) -> t.Optional[float]:
+        return float(self.bid_prices[0]) if self.bid_prices.size else None
+
+    def vwap(self, quote_amount: float) -> t.Optional[float]:
+        """
+        Average price of a market buy of `quote_amount` (in the purchasing currency) walking up the asks.
+        None if the book isn't deep enough to fill the order.
+        """
+
+        level = int(np.searchsorted(self.ask_quote_depth, quote_amount))
+
+        if level >= self.ask_quote_depth.size:
+            return None
+
+        # the levels before `level` are consumed entirely and the remainder is filled at `level`
+        filled_quote = self.ask_quote_depth[level - 1] if level else 0.0
+        filled_quantity = self.ask_depth[level - 1] if level else 0.0
+        quantity = filled_quantity + (quote_amount - filled_quote) / self.ask_prices[level]
+
+        return float(quote_amount / quantity)
+
+    def slippage(self, quote_amount: float) -> t.Optional[float]:
+        "expected price impact of a market buy of `quote_amount` relative to the best ask, 0.01 is 1%"
+
+        if (vwap := self.vwap(quote_amount)) is None or not self.best_ask:
+            return None
+
+        return vwap / self.best_ask - 1
+
+    def bid_depth_ahead(self, prices: np.ndarray) -> np.ndarray:
+        """
+        Quantity bid at or above each of `prices`, which is filled before a new buy at that price. Prices below the
+        fetched levels only count the fetched depth.
+        """
+
+        # bids are sorted from the highest price, so the levels at or above a price are a prefix of the book
+        levels = np.searchsorted(-self.bid_prices, -prices, side="right")
+        return np.concatenate([[0.0], self.bid_depth])[levels]
+
+
+class LimitPrice(t.NamedTuple):
+    price: Decimal
+    # probability the order fills before it is cancelled, according to `fill_probabilities`
+    fill_probability: float
+    # price of the same buy as a market order, None if the order book was not deep enough
+    vwap: t.Optional[float]
+    slippage: t.Optional[float]
+
+
+def candidate_prices(lows: np.ndarray) -> np.ndarray:
+    "the candle lows of each trading pair sorted by price, NaN sorts to the end of each row"
+
+    return np.sort(lows, axis=1)
+
+
+def queue_hours(order_books: t.Sequence[OrderBook], prices: np.ndarray, quote_amounts: np.ndarray, volumes: np.ndarray) -> np.ndarray:
+    """
+    Hours before a buy of each of `quote_amounts` resting at each candidate price is expected to be filled, once the
+    price gets there: the bids at or above the price are ahead of it in the book, and both they and the buy are filled
+    at the average hourly volume of the recent candles in `volumes`.
+
+    Returns a `(trading_pairs, candles)` matrix aligned with `prices`. Pairs without any volume history are not delayed.
+    """
+
+    depth_ahead = np.vstack([order_book.bid_depth_ahead(pair_prices) for order_book, pair_prices in zip(order_books, prices)])
+    candle_counts = np.count_nonzero(~np.isnan(volumes), axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hourly_volumes = np.nansum(volumes, axis=1) / candle_counts
+        hours = (depth_ahead + quote_amounts[:, np.newaxis] / prices) / hourly_volumes[:, np.newaxis]
 
-    trading_pair = symbol + purchasing_currency
+    return np.where(np.isnan(hours), 0.0, hours)
 
-    client = user.binance_client()
 
-    # order depth returns the lowest asks and the highest bids
-    # increasing limits returns lower bids and higher asks
-    # grab a long-ish order book to get some analytics on the order book
+def fill_probabilities(lows: np.ndarray, order_hours: int, queue_hours: t.Optional[np.ndarray] = None) -> t.Tuple[np.ndarray, np.ndarray]:
+    """
+    Candidate limit prices and the probability of each filling, for a `(trading_pairs, candles)` matrix of candle lows.
+
+    A limit buy at price `p` is assumed to fill in an interval if the low of the interval reaches `p`. The per-interval
+    probability is the fraction of recent candles whose low reached `p`, and the order fills if this happens at least once
+    in the `order_hours` before it's cancelled. The candidates are the candle lows themselves: any price in between has
+    the same probability as the next higher low.
 
-    order_book = client.get_order_book(symbol=trading_pair, limit=100)
+    `queue_hours` (see `queue_hours`) is the time spent behind the bids ahead of each candidate, which is taken out of
+    the hours the order has to fill.
 
-    # price that binance reports is at the bottom of the order book
-    # looks like they use the bottom of the ask stack to clear market orders (makes sense)
-    # cannot determine if the orders in the book are market, limit, or other order types.
-    # I wonder if other exchanges expose that sort of information?
-    lowest_ask = order_book["asks"][0][0]
-    highest_bid = order_book["bids"][0][0]
+    Returns `(prices, probabilities)`, both `(trading_pairs, candles)` and sorted by price. Missing candles are NaN.
+    """
 
-    ask_difference = Decimal(highest_bid) - Decimal(lowest_ask)
+    prices = candidate_prices(lows)
+    candle_counts = np.count_nonzero(~np.isnan(lows), axis=1)[:, np.newaxis]
 
-    # TODO can we inspect the low price and determine the volume that was traded at that price point?
-    last_day_low = low_over_last_day(user, trading_pair)
+    # the `j`th lowest price was reached in at least `j + 1` candles
+    touches = np.arange(1, lows.shape[1] + 1)[np.newaxis, :]
 
-    log.warn(
-        "price analytics",
-        symbol=trading_pair,
-        ask_bid_difference=ask_difference,
-        ask_bid_percentage_difference=ask_difference / Decimal(lowest_ask) * -100,
-        last_day_low_difference=100 - (last_day_low / Decimal(lowest_ask) * 100),
-        bid=highest_bid,
-        ask=lowest_ask,
-        last_day_low=last_day_low,
-        reported_price=exchanges.binance_price_for_symbol(trading_pair),
-    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        interval_probabilities = np.minimum(touches / candle_counts, 1.0)
 
-    # TODO calculate momentum, or low price over last 24hrs, to determine the ideal drop price
-    # TODO pull percentage drop attempt from user model
+    fill_hours = order_hours if queue_hours is None else np.maximum(order_hours - queue_hours, 0.0)
 
-    limit_price = min(Decimal(highest_bid), Decimal(lowest_ask) * Decimal(0.97))
-    limit_price = min(last_day_low, limit_price)
+    probabilities = 1 - (1 - interval_probabilities) ** fill_hours
+    probabilities[np.isnan(prices)] = np.nan
 
-    # TODO can we inspect the order book depth here? Or general liquidity for the market?
-    #      what else can we do to improve our purchase strategy?
+    return prices, probabilities
 
-    # TODO add option to use the midpoint, or some other position, of the order book instead of the lowest ask
 
-    return limit_price
+def choose_limit_prices(
+    prices: np.ndarray, probabilities: np.ndarray, best_bids: np.ndarray, fill_probability: float
+) -> t.Tuple[np.ndarray, np.ndarray]:
+    """
+    Lowest candidate price for each trading pair which is expected to fill with at least `fill_probability`.
+    Prices are capped at the best bid: a higher price would cross the spread and fill immediately at the ask.
+    Pairs without a qualifying candidate are priced at the best bid, which is assumed to fill.
+    """
 
+    qualifies = np.nan_to_num(probabilities, nan=0.0) >= fill_probability
+    has_candidate = qualifies.any(axis=1)
+    rows = np.arange(prices.shape[0])
+    candidates = np.argmax(qualifies, axis=1)
 
-def low_over_last_day(user: User, trading_pair: str) -> Decimal:
-    import datetime
+    candidate_prices = np.where(has_candidate, prices[rows, candidates], np.inf)
+    candidate_probabilities = np.where(has_candidate, probabilities[rows, candidates], 1.0)
 
-    # TODO coinbase option is below, but ran into some issues with it that I can't remember
-    # candles = coinbase_public_client.get_product_historic_rates(
-    #   product_id="PAXG-USD",
-    #   granularity=60*60,
-    #   start=(datetime.datetime.now() - datetime.timedelta(hours=24)).isoformat(),
-    #   stop=datetime.datetime.now().isoformat()
-    # )
-    # min([candle['low'] for candle in candles])
-    # https://binance-docs.github.io/apidocs/spot/en/#kline-candlestick-data
-    # the API just returns an ordered array, which is insane
+    limit_prices = np.minimum(candidate_prices, best_bids)
+    # joining the bid has a fill probability at least as high as the candidate it replaced
+    limit_probabilities = np.where(limit_prices < candidate_prices, 1.0, candidate_probabilities)
 
+    return limit_prices, limit_probabilities
+
+
+class LimitPricer:
     """
-    [
-    1499040000000,      // Open time
-    "0.01634790",       // Open
-    "0.80000000",       // High
-    "0.01575800",       // Low
-    "0.01577100",       // Close
-    "148976.11427815",  // Volume
-    1499644799999,      // Close time
-    "2434.19055334",    // Quote asset volume
-    308,                // Number of trades
-    "1756.87402397",    // Taker buy base asset volume
-    "28.46694368",      // Taker buy quote asset volume
-    "17928899.62484339" // Ignore.
-  ]
-  """
-
-    candles = user.binance_client().get_klines(symbol=trading_pair, interval="1h")
-
-    return Decimal(min([candle[3] for candle in candles]))
+    Prices limit buys for a single run. Order books and candles are fetched once per trading pair and reused for every
+    buy in the run.
+    """
+
+    def __init__(
+        self,
+        user: User,
+        purchasing_currency: t.Optional[str] = None,
+        fill_probability: float = LIMIT_FILL_PROBABILITY,
+        store: t.Optional[klines.KlineStore] = None,
+    ):
+        self.user = user
+        self.purchasing_currency = purchasing_currency or user.purchasing_currency
+        self.fill_probability = fill_probability
+        self.store = store or klines.KlineStore()
+
+        self._order_books: t.Dict[str, OrderBook] = {}
+        self._lock = threading.Lock()
+
+    def order_book(self, trading_pair: str) -> OrderBook:
+        with self._lock:
+            if trading_pair in self._order_books:
+                return self._order_books[trading_pair]
+
+        order_book = OrderBook(self.user.binance_client().get_order_book(symbol=trading_pair, limit=ORDER_BOOK_DEPTH))
+
+        with self._lock:
+            return self._order_books.setdefault(trading_pair, order_book)
+
+    def _load_market_data(self, trading_pair: str) -> OrderBook:
+        # candles are kept in the local store, the exchange is only asked for candles the store is missing
+        if not self.store.is_current(self.store.load(trading_pair, FILL_MODEL_INTERVAL), FILL_MODEL_INTERVAL):
+            self.store.update(self.user.binance_client(), trading_pair, FILL_MODEL_INTERVAL, FILL_MODEL_WINDOW)
+
+        return self.order_book(trading_pair)
+
+    def price(self, symbol: str, quote_amount: Decimal) -> LimitPrice:
+        return self.price_batch([{"symbol": symbol, "amount": quote_amount}])[0]
+
+    def price_batch(self, buys: t.List[MarketBuy]) -> t.List[LimitPrice]:
+        "price every buy at once, the fill model is evaluated for all trading pairs in a single pass"
+
+        if not buys:
+            return []
+
+        trading_pairs = [buy["symbol"] + self.purchasing_currency for buy in buys]
+
+        order_books = utils.concurrent_map(self._load_market_data, trading_pairs, max_workers=PRICING_CONCURRENCY)
+
+        best_bids = np.array([self._best_bid(trading_pair, order_book) for trading_pair, order_book in zip(trading_pairs, order_books)])
+        lows = self.store.column_matrix(trading_pairs, FILL_MODEL_INTERVAL, FILL_MODEL_WINDOW, klines.LOW)
+        volumes = self.store.column_matrix(trading_pairs, FILL_MODEL_INTERVAL, FILL_MODEL_WINDOW, klines.VOLUME)
+        quote_amounts = np.array([float(buy["amount"]) for buy in buys])
+
+        # a buy rests behind the bids already in the book, the deeper the book the less time the order has to fill
+        queue = queue_hours(order_books, candidate_prices(lows), quote_amounts, volumes)
+
+        prices, probabilities = fill_probabilities(lows, self.user.stale_order_hour_limit, queue)
+        limit_prices, limit_probabilities = choose_limit_prices(prices, probabilities, best_bids, self.fill_probability)
+
+        results = []
+
+        for buy, trading_pair, order_book, quote_amount, limit_price, probability in zip(
+            buys, trading_pairs, order_books, quote_amounts, limit_prices, limit_probabilities
+        ):
+            result = LimitPrice(
+                price=Decimal(str(limit_price)),
+                fill_probability=float(probability),
+                vwap=order_book.vwap(quote_amount),
+                slippage=order_book.slippage(quote_amount),
+            )
+
+            log.info(
+                "price analytics",
+                symbol=trading_pair,
+                amount=buy["amount"],
+                bid=order_book.best_bid,
+                ask=order_book.best_ask,
+                vwap=result.vwap,
+                slippage=result.slippage,
+                limit_price=result.price,
+                fill_probability=result.fill_probability,
+            )
+
+            results.append(result)
+
+        return results
+
+    def _best_bid(self, trading_pair: str, order_book: OrderBook) -> float:
+        # the streamed best bid is more recent than the order book when it's available
+        if (quote := price_book.quote(trading_pair)) and quote.bid:
+            return float(quote.bid)
+
+        if order_book.best_bid is None:
+            raise ValueError(f"empty order book for {trading_pair}")
+
+        return order_book.best_bid
+
+
+def determine_limit_price(user: User, symbol: str, purchasing_currency: str, quote_amount: Decimal = Decimal(0)) -> Decimal:
+    # TODO this is binance-specific right now, refactor this out
+    return LimitPricer(user, purchasing_currency).price(symbol, quote_amount).price
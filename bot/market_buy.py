@@ -1,10 +1,16 @@
 import typing as t
 from decimal import Decimal
 
-from . import exchanges
+from decouple import config
+
+from . import exchanges, money, utils
+from .account_snapshot import AccountSnapshot
+from .convert_stablecoins import STABLECOINS
 from .data_types import (
+    BuySkipReason,
     CryptoBalance,
     CryptoData,
+    ExchangeOrder,
     MarketBuy,
     MarketBuyStrategy,
     SupportedExchanges,
@@ -12,6 +18,13 @@ from .data_types import (
 from .user import User
 from .utils import log
 
+# maximum number of orders prepared and submitted at once
+ORDER_CONCURRENCY = config("ORDER_CONCURRENCY", default=4, cast=int)
+
+# ideally, we wouldn't need to have a reserve amount. However, FP math is challenging and it's easy
+# to be off a cent or two. It's easier just to reserve $1 and not deal with it. Especially for a fun project.
+PURCHASE_RESERVE_AMOUNT = 1
+
 
 def calculate_market_buy_preferences(
     target_index: t.List[CryptoData],
@@ -34,46 +47,32 @@ def calculate_market_buy_preferences(
 
     log.info("calculating market buy preferences", target_index=len(target_index), current_portfolio=len(current_portfolio))
 
+    # the first balance wins if a symbol is duplicated in the portfolio
+    current_percentages: t.Dict[str, Decimal] = {}
+    for balance in current_portfolio:
+        current_percentages.setdefault(balance["symbol"], balance["percentage"])
+
+    deprioritized_symbols = set(deprioritized_coins)
+
     coins_below_index_target: t.List[CryptoData] = []
 
     # first, let's exclude all coins that we've exceeded target on
     for coin_data in target_index:
-        current_percentage = next((balance["percentage"] for balance in current_portfolio if balance["symbol"] == coin_data["symbol"]), 0)
+        current_percentage = current_percentages.get(coin_data["symbol"], Decimal(0))
 
         if current_percentage < coin_data["percentage"]:
             coins_below_index_target.append(coin_data)
         else:
             log.debug("coin exceeding target, skipping", symbol=coin_data["symbol"], percentage=current_percentage, target=coin_data["percentage"])
 
-    sorted_by_largest_target_delta = sorted(
-        coins_below_index_target,
-        key=lambda coin_data: next((balance["percentage"] for balance in current_portfolio if balance["symbol"] == coin_data["symbol"]), Decimal(0))
-        - coin_data["percentage"],
-    )
-
-    # TODO think about grouping drops into tranches so the above sort isn't completely useless
-    sorted_by_largest_recent_drop = sorted(
-        sorted_by_largest_target_delta,
-        # TODO should we use 7d change vs 30?
-        key=lambda coin_data: coin_data["change_30d"],
-    )
-
-    # prioritize tokens we don't own yet
-    symbols_in_current_allocation = [item["symbol"] for item in current_portfolio]
-    sorted_by_unowned_coins = sorted(
-        sorted_by_largest_recent_drop, key=lambda coin_data: 1 if coin_data["symbol"] in symbols_in_current_allocation else 0
-    )
-
     # prioritize tokens that make up > 1% of the market
     # and either (a) we don't own or (b) our target allocation is off by a factor of 6
     # why 6? It felt right based on looking at what I wanted out of my current allocation
 
-    def should_token_be_treated_as_unowned(coin_data: CryptoData) -> int:
+    def should_token_be_treated_as_unowned(coin_data: CryptoData, current_percentage: Decimal) -> int:
         if coin_data["percentage"] < 1:
             return 1
 
-        current_percentage = next((balance["percentage"] for balance in current_portfolio if balance["symbol"] == coin_data["symbol"]), 0)
-
         if current_percentage == 0:
             return 0
 
@@ -83,25 +82,71 @@ def calculate_market_buy_preferences(
         else:
             return 1
 
-    sorted_by_large_market_cap_coins = sorted(sorted_by_unowned_coins, key=should_token_be_treated_as_unowned)
-
-    # last, but not least, let's respect the user's preference for deprioritizing coins
-    sorted_by_deprioritized_coins = sorted(
-        sorted_by_large_market_cap_coins, key=lambda coin_data: 1 if coin_data["symbol"] in deprioritized_coins else 0
-    )
+    # each criteria was originally applied as a separate stable sort, with the last sort taking precedence.
+    # a single sort against a tuple, ordered from the highest to the lowest precedence, results in the same ordering.
+    def buy_preference(coin_data: CryptoData) -> t.Tuple:
+        symbol = coin_data["symbol"]
+        current_percentage = current_percentages.get(symbol, Decimal(0))
+
+        return (
+            # last, but not least, let's respect the user's preference for deprioritizing coins
+            1 if symbol in deprioritized_symbols else 0,
+            should_token_be_treated_as_unowned(coin_data, current_percentage),
+            # prioritize tokens we don't own yet
+            1 if symbol in current_percentages else 0,
+            # TODO think about grouping drops into tranches so the target delta below isn't completely useless
+            # TODO should we use 7d change vs 30?
+            coin_data["change_30d"],
+            current_percentage - coin_data["percentage"],
+        )
 
-    return sorted_by_deprioritized_coins
+    return sorted(coins_below_index_target, key=buy_preference)
 
 
 def purchasing_currency_in_portfolio(user: User, portfolio: t.List[CryptoBalance]) -> Decimal:
-    # ideally, we wouldn't need to have a reserve amount. However, FP math is challenging and it's easy
-    # to be off a cent or two. It's easier just to reserve $1 and not deal with it. Especially for a fun project.
-    reserve_amount = 1
-
     total = sum([balance["usd_total"] for balance in portfolio if balance["symbol"] == user.purchasing_currency])
 
     # TODO we need some sort of `max` overload to treat a decimal as a `SupportsLessThanT`
-    return max(total - reserve_amount, Decimal(0))  # type: ignore
+    return max(total - PURCHASE_RESERVE_AMOUNT, Decimal(0))  # type: ignore
+
+
+def unpriced_purchasing_currency_in_portfolio(user: User, portfolio: t.List[CryptoBalance]) -> Decimal:
+    """
+    `purchasing_currency_in_portfolio` for balances which have not been priced yet: the purchasing currency is its own
+    price, so its amount is used as the total
+    """
+
+    purchasing_currency_balances = [
+        t.cast(CryptoBalance, {**balance, "usd_total": Decimal(balance["amount"])})
+        for balance in [*portfolio, *user.external_portfolio]
+        if balance["symbol"] == user.purchasing_currency
+    ]
+
+    return purchasing_currency_in_portfolio(user, purchasing_currency_balances)
+
+
+def buy_skip_reason(user: User, portfolio: t.List[CryptoBalance]) -> t.Optional[BuySkipReason]:
+    """
+    Most runs find nothing to buy. This check only looks at the unpriced balances of the purchasing currency and its
+    stablecoins so a run can stop before loading any market data. Returns None when a buy may be possible.
+    """
+
+    exchange_purchase_minimum = exchanges.purchase_minimum(SupportedExchanges.BINANCE)
+    purchase_balance = unpriced_purchasing_currency_in_portfolio(user, portfolio)
+
+    if purchase_balance >= exchange_purchase_minimum:
+        return None
+
+    stablecoin_balances = [balance for balance in portfolio if balance["symbol"] in STABLECOINS.get(user.purchasing_currency, [])]
+
+    # each stablecoin balance is converted on its own, and only when it's above the minimum, see `convert_stablecoins`
+    if user.convert_stablecoins and any(balance["amount"] >= exchange_purchase_minimum for balance in stablecoin_balances):
+        return None
+
+    if not purchase_balance and not stablecoin_balances:
+        return BuySkipReason.NO_PURCHASING_CURRENCY
+
+    return BuySkipReason.BELOW_PURCHASE_MINIMUM
 
 
 def determine_market_buys(
@@ -110,6 +155,7 @@ def determine_market_buys(
     current_portfolio: t.List[CryptoBalance],
     target_portfolio: t.List[CryptoData],
     purchase_balance: Decimal,
+    account: t.Optional[AccountSnapshot] = None,
 ) -> t.List[MarketBuy]:
     """
     1. Is the asset currently trading?
@@ -126,10 +172,6 @@ def determine_market_buys(
     # but not on
     exchange_purchase_minimum = exchanges.purchase_minimum(SupportedExchanges.BINANCE)
 
-    user_purchase_minimum = user.purchase_min
-    user_purchase_maximum = user.purchase_max
-    portfolio_total = sum(balance["usd_total"] for balance in current_portfolio)
-
     if purchase_balance < exchange_purchase_minimum:
         log.info("not enough USD to buy anything", purchase_balance=purchase_balance)
         return []
@@ -138,14 +180,29 @@ def determine_market_buys(
         "enough purchase currency balance",
         balance=purchase_balance,
         exchange_minimum=exchange_purchase_minimum,
-        user_minimum=user_purchase_minimum,
+        user_minimum=user.purchase_min,
     )
 
-    purchase_total = purchase_balance
+    # amounts are integer units of the smallest amount of purchasing currency an order can be placed in (i.e. 0.0001 USD),
+    # each value is rounded down once here and purchase amounts are converted back once they are decided
+    decimals = exchanges.purchasing_currency_decimals(SupportedExchanges.BINANCE, user.purchasing_currency)
+
+    exchange_purchase_minimum = money.to_units(exchange_purchase_minimum, decimals)
+    user_purchase_minimum = money.to_units(user.purchase_min, decimals)
+    user_purchase_maximum = money.to_units(user.purchase_max, decimals)
+    portfolio_total = money.to_units(sum(balance["usd_total"] for balance in current_portfolio), decimals)
+
+    # the first target wins if a symbol is duplicated in the index. Percentages are only converted for the coins
+    # that are considered, most of a large index is never reached
+    target_percentages: t.Dict[str, Decimal] = {}
+    for target in target_portfolio:
+        target_percentages.setdefault(target["symbol"], target["percentage"])
+
+    purchase_total = money.to_units(purchase_balance, decimals)
     purchases = []
 
-    existing_orders = exchanges.open_orders(SupportedExchanges.BINANCE, user)
-    symbols_of_existing_orders = [order["symbol"] for order in existing_orders]
+    account = account or AccountSnapshot(user, SupportedExchanges.BINANCE)
+    symbols_of_existing_orders = {order["symbol"] for order in account.open_orders()}
 
     for coin in sorted_buy_preferences:
         # TODO may make sense in the future to check the purchase amount and adjust the expected
@@ -161,9 +218,7 @@ def determine_market_buys(
         # round up the purchase amount to the total available balance if we don't have enough to buy two tokens
         purchase_amount = purchase_total if purchase_total < exchange_purchase_minimum * 2 else user_purchase_minimum
 
-        # percentage is not expressed in a < 1 float, so we need to convert it
-        coin_portfolio_info = next((target for target in target_portfolio if target["symbol"] == coin["symbol"]))
-        target_amount = coin_portfolio_info["percentage"] / 100 * portfolio_total
+        target_amount = money.share_of(portfolio_total, money.to_units(target_percentages[coin["symbol"]], money.PERCENTAGE_DECIMALS))
 
         # make sure purchase total will not overflow the target allocation
         purchase_amount = min(purchase_amount, target_amount, user_purchase_maximum)
@@ -174,24 +229,27 @@ def determine_market_buys(
         # we need to at least buy the minimum that the exchange allows
         purchase_amount = max(exchange_purchase_minimum, purchase_amount)
 
-        # TODO right now the minNotional filter is NOT respected since the user min is $30, which is normally higher than this value
-        #      this is something we'll have to handle properly in the future
-        # minimum_token_quantity_in_exchange(paired_symbol)
-        # symbol_info = public_binance_client.get_symbol_info(paired_symbol)
-        # tick_size = next(f['minNotional'] for f in symbol_info['filters'] if f['filterType'] == 'PRICE_FILTER')
+        # exchange filters (LOT_SIZE, PRICE_FILTER, MIN_NOTIONAL) depend on the order price and are checked for the
+        # whole batch right before submission, see `exchanges.validate_buys`
 
         if purchase_amount > purchase_total:
-            log.info("not enough purchase currency balance for coin", amount=purchase_amount, balance=purchase_total, coin=coin["symbol"])
+            log.info(
+                "not enough purchase currency balance for coin",
+                amount=money.from_units(purchase_amount, decimals),
+                balance=money.from_units(purchase_total, decimals),
+                coin=coin["symbol"],
+            )
             continue
 
-        log.info("adding purchase preference", symbol=coin["symbol"], amount=purchase_amount)
+        amount = money.from_units(purchase_amount, decimals)
+        log.info("adding purchase preference", symbol=coin["symbol"], amount=amount)
 
         purchases.append(
             {
                 "symbol": coin["symbol"],
                 # TODO should we include the paired symbol in this data structure?
                 # amount in purchasing currency, not a quantity of the symbol to purchase
-                "amount": purchase_amount,
+                "amount": amount,
             }
         )
 
@@ -203,42 +261,60 @@ def determine_market_buys(
     return purchases
 
 
+def make_market_buy(user: User, buy: MarketBuy, limit_price: t.Optional[Decimal] = None) -> t.Optional[ExchangeOrder]:
+    purchasing_currency = user.purchasing_currency
+    symbol = buy["symbol"]
+    amount = buy["amount"]
+
+    if user.buy_strategy == MarketBuyStrategy.LIMIT:
+        from . import limit_buy
+
+        if limit_price is None:
+            limit_price = limit_buy.determine_limit_price(user, symbol, purchasing_currency, amount)
+
+        order_quantity = Decimal(buy["amount"]) / limit_price
+
+        return exchanges.limit_buy(
+            exchange=SupportedExchanges.BINANCE,
+            user=user,
+            purchasing_currency=purchasing_currency,
+            symbol=symbol,
+            quantity=order_quantity,
+            price=limit_price,
+        )
+    else:  # market
+        return exchanges.market_buy(
+            exchange=SupportedExchanges.BINANCE, user=user, symbol=symbol, purchasing_currency=purchasing_currency, amount=amount
+        )
+
+
 # https://www.binance.us/en/usercenter/wallet/money-log
-def make_market_buys(user: User, market_buys: t.List[MarketBuy]) -> t.List:
+def make_market_buys(user: User, market_buys: t.List[MarketBuy], account: t.Optional[AccountSnapshot] = None) -> t.List:
     if not market_buys:
         return []
 
-    purchasing_currency = user.purchasing_currency
-    orders = []
-
     # TODO consider executing limit orders based on the current market orders
     #      this could ensure we don't overpay for an asset with low liquidity
 
-    for buy in market_buys:
-        symbol = buy["symbol"]
-        amount = buy["amount"]
+    # the limit strategy prices every buy up front so order books and candles are fetched once per trading pair
+    limit_prices: t.List[t.Optional[Decimal]] = [None] * len(market_buys)
 
-        if user.buy_strategy == MarketBuyStrategy.LIMIT:
-            from . import limit_buy
+    if user.buy_strategy == MarketBuyStrategy.LIMIT:
+        from . import limit_buy
 
-            limit_price = limit_buy.determine_limit_price(user, symbol, purchasing_currency)
+        limit_prices = [limit_price.price for limit_price in limit_buy.LimitPricer(user).price_batch(market_buys)]
 
-            order_quantity = Decimal(buy["amount"]) / limit_price
+    # an order which fails an exchange filter costs a signed request, invalid buys are resized or dropped locally first
+    validated_buys = exchanges.validate_buys(SupportedExchanges.BINANCE, user.purchasing_currency, market_buys, limit_prices)
 
-            order = exchanges.limit_buy(
-                exchange=SupportedExchanges.BINANCE,
-                user=user,
-                purchasing_currency=purchasing_currency,
-                symbol=symbol,
-                quantity=order_quantity,
-                price=limit_price,
-            )
-        else:  # market
-            order = exchanges.market_buy(
-                exchange=SupportedExchanges.BINANCE, user=user, symbol=symbol, purchasing_currency=purchasing_currency, amount=amount
-            )
+    # each buy is a blocking order submission, buys are submitted concurrently
+    # each request waits for its weight in `exchanges.request_weight_limiter`
+    orders = utils.concurrent_map(lambda buy_with_price: make_market_buy(user, *buy_with_price), validated_buys, max_workers=ORDER_CONCURRENCY)
 
-        orders.append(order)
+    if account:
+        for (buy, _), order in zip(validated_buys, orders):
+            if order:
+                account.record_placed_order(order, buy["amount"])
 
     # in testmode, or in the case of an error, the result is an empty dict
     # remove this since it doesn't provide any useful information and is confusing to parse downstream
@@ -1,13 +1,202 @@
+import json
+import sys
 import typing as t
 from decimal import Decimal
 
-from . import exchanges, utils
+import numpy as np
+from decouple import config
+
+from . import caching, exchanges, klines, tracing, utils
 from .data_types import CryptoData, MarketIndexStrategy, SupportedExchanges
 from .user import User
 from .utils import log
 
+SMA_INTERVAL = t.cast(str, config("SMA_INTERVAL", default="1d"))
+SMA_WINDOW = config("SMA_WINDOW", default=30, cast=int)
+# candles for each coin are requested concurrently when updating the local klines store
+SMA_CONCURRENCY = config("SMA_CONCURRENCY", default=4, cast=int)
+
+# listings are updated every few minutes, but each call uses up API credits
+COINMARKETCAP_CACHE_TIMEOUT = 60 * 30
+
+
+# the listings endpoint quotes every coin in USD unless `convert` is specified
+COINMARKETCAP_QUOTE_CURRENCY = "USD"
+
+
+class _ListingRow(t.NamedTuple):
+    symbol: str
+    tags: t.Tuple[str, ...]
+    rank: int
+    price: float
+    market_cap: float
+    percent_change_7d: float
+    percent_change_30d: float
+
+
+def _project_coin(coin: t.Dict, quote_currency: str) -> _ListingRow:
+    quote = coin["quote"][quote_currency]
+
+    return _ListingRow(
+        symbol=coin["symbol"],
+        # the same tags appear on hundreds of coins, interned strings are stored (and pickled) once
+        tags=tuple(sys.intern(tag) for tag in coin.get("tags") or ()),
+        rank=coin.get("cmc_rank") or 0,
+        # coinmarketcap reports `null` for some values of newly listed coins
+        price=quote.get("price") or 0.0,
+        market_cap=quote.get("market_cap") or 0.0,
+        percent_change_7d=quote.get("percent_change_7d") or 0.0,
+        percent_change_30d=quote.get("percent_change_30d") or 0.0,
+    )
+
+
+class CoinMarketCapListings:
+    """
+    Columnar projection of a coinmarketcap `listings/latest` response. Only the fields the bot uses are kept: the symbol,
+    tags, rank and the price, market cap and 7d/30d percent changes of a single quote currency. Numeric fields are float
+    columns, rows stay in the order of the response (by market cap) and symbols are indexed so a lookup is O(1).
+
+    The full response has ~30 fields per coin, most of them nested, so the projection is a fraction of the size of the
+    response both in memory and when pickled into the cache.
+    """
+
+    def __init__(
+        self,
+        symbols: t.List[str],
+        tags: t.List[t.Tuple[str, ...]],
+        ranks: np.ndarray,
+        prices: np.ndarray,
+        market_caps: np.ndarray,
+        percent_change_7d: np.ndarray,
+        percent_change_30d: np.ndarray,
+        quote_currency: str = COINMARKETCAP_QUOTE_CURRENCY,
+        timestamp: t.Optional[str] = None,
+    ):
+        self.symbols = symbols
+        self.tags = tags
+        self.ranks = ranks
+        self.prices = prices
+        self.market_caps = market_caps
+        self.percent_change_7d = percent_change_7d
+        self.percent_change_30d = percent_change_30d
+        self.quote_currency = quote_currency
+        # `status.timestamp` of the response, i.e. `2021-09-28T20:34:07.000Z`
+        self.timestamp = timestamp
+
+        # the first listing wins if a symbol is duplicated, like the linear scan this replaces
+        self._rows: t.Dict[str, int] = {}
+        for row, symbol in enumerate(symbols):
+            self._rows.setdefault(symbol, row)
+
+    @classmethod
+    def from_json(cls, raw_response: t.Union[str, bytes], quote_currency: str = COINMARKETCAP_QUOTE_CURRENCY) -> "CoinMarketCapListings":
+        """
+        Parse a raw response. Each coin is projected as soon as the decoder finishes it, so the rest of its fields are
+        released immediately instead of building the whole response first. Numbers are parsed as floats.
+        """
+
+        def project_coin(obj: t.Dict) -> t.Any:
+            # `platform` objects have a symbol too, only coins have a quote
+            if "symbol" in obj and "quote" in obj:
+                return _project_coin(obj, quote_currency)
+
+            return obj
+
+        response = json.loads(raw_response, object_hook=project_coin)
+        return cls._from_rows(response["data"], quote_currency, response.get("status", {}).get("timestamp"))
+
+    @classmethod
+    def from_response(cls, response: t.Dict, quote_currency: str = COINMARKETCAP_QUOTE_CURRENCY) -> "CoinMarketCapListings":
+        "project an already decoded response, i.e. a recorded snapshot or test data"
+
+        rows = [_project_coin(coin, quote_currency) for coin in response["data"]]
+        return cls._from_rows(rows, quote_currency, response.get("status", {}).get("timestamp"))
+
+    @classmethod
+    def _from_rows(cls, rows: t.List[_ListingRow], quote_currency: str, timestamp: t.Optional[str]) -> "CoinMarketCapListings":
+        return cls(
+            symbols=[row.symbol for row in rows],
+            tags=[row.tags for row in rows],
+            ranks=np.fromiter((row.rank for row in rows), dtype=np.int32, count=len(rows)),
+            prices=np.fromiter((row.price for row in rows), dtype=np.float64, count=len(rows)),
+            market_caps=np.fromiter((row.market_cap for row in rows), dtype=np.float64, count=len(rows)),
+            percent_change_7d=np.fromiter((row.percent_change_7d for row in rows), dtype=np.float64, count=len(rows)),
+            percent_change_30d=np.fromiter((row.percent_change_30d for row in rows), dtype=np.float64, count=len(rows)),
+            quote_currency=quote_currency,
+            timestamp=timestamp,
+        )
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CoinMarketCapListings) and self.as_response() == other.as_response()
+
+    def __reduce__(self):
+        # the symbol index is rebuilt rather than pickled, it's as large as the symbol column
+        return (
+            CoinMarketCapListings,
+            (
+                self.symbols,
+                self.tags,
+                self.ranks,
+                self.prices,
+                self.market_caps,
+                self.percent_change_7d,
+                self.percent_change_30d,
+                self.quote_currency,
+                self.timestamp,
+            ),
+        )
+
+    def row(self, symbol: str) -> t.Optional[int]:
+        return self._rows.get(symbol)
 
-def coinmarketcap_data():
+    def take(self, rows: t.Sequence[int]) -> "CoinMarketCapListings":
+        "a table of the given rows, in the given order"
+
+        indexes = np.asarray(rows, dtype=np.intp)
+
+        return CoinMarketCapListings(
+            symbols=[self.symbols[row] for row in rows],
+            tags=[self.tags[row] for row in rows],
+            ranks=self.ranks[indexes],
+            prices=self.prices[indexes],
+            market_caps=self.market_caps[indexes],
+            percent_change_7d=self.percent_change_7d[indexes],
+            percent_change_30d=self.percent_change_30d[indexes],
+            quote_currency=self.quote_currency,
+            timestamp=self.timestamp,
+        )
+
+    def check_quote_currency(self, purchasing_currency: str):
+        if purchasing_currency != self.quote_currency:
+            raise KeyError(f"coinmarketcap listings are quoted in {self.quote_currency}, not {purchasing_currency}")
+
+    def coin(self, row: int) -> t.Dict:
+        "a single row in the shape of a listing in the coinmarketcap response"
+
+        return {
+            "symbol": self.symbols[row],
+            "tags": list(self.tags[row]),
+            "cmc_rank": int(self.ranks[row]),
+            "quote": {
+                self.quote_currency: {
+                    "price": float(self.prices[row]),
+                    "market_cap": float(self.market_caps[row]),
+                    "percent_change_7d": float(self.percent_change_7d[row]),
+                    "percent_change_30d": float(self.percent_change_30d[row]),
+                }
+            },
+        }
+
+    def as_response(self) -> t.Dict:
+        "the projected fields in the shape of the coinmarketcap response, i.e. to record a snapshot as JSON"
+
+        return {"status": {"timestamp": self.timestamp}, "data": [self.coin(row) for row in range(len(self))]}
+
+
+def coinmarketcap_data() -> CoinMarketCapListings:
     import decouple
     import requests
 
@@ -15,49 +204,52 @@ def coinmarketcap_data():
         coinmarketcap_api_key = decouple.config("COINMARKETCAP_API_KEY")
         coinbase_endpoint = "https://pro-api.coinmarketcap.com/v1/cryptocurrency/listings/latest?limit=1000&sort=market_cap"
         headers = {"X-CMC_PRO_API_KEY": coinmarketcap_api_key}
-        response = requests.get(coinbase_endpoint, headers=headers)
+        response = requests.get(coinbase_endpoint, headers=headers, hooks={"response": tracing.record_response})
 
         if not response.ok:
             raise Exception("invalid response from coinmarketcap, probably bad api key")
 
-        return response.json(parse_float=Decimal)
+        return CoinMarketCapListings.from_json(response.content)
 
-    return utils.cached_result("coinmarketcap_data", get_coinmarketcap_data)
+    return caching.cached_result(
+        "coinmarketcap_data", get_coinmarketcap_data, timeout=COINMARKETCAP_CACHE_TIMEOUT, stale_timeout=COINMARKETCAP_CACHE_TIMEOUT
+    )
 
 
 # for debugging / testing only
 def coinmarketcap_tags():
-    import operator
-    from functools import reduce
+    return set(tag for tags in coinmarketcap_data().tags for tag in tags)
 
-    all_data = coinmarketcap_data()
-    all_tags = [data["tags"] for data in all_data["data"]]
-    all_tags = reduce(operator.concat, all_tags)
-    return set(all_tags)
 
+def coinmarketcap_data_for_symbol(symbol) -> t.Dict:
+    "raises a KeyError if coinmarketcap does not list the symbol"
 
-# for debugging / testing only
-def coinmarketcap_data_for_symbol(symbol):
     all_data = coinmarketcap_data()
-    return next(data for data in all_data["data"] if data["symbol"] == symbol)
+
+    if (row := all_data.row(symbol)) is None:
+        raise KeyError(f"coinmarketcap does not list {symbol}")
+
+    return all_data.coin(row)
 
 
 # TODO should indicate that this is married to coinmarketcap data a bit more
 # market_data is pulled from coinmarketcap
 def filtered_coins_by_market_cap(
-    market_data, purchasing_currency: str, enabled_exchanges: t.List[SupportedExchanges], exclude_tags=[], exclude_coins=[], limit=-1
-):
+    market_data: CoinMarketCapListings,
+    purchasing_currency: str,
+    enabled_exchanges: t.List[SupportedExchanges],
+    exclude_tags=[],
+    exclude_coins=[],
+    limit: t.Optional[int] = -1,
+) -> CoinMarketCapListings:
 
     exclude_tags = set(exclude_tags)
-    coins = []
-
-    for coin in market_data["data"]:
-        symbol = coin["symbol"]
+    rows = []
 
+    for row, symbol in enumerate(market_data.symbols):
         # was the coin included in a list of skipped coins?
-        offending_tags = set.intersection(set(coin["tags"]), exclude_tags)
-        if len(offending_tags) > 0:
-            log.debug("skipping, includes excluded tag", symbol=symbol, offending_tags=offending_tags)
+        if not exclude_tags.isdisjoint(market_data.tags[row]):
+            log.debug("skipping, includes excluded tag", symbol=symbol, offending_tags=exclude_tags.intersection(market_data.tags[row]))
             continue
 
         # was the coin manually excluded?
@@ -70,61 +262,128 @@ def filtered_coins_by_market_cap(
             log.debug("coin cannot be purchased in exchange", symbol=symbol, enabled_exchanges=enabled_exchanges)
             continue
 
-        coins.append(coin)
+        rows.append(row)
 
         if limit != -1 and limit != None:
             limit -= 1
             if limit == 0:
                 break
 
-    log.info("filtered coin list, used for index", coin_count=len(coins))
+    log.info("filtered coin list, used for index", coin_count=len(rows))
 
-    return coins
+    return market_data.take(rows)
+
+
+# index weighting schemes map an array of market caps to an array of (unnormalized) weights for each coin.
+# schemes should be vectorized numpy operations so the index can be built without looping over each coin in python.
+WeightingScheme = t.Callable[[np.ndarray], np.ndarray]
+
+_weighting_schemes: t.Dict[MarketIndexStrategy, WeightingScheme] = {}
+
+
+def weighting_scheme(strategy: MarketIndexStrategy) -> t.Callable[[WeightingScheme], WeightingScheme]:
+    def register(scheme: WeightingScheme) -> WeightingScheme:
+        _weighting_schemes[strategy] = scheme
+        return scheme
+
+    return register
+
+
+@weighting_scheme(MarketIndexStrategy.MARKET_CAP)
+def market_cap_weights(market_caps: np.ndarray) -> np.ndarray:
+    return market_caps
+
+
+@weighting_scheme(MarketIndexStrategy.SQRT_MARKET_CAP)
+def sqrt_market_cap_weights(market_caps: np.ndarray) -> np.ndarray:
+    return np.sqrt(market_caps)
+
+
+@weighting_scheme(MarketIndexStrategy.SMA)
+def sma_market_cap_weights(market_caps: np.ndarray) -> np.ndarray:
+    # the price smoothing happens in `sma_market_caps`, the smoothed market caps are weighted as-is
+    return market_caps
+
+
+def sma_market_caps(purchasing_currency: str, coins: CoinMarketCapListings, market_caps: np.ndarray) -> np.ndarray:
+    """
+    Replace the current price in each market cap with the SMA of the price from the local klines store:
+    circulating supply (market cap / price) * SMA. Coins without any price history keep their current market cap.
+    """
+
+    store = klines.KlineStore()
+    trading_pairs = [symbol + purchasing_currency for symbol in coins.symbols]
+
+    buyable_trading_pairs = [
+        trading_pair for symbol, trading_pair in zip(coins.symbols, trading_pairs) if exchanges.can_buy_in_binance(symbol, purchasing_currency)
+    ]
+
+    utils.concurrent_map(
+        lambda trading_pair: store.update(exchanges.public_binance_client(), trading_pair, SMA_INTERVAL, SMA_WINDOW),
+        buyable_trading_pairs,
+        max_workers=SMA_CONCURRENCY,
+    )
+
+    moving_averages = store.simple_moving_averages(trading_pairs, SMA_INTERVAL, SMA_WINDOW)
+    prices = coins.prices
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(np.isnan(moving_averages) | (prices == 0), market_caps, market_caps / prices * moving_averages)
+
+
+def calculate_index_weights(market_caps: np.ndarray, strategy: MarketIndexStrategy) -> t.Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the weight and the percentage of the index for each market cap, in a single pass over the array
+    """
+
+    # the strategy can be passed as a raw string from the CLI or user preferences
+    weights = _weighting_schemes[MarketIndexStrategy(strategy)](market_caps)
+    total_weight = weights.sum()
+
+    log.info("total market cap", total_market_cap=total_weight)
+
+    return weights, weights / total_weight * 100
+
+
+def _to_decimal(value: float) -> Decimal:
+    # `str` uses the shortest representation of the float, `Decimal(float)` would include binary rounding noise
+    return Decimal(str(value))
 
 
 # TODO hardcoded against USD quotes right now, support different purchase currencies in the future
 # `coins` is data from coinmarketcap
 def calculate_market_cap_from_coin_list(
-    purchasing_currency: str, coins, strategy: MarketIndexStrategy = MarketIndexStrategy.MARKET_CAP
+    purchasing_currency: str, coins: CoinMarketCapListings, strategy: MarketIndexStrategy = MarketIndexStrategy.MARKET_CAP
 ) -> t.List[CryptoData]:
     log.info("calculating market index", strategy=strategy)
 
+    if not len(coins):
+        return []
+
+    coins.check_quote_currency(purchasing_currency)
+    market_caps = coins.market_caps
+
     if strategy == MarketIndexStrategy.SMA:
-        for coin in coins:
-            breakpoint()
-
-    market_cap_list = [Decimal(coin["quote"][purchasing_currency]["market_cap"]) for coin in coins]
-
-    if strategy == MarketIndexStrategy.SQRT_MARKET_CAP:
-        total_market_cap = sum([cap.sqrt() for cap in market_cap_list])
-    else:
-        total_market_cap = sum([cap for cap in market_cap_list])
-
-    coins_with_market_cap = []
-
-    log.info("total market cap", total_market_cap=total_market_cap)
-
-    for coin in coins:
-        market_cap = Decimal(coin["quote"][purchasing_currency]["market_cap"])
-
-        if strategy == "sqrt_market_cap":
-            market_cap = market_cap.sqrt()
-
-        coins_with_market_cap.append(
-            CryptoData(
-                symbol=coin["symbol"],
-                market_cap=market_cap,
-                # TODO we probably need safer FPA calculations
-                # represents % of total market cap of the portfolio
-                percentage=market_cap / total_market_cap * 100,
-                # include percent changes for purchase priority decisions
-                change_7d=coin["quote"][purchasing_currency]["percent_change_7d"],
-                change_30d=coin["quote"][purchasing_currency]["percent_change_30d"]
-                # TODO why not just add the USD price here? Any benefit to pulling the price from the exchange?
-            )
+        market_caps = sma_market_caps(purchasing_currency, coins, market_caps)
+
+    weights, percentages = calculate_index_weights(market_caps, strategy)
+
+    # decimals are only created at the output boundary
+    return [
+        CryptoData(
+            symbol=symbol,
+            market_cap=_to_decimal(weight),
+            # represents % of total market cap of the portfolio
+            percentage=_to_decimal(percentage),
+            # include percent changes for purchase priority decisions
+            change_7d=change_7d,
+            change_30d=change_30d
+            # TODO why not just add the USD price here? Any benefit to pulling the price from the exchange?
         )
-
-    return coins_with_market_cap
+        for symbol, weight, percentage, change_7d, change_30d in zip(
+            coins.symbols, weights.tolist(), percentages.tolist(), coins.percent_change_7d.tolist(), coins.percent_change_30d.tolist()
+        )
+    ]
 
 
 def coins_with_market_cap(user: User, limit: t.Optional[int] = None) -> t.List[CryptoData]:
@@ -0,0 +1,203 @@
+import mmap
+import os
+import pickle
+import stat
+import struct
+import tempfile
+import time
+import typing as t
+
+from decouple import config
+
+from . import caching, exchanges, market_cap
+from .data_types import CryptoData, MarketIndexStrategy
+from .user import User
+from .utils import log
+
+PreferenceKey = t.Tuple
+
+# snapshots are written to disk so a new process (cron, CLI, celery worker) can start without refetching market data.
+# Snapshots are pickles, so they are kept in a directory only the bot can write to, never a shared temp directory
+MARKET_SNAPSHOT_PATH = t.cast(
+    str,
+    config(
+        "MARKET_SNAPSHOT_PATH",
+        default=os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "crypto-index-fund-bot", "market_snapshot.bin"),
+    ),
+)
+# a snapshot older than this is ignored. Each value in a snapshot still expires with its own cache timeout once installed,
+# so tickers are refetched while listings and exchange info are reused. `0` disables reading snapshots from disk
+MARKET_SNAPSHOT_TTL = config("MARKET_SNAPSHOT_TTL", default=market_cap.COINMARKETCAP_CACHE_TIMEOUT, cast=int)
+# a snapshot shared by a run is rebuilt once it's older than this. Buys are spread across the hour, without a limit the
+# last users would buy against a target index built for the first ones
+MARKET_SNAPSHOT_MAX_AGE = config("MARKET_SNAPSHOT_MAX_AGE", default=market_cap.COINMARKETCAP_CACHE_TIMEOUT, cast=int)
+
+# bump the version when the contents of `MarketSnapshot` (or the objects it holds) change so old files are ignored
+MARKET_SNAPSHOT_MAGIC = b"CIFBSNAP"
+MARKET_SNAPSHOT_VERSION = 2
+# magic, version, created_at. The header can be checked without deserializing the rest of the file
+_MARKET_SNAPSHOT_HEADER = struct.Struct("<8sHd")
+
+
+def index_preference_key(user: User) -> PreferenceKey:
+    "users with the same key share the same target index"
+
+    return (
+        user.purchasing_currency,
+        tuple(sorted(user.exchanges)),
+        # preferences can be stored as raw strings
+        MarketIndexStrategy(user.index_strategy),
+        user.index_limit,
+        tuple(sorted(user.excluded_tags)),
+        tuple(sorted(user.excluded_coins)),
+    )
+
+
+class MarketSnapshot:
+    """
+    Market data that is identical for every user in a run: coinmarketcap listings, exchange tickers, the symbol registry
+    and a target index for each distinct set of index preferences. Build this once and share it across users so
+    per-user work is limited to account-specific calls.
+    """
+
+    def __init__(self):
+        self.created_at = time.time()
+        self.coinmarketcap_data = market_cap.coinmarketcap_data()
+        self.prices = exchanges.binance_all_prices()
+        self.symbol_registry = exchanges.binance_symbol_registry()
+        self.target_indexes: t.Dict[PreferenceKey, t.List[CryptoData]] = {}
+
+    def expired(self, max_age: t.Optional[int] = None) -> bool:
+        max_age = MARKET_SNAPSHOT_MAX_AGE if max_age is None else max_age
+        return self.created_at + max_age < time.time()
+
+    def install(self):
+        """
+        Serve the snapshot's market data from the process-local cache so any lookups made while processing a user
+        (prices, symbol info, etc) do not hit the exchange or redis. Each value expires as if it were fetched when the
+        snapshot was created.
+        """
+
+        caching.prime("coinmarketcap_data", self.coinmarketcap_data, self.created_at + market_cap.COINMARKETCAP_CACHE_TIMEOUT)
+        caching.prime("binance_all_prices", self.prices, self.created_at + exchanges.TICKER_CACHE_TIMEOUT)
+        caching.prime("binance_symbol_registry", self.symbol_registry, self.created_at + exchanges.EXCHANGE_INFO_CACHE_TIMEOUT)
+
+    def target_index(self, user: User) -> t.List[CryptoData]:
+        preference_key = index_preference_key(user)
+
+        if preference_key not in self.target_indexes:
+            self.install()
+            self.target_indexes[preference_key] = market_cap.coins_with_market_cap(user)
+
+        return self.target_indexes[preference_key]
+
+
+def build_market_snapshot(users: t.Iterable[User]) -> MarketSnapshot:
+    snapshot = MarketSnapshot()
+
+    for user in users:
+        snapshot.target_index(user)
+
+    log.info("built market snapshot", target_indexes=len(snapshot.target_indexes))
+
+    return snapshot
+
+
+def _is_private(stat_result: os.stat_result, writable_mode: int) -> bool:
+    "owned by the user running the bot, and not writable by anyone else"
+
+    return stat_result.st_uid == os.getuid() and not stat_result.st_mode & writable_mode
+
+
+def write_market_snapshot(snapshot: MarketSnapshot, path: t.Optional[str] = None):
+    path = path or MARKET_SNAPSHOT_PATH
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    if not _is_private(os.stat(directory), stat.S_IRWXG | stat.S_IRWXO):
+        log.warning("not writing market snapshot, the directory is accessible by other users", path=path)
+        return
+
+    header = _MARKET_SNAPSHOT_HEADER.pack(MARKET_SNAPSHOT_MAGIC, MARKET_SNAPSHOT_VERSION, snapshot.created_at)
+
+    # write to a temporary file and atomically replace so concurrent readers never see a partial file
+    fd, temporary_path = tempfile.mkstemp(dir=directory, suffix=".bin")
+    with os.fdopen(fd, "wb") as f:
+        f.write(header)
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(temporary_path, path)
+
+
+def read_market_snapshot(path: t.Optional[str] = None, ttl: t.Optional[int] = None) -> t.Optional[MarketSnapshot]:
+    """
+    Load a snapshot written by `write_market_snapshot`. Returns None if there is no snapshot, it was written by a different
+    version of the bot or it is older than `ttl` seconds.
+
+    The file is memory-mapped and deserialized directly from the mapping. The snapshot is a pickle, so it's only read
+    if both the file and its directory are owned by the bot and can't be written by other users.
+    """
+
+    path = path or MARKET_SNAPSHOT_PATH
+    ttl = MARKET_SNAPSHOT_TTL if ttl is None else ttl
+
+    if ttl <= 0:
+        return None
+
+    try:
+        if not _is_private(os.stat(os.path.dirname(path)), stat.S_IRWXG | stat.S_IRWXO):
+            log.warning("ignoring market snapshot, the directory is accessible by other users", path=path)
+            return None
+
+        with open(path, "rb") as f:
+            if not _is_private(os.fstat(f.fileno()), stat.S_IWGRP | stat.S_IWOTH):
+                log.warning("ignoring market snapshot, the file is writable by other users", path=path)
+                return None
+
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with mapped_file:
+            magic, version, created_at = _MARKET_SNAPSHOT_HEADER.unpack_from(mapped_file)
+
+            if magic != MARKET_SNAPSHOT_MAGIC or version != MARKET_SNAPSHOT_VERSION:
+                log.info("ignoring market snapshot from a different version", path=path, version=version)
+                return None
+
+            if created_at + ttl < time.time():
+                log.info("market snapshot expired", path=path, created_at=created_at)
+                return None
+
+            with memoryview(mapped_file) as view:
+                return pickle.loads(view[_MARKET_SNAPSHOT_HEADER.size :])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        # an empty or corrupt file, treat it as missing and let the next write replace it
+        log.warning("failed to read market snapshot", path=path, error=e)
+        return None
+
+
+def warm_market_snapshot(users: t.Iterable[User], path: t.Optional[str] = None) -> MarketSnapshot:
+    """
+    Use the snapshot on disk if it's fresh, otherwise build a new one. The snapshot is written back if it was rebuilt
+    or target indexes were added for new index preferences.
+    """
+
+    users = list(users)
+
+    if snapshot := read_market_snapshot(path):
+        target_index_count = len(snapshot.target_indexes)
+
+        for user in users:
+            snapshot.target_index(user)
+
+        log.info("loaded market snapshot", created_at=snapshot.created_at, target_indexes=len(snapshot.target_indexes))
+
+        if len(snapshot.target_indexes) == target_index_count:
+            return snapshot
+    else:
+        snapshot = build_market_snapshot(users)
+
+    write_market_snapshot(snapshot, path)
+
+    return snapshot
@@ -0,0 +1,87 @@
+"""
+Fixed-point amounts for the allocation pipeline.
+
+Balances, percentages and purchase amounts are converted to integers scaled by `10 ** decimals` once when they enter
+the pipeline, compared and summed as plain integers, and converted back to `Decimal` (or an exchange string) once
+when they leave it. Conversions round down, so an amount never exceeds what's actually available.
+"""
+
+import typing as t
+from decimal import Decimal
+
+# percentages are kept to 1e-8 of a percent, well below anything that changes a buy decision
+PERCENTAGE_DECIMALS = 8
+ONE_HUNDRED_PERCENT = 100 * 10 ** PERCENTAGE_DECIMALS
+
+# binance reports at most 8 decimals for any asset
+DEFAULT_DECIMALS = 8
+
+Amount = t.Union[Decimal, int, float, str]
+
+
+def to_units(value: Amount, decimals: int) -> int:
+    "`value` as an integer number of `10 ** -decimals` units, rounded down"
+
+    if isinstance(value, str):
+        return parse_units(value, decimals)
+
+    if isinstance(value, int):
+        return value * 10 ** decimals
+
+    if isinstance(value, float):
+        # user preferences can be stored as floats, use the shortest representation rather than the binary value
+        value = Decimal(repr(value))
+
+    # `int` truncates towards zero, which is the same as `ROUND_DOWN`
+    return int(value * 10 ** decimals)
+
+
+def from_units(units: int, decimals: int) -> Decimal:
+    "the exact `Decimal` for an amount in units, no rounding is required"
+
+    return Decimal(units).scaleb(-decimals)
+
+
+def parse_units(string: str, decimals: int) -> int:
+    """
+    Parse an exchange string (i.e. '0.01000000') directly into units without constructing a `Decimal`.
+    Digits beyond `decimals` are dropped.
+    """
+
+    if string.startswith("-"):
+        return -parse_units(string[1:], decimals)
+
+    if "e" in string or "E" in string:
+        return to_units(Decimal(string), decimals)
+
+    whole, _, fraction = string.partition(".")
+    fraction = fraction[:decimals].ljust(decimals, "0")
+
+    return int(whole or "0") * 10 ** decimals + int(fraction or "0")
+
+
+def format_units(units: int, decimals: int) -> str:
+    "format units as an exchange string with exactly `decimals` digits after the decimal point"
+
+    sign = "-" if units < 0 else ""
+    whole, fraction = divmod(abs(units), 10 ** decimals)
+
+    if not decimals:
+        return f"{sign}{whole}"
+
+    return f"{sign}{whole}.{fraction:0{decimals}d}"
+
+
+def decimals_for_step(step: Decimal) -> int:
+    "number of decimals an exchange filter step (i.e. a `stepSize` of '0.00100000') allows"
+
+    if not step:
+        return DEFAULT_DECIMALS
+
+    return max(-t.cast(int, step.normalize().as_tuple().exponent), 0)
+
+
+def share_of(total: int, percentage: int) -> int:
+    "the portion of `total` a percentage in `PERCENTAGE_DECIMALS` units represents"
+
+    return total * percentage // ONE_HUNDRED_PERCENT
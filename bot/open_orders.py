@@ -2,17 +2,19 @@ import datetime
 import typing as t
 
 from . import exchanges
+from .account_snapshot import AccountSnapshot
 from .data_types import OrderTimeInForce, OrderType, SupportedExchanges
 from .user import User, user_from_env
 from .utils import log
 
 
-def cancel_stale_open_orders(user: User, exchange: SupportedExchanges) -> t.List:
+def cancel_stale_open_orders(user: User, exchange: SupportedExchanges, account: t.Optional[AccountSnapshot] = None) -> t.List:
     order_time_limit = user.stale_order_hour_limit
+    account = account or AccountSnapshot(user, exchange)
 
     old_orders = [
         order
-        for order in exchanges.open_orders(exchange, user)
+        for order in account.open_orders()
         if order["type"] == OrderType.BUY
         and order["time_in_force"] == OrderTimeInForce.GTC
         and order["created_at"] < (datetime.datetime.now() - datetime.timedelta(hours=order_time_limit)).timestamp()
@@ -27,6 +29,7 @@ def cancel_stale_open_orders(user: User, exchange: SupportedExchanges) -> t.List
     for order in old_orders:
         log.info("cancelling order", order=order)
         cancelled_orders.append(exchanges.cancel_order(exchange, user, order))
+        account.record_cancelled_order(order)
 
     return cancelled_orders
 
@@ -1,9 +1,115 @@
 import typing as t
 from decimal import Decimal
 
-from . import exchanges
-from .data_types import CryptoBalance, CryptoData
+from . import exchanges, utils
+from .data_types import CryptoBalance, CryptoData, SupportedExchanges
 from .user import User
+from .utils import log
+
+
+class Portfolio:
+    """
+    Balances keyed by symbol. Merging, joining against a target index and filling in missing assets are all
+    dict lookups instead of scanning the other portfolio for every balance, which matters when merging multiple
+    exchange portfolios and large external portfolios against a 1000 coin index.
+
+    Insertion order is preserved, so the rows produced match the list-based portfolio functions.
+    """
+
+    def __init__(self, balances: t.Iterable[CryptoBalance] = ()):
+        self._balances: t.Dict[str, CryptoBalance] = {}
+
+        for balance in balances:
+            self.add(balance)
+
+    def __len__(self) -> int:
+        return len(self._balances)
+
+    def __iter__(self) -> t.Iterator[CryptoBalance]:
+        return iter(self._balances.values())
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self._balances
+
+    def get(self, symbol: str) -> t.Optional[CryptoBalance]:
+        return self._balances.get(symbol)
+
+    def add(self, balance: CryptoBalance, exchange: t.Optional[SupportedExchanges] = None):
+        """
+        If `exchange` is specified, the amount is also recorded in the balance's `exchanges` breakdown: the amount held in
+        each exchange, keyed by exchange name.
+        """
+
+        if exchange is not None:
+            balance = t.cast(CryptoBalance, balance | {"exchanges": {SupportedExchanges(exchange).value: balance["amount"]}})
+
+        # if an asset already exists in the portfolio, combine them
+        if existing_balance := self._balances.get(balance["symbol"]):
+            combined_balance = existing_balance | {"amount": existing_balance["amount"] + balance["amount"]}
+
+            if "exchanges" in balance:
+                exchange_amounts = dict(existing_balance.get("exchanges", {}))
+
+                for exchange_name, amount in balance["exchanges"].items():  # type: ignore
+                    exchange_amounts[exchange_name] = exchange_amounts.get(exchange_name, Decimal(0)) + amount
+
+                combined_balance["exchanges"] = exchange_amounts
+
+            balance = t.cast(CryptoBalance, combined_balance)
+
+        self._balances[balance["symbol"]] = balance
+
+    def merge(self, other: t.Iterable[CryptoBalance]) -> "Portfolio":
+        merged_portfolio = Portfolio(self)
+
+        for balance in other:
+            merged_portfolio.add(balance)
+
+        return merged_portfolio
+
+    def with_targets(self, portfolio_target: t.List[CryptoData]) -> "Portfolio":
+        # the first target wins if a symbol is duplicated in the index
+        target_percentages: t.Dict[str, Decimal] = {}
+        for target in portfolio_target:
+            target_percentages.setdefault(target["symbol"], target["percentage"])
+
+        return Portfolio(
+            t.cast(
+                CryptoBalance,
+                # updating TypedDicts is not simple https://github.com/python/mypy/issues/6462
+                balance
+                | {
+                    # coin may exist in portfolio but not available for purchase
+                    # this can occur if deposits are allowed but trades are not
+                    "target_percentage": target_percentages.get(balance["symbol"], Decimal(0)),
+                },
+            )
+            for balance in self
+        )
+
+    def with_missing_assets(self, portfolio_target: t.List[CryptoData], price: t.Callable[[str], t.Optional[Decimal]]) -> "Portfolio":
+        """
+        Add an empty balance for every coin in the target index that is not held in this portfolio. `price` returns the
+        price of a symbol in the purchasing currency.
+        """
+
+        return self.merge(
+            CryptoBalance(
+                symbol=target["symbol"],
+                # a missing price is left as `None`, as the list-based portfolio functions did
+                usd_price=t.cast(Decimal, price(target["symbol"])),
+                amount=Decimal(0),
+                # we can't mark specific arguments as optional, so instead we pass a value that will be ignored
+                target_percentage=Decimal(0),
+                usd_total=Decimal(0),
+                percentage=Decimal(0),
+            )
+            for target in portfolio_target
+            if target["symbol"] not in self
+        )
+
+    def balances(self) -> t.List[CryptoBalance]:
+        return list(self._balances.values())
 
 
 def portfolio_with_allocation_percentages(portfolio: t.List[CryptoBalance]) -> t.List[CryptoBalance]:
@@ -27,33 +133,34 @@ def portfolio_with_allocation_percentages(portfolio: t.List[CryptoBalance]) -> t
 # useful for adding in externally held assets
 # in the future, we'll also use this for merging portfolios from multiple exchanges
 def merge_portfolio(portfolio_1: t.List[CryptoBalance], portfolio_2: t.List[CryptoBalance]) -> t.List[CryptoBalance]:
-    new_portfolio: t.List[CryptoBalance] = []
+    return Portfolio(portfolio_1).merge(portfolio_2).balances()
 
-    for balance in portfolio_1:
-        portfolio_2_balance = next(
-            (portfolio_2_balance for portfolio_2_balance in portfolio_2 if portfolio_2_balance["symbol"] == balance["symbol"]), None
-        )
 
-        # if an asset is in porfolio 2, combine them
-        if portfolio_2_balance:
-            new_portfolio.append(
-                t.cast(
-                    CryptoBalance,
-                    balance
-                    | {
-                        "amount": balance["amount"] + portfolio_2_balance["amount"],
-                    },
-                )
-            )
+def exchange_portfolio(user: User) -> t.List[CryptoBalance]:
+    """
+    Balances across all of the user's exchanges, merged by symbol, with an `exchanges` breakdown on each balance.
+    Exchanges are fetched concurrently so this takes about as long as the slowest exchange.
+    """
+
+    user_exchanges = []
+
+    for exchange in map(SupportedExchanges, user.exchanges):
+        if user.has_exchange_credentials(exchange):
+            user_exchanges.append(exchange)
         else:
-            new_portfolio.append(balance)
+            log.warning("skipping exchange without credentials", exchange=exchange.value)
+
+    exchange_portfolios = utils.concurrent_map(
+        lambda exchange: exchanges.portfolio(exchange, user), user_exchanges, max_workers=len(user_exchanges) or 1
+    )
+
+    aggregated_portfolio = Portfolio()
 
-    # add in any new assets from the 2nd portfolio
-    for balance in portfolio_2:
-        if balance["symbol"] not in [balance["symbol"] for balance in new_portfolio]:
-            new_portfolio.append(balance)
+    for exchange, balances in zip(user_exchanges, exchange_portfolios):
+        for balance in balances:
+            aggregated_portfolio.add(balance, exchange=exchange)
 
-    return new_portfolio
+    return aggregated_portfolio.balances()
 
 
 def add_price_to_portfolio(portfolio: t.List[CryptoBalance], purchasing_currency: str) -> t.List[CryptoBalance]:
@@ -78,39 +185,13 @@ def add_missing_assets_to_portfolio(user: User, portfolio: t.List[CryptoBalance]
 
     purchasing_currency = user.purchasing_currency
 
-    return portfolio + [
-        CryptoBalance(
-            symbol=balance["symbol"],
-            usd_price=exchanges.binance_price_for_symbol(balance["symbol"] + purchasing_currency),
-            amount=Decimal(0),
-            # we can't mark specific arguments as optional, so instead we pass a value that will be ignored
-            target_percentage=Decimal(0),
-            usd_total=Decimal(0),
-            percentage=Decimal(0),
-        )
-        for balance in portfolio_target
-        if balance["symbol"] not in [balance["symbol"] for balance in portfolio]
-    ]
+    return (
+        Portfolio(portfolio)
+        .with_missing_assets(portfolio_target, lambda symbol: exchanges.binance_price_for_symbol(symbol + purchasing_currency))
+        .balances()
+    )
 
 
 # right now, this is for tinkering/debugging purposes only
 def add_percentage_target_to_portfolio(portfolio: t.List[CryptoBalance], portfolio_target: t.List[CryptoData]) -> t.List[CryptoBalance]:
-    return t.cast(
-        t.List[CryptoBalance],
-        [
-            # updating TypedDicts is not simple https://github.com/python/mypy/issues/6462
-            balance
-            | {
-                "target_percentage":
-                # `next` is a little trick to return the first match in a list comprehension
-                # https://stackoverflow.com/questions/9542738/python-find-in-list
-                next(
-                    (target["percentage"] for target in portfolio_target if target["symbol"] == balance["symbol"]),
-                    # coin may exist in portfolio but not available for purchase
-                    # this can occur if deposits are allowed but trades are not
-                    Decimal(0),
-                ),
-            }
-            for balance in portfolio
-        ],
-    )
+    return Portfolio(portfolio).with_targets(portfolio_target).balances()
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import threading
+import time
+import typing as t
+from decimal import Decimal
+
+from decouple import config
+from websockets.legacy.client import connect
+
+from .utils import log
+
+# https://docs.binance.us/#websocket-streams
+# `!miniTicker@arr` pushes the last price of every pair which changed in the last second,
+# `!bookTicker` pushes the best bid/ask of every pair as soon as it changes
+PRICE_BOOK_STREAM_URL = t.cast(
+    str,
+    config(
+        "PRICE_BOOK_STREAM_URL",
+        default="wss://stream.binance.us:9443/stream?streams=!miniTicker@arr/!bookTicker",
+    ),
+)
+
+# the stream is a long-running service, only run it in long-lived processes (i.e. celery workers)
+PRICE_BOOK_STREAM = config("PRICE_BOOK_STREAM", default=False, cast=bool)
+
+# quotes older than this are ignored and callers fall back to the REST API. Quiet pairs may not tick for a while.
+PRICE_BOOK_MAX_AGE = config("PRICE_BOOK_MAX_AGE", default=30, cast=int)
+
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+
+class PriceQuote(t.NamedTuple):
+    last: t.Optional[Decimal]
+    bid: t.Optional[Decimal]
+    ask: t.Optional[Decimal]
+    updated_at: float
+
+
+class PriceBook:
+    """
+    Latest price, best bid and best ask for each trading pair, as pushed by the exchange stream.
+
+    Readers never take a lock: each pair maps to an immutable `PriceQuote` which is replaced in a single dict assignment,
+    so a reader sees either the previous or the next quote for a pair. There is only a single writer (the stream consumer),
+    which makes merging ticker and book updates into the existing quote safe.
+    """
+
+    def __init__(self):
+        self._quotes: t.Dict[str, PriceQuote] = {}
+
+    def __len__(self) -> int:
+        return len(self._quotes)
+
+    def update(
+        self,
+        trading_pair: str,
+        last: t.Optional[Decimal] = None,
+        bid: t.Optional[Decimal] = None,
+        ask: t.Optional[Decimal] = None,
+        updated_at: t.Optional[float] = None,
+    ):
+        previous = self._quotes.get(trading_pair)
+
+        self._quotes[trading_pair] = PriceQuote(
+            last=last if last is not None else (previous and previous.last),
+            bid=bid if bid is not None else (previous and previous.bid),
+            ask=ask if ask is not None else (previous and previous.ask),
+            updated_at=updated_at or time.time(),
+        )
+
+    def quote(self, trading_pair: str, max_age: int = PRICE_BOOK_MAX_AGE) -> t.Optional[PriceQuote]:
+        "returns None if there is no quote for the pair or the quote is older than `max_age` seconds"
+
+        quote = self._quotes.get(trading_pair)
+
+        if quote is None or time.time() - quote.updated_at > max_age:
+            return None
+
+        return quote
+
+    def last_price(self, trading_pair: str) -> t.Optional[Decimal]:
+        quote = self.quote(trading_pair)
+        return quote.last if quote else None
+
+    def handle_message(self, message: t.Union[t.Dict, t.List]):
+        """
+        Apply a decoded stream payload. Combined streams wrap each payload as `{"stream": ..., "data": ...}`.
+
+        https://docs.binance.us/#all-market-mini-tickers-stream
+        https://docs.binance.us/#all-book-tickers-stream
+        """
+
+        if isinstance(message, dict) and "stream" in message:
+            message = message["data"]
+
+        events = message if isinstance(message, list) else [message]
+        now = time.time()
+
+        for event in events:
+            event_type = event.get("e")
+
+            if event_type == "24hrMiniTicker":
+                self.update(event["s"], last=Decimal(event["c"]), updated_at=now)
+            elif event_type == "24hrTicker":
+                self.update(event["s"], last=Decimal(event["c"]), bid=Decimal(event["b"]), ask=Decimal(event["a"]), updated_at=now)
+            elif event_type is None and "b" in event and "a" in event:
+                # book ticker events do not specify an event type
+                self.update(event["s"], bid=Decimal(event["b"]), ask=Decimal(event["a"]), updated_at=now)
+            else:
+                log.debug("ignoring price book event", event_type=event_type)
+
+    def clear(self):
+        self._quotes = {}
+
+
+class PriceBookStream:
+    """
+    Consumes the exchange ticker stream on a background thread and feeds it into a `PriceBook`, reconnecting with
+    exponential backoff when the connection drops.
+    """
+
+    def __init__(self, price_book: PriceBook, url: str = PRICE_BOOK_STREAM_URL):
+        self.price_book = price_book
+        self.url = url
+
+        self._thread: t.Optional[threading.Thread] = None
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self._task: t.Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+
+    async def consume(self):
+        "consume messages until the connection is closed"
+
+        async with connect(self.url) as websocket:
+            log.info("connected to price book stream", url=self.url)
+
+            async for message in websocket:
+                self.price_book.handle_message(json.loads(message))
+
+    async def consume_forever(self):
+        delay = RECONNECT_MIN_DELAY
+
+        while not self._stopped.is_set():
+            try:
+                await self.consume()
+                delay = RECONNECT_MIN_DELAY
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("price book stream disconnected", error=e, retry_in=delay)
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="price-book-stream", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stopped.set()
+
+        if self._loop and self._task:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._task = self._loop.create_task(self.consume_forever())
+
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+
+price_book = PriceBook()
+
+_price_book_stream: t.Optional[PriceBookStream] = None
+
+
+def start_price_book_stream() -> PriceBookStream:
+    global _price_book_stream
+
+    if _price_book_stream is None:
+        _price_book_stream = PriceBookStream(price_book)
+
+    _price_book_stream.start()
+    return _price_book_stream
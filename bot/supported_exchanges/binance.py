@@ -1,64 +1,187 @@
 import decimal
-import functools
-import math
+import re
 import typing as t
+import urllib.parse
 from decimal import Decimal
 
+import requests
+import requests.adapters
+from binance.client import BaseClient
 from binance.client import Client as BinanceClient
+from decouple import config
 
-from .. import utils
+from .. import caching, money, tracing
 from ..data_types import (
     CryptoBalance,
     ExchangeOrder,
+    MarketBuy,
     OrderTimeInForce,
     OrderType,
     SupportedExchanges,
 )
+from ..price_book import price_book
 from ..user import User
 from ..utils import log
+from ..weight_limiter import RequestWeightLimiter
 
 # https://algotrading101.com/learn/binance-python-api-guide/
 # https://github.com/timggraf/crypto-index-bot seems to have details about binance errors. Need to handle more error types
 
 
-# initializing a new client actually hits the `ping` endpoint on the API
-# which is on of the reasons we want to cache it
-@functools.cache
+def _order_book_weight(method: str, params: t.Dict) -> int:
+    # weighted by the number of levels requested, `limit_buy.ORDER_BOOK_DEPTH` is the deepest book with the minimum weight
+    limit = int(params.get("limit", 100))
+
+    for max_limit, weight in ((100, 1), (500, 5), (1000, 10)):
+        if limit <= max_limit:
+            return weight
+
+    return 50
+
+
+# request weight of each endpoint used by the bot, keyed by the path after the API version
+# https://binance-docs.github.io/apidocs/spot/en/#market-data-endpoints
+# https://binance-docs.github.io/apidocs/spot/en/#spot-account-trade
+ENDPOINT_WEIGHTS: t.Dict[str, t.Callable[[str, t.Dict], int]] = {
+    "ping": lambda method, params: 1,
+    "time": lambda method, params: 1,
+    "exchangeInfo": lambda method, params: 10,
+    "depth": _order_book_weight,
+    "klines": lambda method, params: 1,
+    # ticker endpoints are cheap for a single symbol and expensive for all symbols at once
+    "ticker/price": lambda method, params: 1 if "symbol" in params else 2,
+    "ticker/bookTicker": lambda method, params: 1 if "symbol" in params else 2,
+    "ticker/24hr": lambda method, params: 1 if "symbol" in params else 40,
+    "account": lambda method, params: 10,
+    "order": lambda method, params: 2 if method == "get" else 1,
+    "order/test": lambda method, params: 1,
+    "openOrders": lambda method, params: 3 if "symbol" in params else 40,
+    "allOrders": lambda method, params: 10,
+    "myTrades": lambda method, params: 10,
+}
+DEFAULT_ENDPOINT_WEIGHT = 1
+
+_API_PATH_PREFIX = re.compile(r"^/(?:api|sapi)/v\d+/")
+
+
+def binance_request_weight(method: str, uri: str, params: t.Optional[t.Dict] = None) -> int:
+    endpoint = _API_PATH_PREFIX.sub("", urllib.parse.urlparse(uri).path)
+
+    if weight := ENDPOINT_WEIGHTS.get(endpoint):
+        return weight(method, params or {})
+
+    return DEFAULT_ENDPOINT_WEIGHT
+
+
+# request weight is limited per IP, the limiter is shared by every client in the process and, when redis is available,
+# by every process
+request_weight_limiter = RequestWeightLimiter()
+
+CLIENT_POOL_MAX_SIZE = config("BINANCE_CLIENT_POOL_MAX_SIZE", default=256, cast=int)
+CLIENT_POOL_TIMEOUT = config("BINANCE_CLIENT_POOL_TIMEOUT", default=60 * 60, cast=int)
+# keep-alive connections to the exchange shared by all clients
+CLIENT_POOL_CONNECTIONS = 20
+
+
+class PooledBinanceClient(BinanceClient):
+    """
+    Binance client which shares a connection pool with every other pooled client and does not ping the API on creation.
+    """
+
+    def __init__(self, api_key: str, api_secret: str, http_adapter: requests.adapters.HTTPAdapter, tld: str = "us"):
+        self.http_adapter = http_adapter
+
+        # `Client.__init__` hits the `ping` endpoint to warm up DNS and TLS, which pooled keep-alive connections make unnecessary
+        BaseClient.__init__(self, api_key, api_secret, tld=tld)
+
+    def _init_session(self) -> requests.Session:
+        # the session holds the API key headers, so each client needs its own session, but the underlying
+        # connections can be shared across all clients
+        session = super()._init_session()
+        session.mount("https://", self.http_adapter)
+        session.hooks["response"].append(request_weight_limiter.record_response)
+        return tracing.trace_session(session)
+
+    def _request(self, method, uri: str, signed: bool, force_params: bool = False, **kwargs):
+        # every API call goes through here, so each request waits for its own weight
+        request_weight_limiter.acquire(binance_request_weight(method, uri, kwargs.get("data")))
+        return super()._request(method, uri, signed, force_params, **kwargs)
+
+
+class BinanceClientPool(caching.ClientPool[BinanceClient]):
+    "clients share a single HTTP connection pool, each client keeps its own session for the API key headers"
+
+    def __init__(self, max_size: int = CLIENT_POOL_MAX_SIZE, timeout: int = CLIENT_POOL_TIMEOUT):
+        super().__init__(max_size, timeout)
+        self._http_adapter = requests.adapters.HTTPAdapter(pool_maxsize=CLIENT_POOL_CONNECTIONS)
+
+    def create_client(self, *credentials: str) -> BinanceClient:
+        api_key, api_secret = credentials
+        return PooledBinanceClient(api_key, api_secret, self._http_adapter)
+
+    def clear(self):
+        super().clear()
+        self._http_adapter.close()
+        self._http_adapter = requests.adapters.HTTPAdapter(pool_maxsize=CLIENT_POOL_CONNECTIONS)
+
+
+binance_client_pool = BinanceClientPool()
+
+
 def public_binance_client() -> BinanceClient:
-    return BinanceClient("", "", tld="us")
+    return binance_client_pool.client("", "")
 
 
 def binance_purchase_minimum() -> Decimal:
     return Decimal(10)
 
 
-def can_buy_in_binance(symbol, purchasing_currency):
-    for coin in binance_all_symbol_info():
-        if coin["baseAsset"] == symbol and coin["quoteAsset"] == purchasing_currency:
-            return True
+def binance_purchasing_currency_decimals(purchasing_currency: str) -> int:
+    "decimals order amounts in the purchasing currency are expressed in, i.e. 4 for USD"
 
-    return False
+    precision = binance_symbol_registry().quote_asset_precision(purchasing_currency)
+    return money.DEFAULT_DECIMALS if precision is None else precision
 
 
-# TODO is there a way to enforce trading pair via typing?
-def binance_price_for_symbol(trading_pair: str) -> Decimal:
-    """
-    trading_pair must be in the format of "BTCUSD"
+def can_buy_in_binance(symbol, purchasing_currency):
+    return binance_symbol_registry().get_by_assets(symbol, purchasing_currency) is not None
 
-    This method will throw an exception if the price does not exist.
-    """
 
+# prices move quickly, but a slightly stale price is fine for index calculations
+TICKER_CACHE_TIMEOUT = 30
+# new listings and filter changes are rare
+EXCHANGE_INFO_CACHE_TIMEOUT = 60 * 60 * 6
+
+
+def binance_all_prices() -> t.Dict[str, Decimal]:
     # `symbol` is a trading pair
     # this includes both USDT and USD prices
     # the pair formatting is 'BTCUSD'
-    return utils.cached_result(
-        "binance_price_for_symbol",
+    return caching.cached_result(
+        "binance_all_prices",
         lambda: {
             price_dict["symbol"]: Decimal(price_dict["price"])
             # `get_all_tickers` is only called once
             for price_dict in public_binance_client().get_all_tickers()
         },
-    ).get(trading_pair)
+        timeout=TICKER_CACHE_TIMEOUT,
+        stale_timeout=60,
+    )
+
+
+# TODO is there a way to enforce trading pair via typing?
+def binance_price_for_symbol(trading_pair: str) -> t.Optional[Decimal]:
+    """
+    trading_pair must be in the format of "BTCUSD"
+
+    Returns None if the price does not exist.
+    """
+
+    # when the price book stream is running, prices don't require any requests
+    if price := price_book.last_price(trading_pair):
+        return price
+
+    return binance_all_prices().get(trading_pair)
 
 
 def binance_portfolio(user: User) -> t.List[CryptoBalance]:
@@ -126,22 +249,203 @@ def binance_open_orders(user: User) -> t.List[ExchangeOrder]:
     ]
 
 
-# TODO maybe document struct of dict?
-def binance_all_symbol_info() -> t.List[t.Dict]:
-    return utils.cached_result(
-        "binance_all_symbol_info",
+class BinanceSymbolFilters(t.NamedTuple):
+    """
+    Exchange filters for a single trading pair, parsed into decimals once when the registry is built.
+    Filters which binance does not report for a pair are represented as zero.
+    """
+
+    # LOT_SIZE
+    min_quantity: Decimal
+    max_quantity: Decimal
+    step_size: Decimal
+    # PRICE_FILTER
+    min_price: Decimal
+    max_price: Decimal
+    tick_size: Decimal
+    # MIN_NOTIONAL, the minimum order size in the quote asset
+    min_notional: Decimal
+    quote_asset_precision: int
+
+
+def _parse_symbol_filters(symbol_info: t.Dict) -> BinanceSymbolFilters:
+    """
+    {'filterType': 'PRICE_FILTER', 'minPrice': '0.00010000', 'maxPrice': '100000.00000000', 'tickSize': '0.00010000'}
+    {'filterType': 'LOT_SIZE', 'minQty': '0.10000000', 'maxQty': '9000000.00000000', 'stepSize': '0.10000000'}
+    {'filterType': 'MIN_NOTIONAL', 'minNotional': '10.00000000', 'applyToMarket': True, 'avgPriceMins': 5}
+    """
+
+    filters = {f["filterType"]: f for f in symbol_info["filters"]}
+    lot_size = filters.get("LOT_SIZE", {})
+    price_filter = filters.get("PRICE_FILTER", {})
+    # newer exchange info responses replace MIN_NOTIONAL with NOTIONAL
+    min_notional = filters.get("MIN_NOTIONAL", filters.get("NOTIONAL", {}))
+
+    return BinanceSymbolFilters(
+        min_quantity=Decimal(lot_size.get("minQty", 0)),
+        max_quantity=Decimal(lot_size.get("maxQty", 0)),
+        step_size=Decimal(lot_size.get("stepSize", 0)),
+        min_price=Decimal(price_filter.get("minPrice", 0)),
+        max_price=Decimal(price_filter.get("maxPrice", 0)),
+        tick_size=Decimal(price_filter.get("tickSize", 0)),
+        min_notional=Decimal(min_notional.get("minNotional", 0)),
+        quote_asset_precision=symbol_info["quoteAssetPrecision"],
+    )
+
+
+class SymbolQuantizer(t.NamedTuple):
+    """
+    LOT_SIZE, PRICE_FILTER and MIN_NOTIONAL of a trading pair as integer units (see `money`), computed once per pair so
+    a batch of orders can be rounded and checked without converting the filters for every order. Zero means the filter
+    was not reported.
+    """
+
+    quantity_decimals: int
+    step_size: int
+    min_quantity: int
+    max_quantity: int
+
+    # prices and amounts in the quote asset can't be more precise than the tick size or the quote asset precision
+    price_decimals: int
+    tick_size: int
+    min_price: int
+    max_price: int
+    min_notional: int
+
+    @classmethod
+    def from_filters(cls, filters: BinanceSymbolFilters) -> "SymbolQuantizer":
+        quantity_decimals = money.decimals_for_step(filters.step_size)
+        price_decimals = min(filters.quote_asset_precision, money.decimals_for_step(filters.tick_size))
+
+        return cls(
+            quantity_decimals=quantity_decimals,
+            step_size=money.to_units(filters.step_size, quantity_decimals),
+            min_quantity=money.to_units(filters.min_quantity, quantity_decimals),
+            max_quantity=money.to_units(filters.max_quantity, quantity_decimals),
+            price_decimals=price_decimals,
+            # a tick smaller than the quote asset precision rounds to zero
+            tick_size=max(money.to_units(filters.tick_size, price_decimals), 1),
+            min_price=money.to_units(filters.min_price, price_decimals),
+            max_price=money.to_units(filters.max_price, price_decimals),
+            min_notional=money.to_units(filters.min_notional, price_decimals),
+        )
+
+    def amount(self, amount: Decimal) -> int:
+        "amount in the quote asset in price units, rounded down"
+
+        return money.to_units(amount, self.price_decimals)
+
+    def quantity_for(self, amount: int, price: int) -> int:
+        "quantity in units an amount buys at a price (both in price units), rounded down to the step size"
+
+        return self._round_to_step(amount * 10 ** self.quantity_decimals // price)
+
+    def largest_quantity(self) -> t.Optional[int]:
+        return self._round_to_step(self.max_quantity) if self.max_quantity else None
+
+    def price(self, price: Decimal) -> int:
+        "price in units rounded down to the tick size"
+
+        units = money.to_units(price, self.price_decimals)
+        return units - units % self.tick_size
+
+    def valid_price(self, price: int) -> bool:
+        return price > 0 and price >= self.min_price and (not self.max_price or price <= self.max_price)
+
+    def valid_quantity(self, quantity: int) -> bool:
+        return quantity > 0 and quantity >= self.min_quantity
+
+    def valid_notional(self, quantity: int, price: int) -> bool:
+        # the product of quantity and price units is in `quantity_decimals + price_decimals` units
+        return quantity * price >= self.min_notional * 10 ** self.quantity_decimals
+
+    def _round_to_step(self, quantity: int) -> int:
+        return quantity - quantity % self.step_size if self.step_size else quantity
+
+
+class SymbolRegistry:
+    """
+    Hash-indexed view of binance's exchange info. This is built once per `get_exchange_info` fetch so lookups
+    don't scan the full symbol list; `filtered_coins_by_market_cap` checks every coinmarketcap listing against it.
+    """
+
+    def __init__(self, all_symbol_info: t.List[t.Dict]):
+        self.all_symbol_info = all_symbol_info
+
+        # `symbol` on binance is the trading pair, i.e. 'BTCUSD'
+        self._by_trading_pair = {symbol_info["symbol"]: symbol_info for symbol_info in all_symbol_info}
+        self._by_assets = {(symbol_info["baseAsset"], symbol_info["quoteAsset"]): symbol_info for symbol_info in all_symbol_info}
+        self._filters = {symbol_info["symbol"]: _parse_symbol_filters(symbol_info) for symbol_info in all_symbol_info}
+        # built on first use, most pairs are never ordered
+        self._quantizers: t.Dict[str, SymbolQuantizer] = {}
+
+        # the precision of an asset when it's used to pay for an order. This can differ between pairs, so keep the highest
+        self._quote_asset_precisions: t.Dict[str, int] = {}
+        for symbol_info in all_symbol_info:
+            quote_asset = symbol_info["quoteAsset"]
+            self._quote_asset_precisions[quote_asset] = max(symbol_info["quoteAssetPrecision"], self._quote_asset_precisions.get(quote_asset, 0))
+
+    def __len__(self) -> int:
+        return len(self.all_symbol_info)
+
+    def __reduce__(self):
+        # only the raw exchange info is serialized (i.e. in a market snapshot), rebuilding the indexes is faster than
+        # unpickling the parsed filters and the result is half the size
+        return (SymbolRegistry, (self.all_symbol_info,))
+
+    def get(self, trading_pair: str) -> t.Optional[t.Dict]:
+        return self._by_trading_pair.get(trading_pair)
+
+    def get_by_assets(self, base_asset: str, quote_asset: str) -> t.Optional[t.Dict]:
+        return self._by_assets.get((base_asset, quote_asset))
+
+    def filters(self, trading_pair: str) -> t.Optional[BinanceSymbolFilters]:
+        return self._filters.get(trading_pair)
+
+    def quote_asset_precision(self, quote_asset: str) -> t.Optional[int]:
+        return self._quote_asset_precisions.get(quote_asset)
+
+    def quantizer(self, trading_pair: str) -> t.Optional[SymbolQuantizer]:
+        if quantizer := self._quantizers.get(trading_pair):
+            return quantizer
+
+        if (filters := self.filters(trading_pair)) is None:
+            return None
+
+        return self._quantizers.setdefault(trading_pair, SymbolQuantizer.from_filters(filters))
+
+
+def binance_symbol_registry() -> SymbolRegistry:
+    return caching.cached_result(
+        "binance_symbol_registry",
         # exchange info includes filters, status, etc but does NOT include pricing data
-        lambda: public_binance_client().get_exchange_info()["symbols"],
+        lambda: SymbolRegistry(public_binance_client().get_exchange_info()["symbols"]),
+        timeout=EXCHANGE_INFO_CACHE_TIMEOUT,
+        stale_timeout=60 * 60,
     )
 
 
-def binance_get_symbol_info(trading_pair: str):
-    return next((symbol_info for symbol_info in binance_all_symbol_info() if symbol_info["symbol"] == trading_pair))
+# TODO maybe document struct of dict?
+def binance_all_symbol_info() -> t.List[t.Dict]:
+    return binance_symbol_registry().all_symbol_info
 
 
-def binance_normalize_purchase_amount(amount: t.Union[str, Decimal], symbol: str) -> str:
-    symbol_info = binance_get_symbol_info(symbol)
+def binance_get_symbol_info(trading_pair: str) -> t.Optional[t.Dict]:
+    return binance_symbol_registry().get(trading_pair)
+
+
+def binance_symbol_filters(trading_pair: str) -> BinanceSymbolFilters:
+    """
+    Raises a KeyError if the trading pair does not exist
+    """
+
+    if filters := binance_symbol_registry().filters(trading_pair):
+        return filters
+
+    raise KeyError(f"unknown trading pair {trading_pair}")
+
 
+def binance_normalize_purchase_amount(amount: t.Union[str, Decimal], symbol: str) -> str:
     # not 100% sure of the logic below, but I imagine it's possible for the quote asset precision
     # and the step size precision to be different. In this case, to satisfy both filters, we'd need to pick the min
     # asset_rounding_precision = symbol_info['quoteAssetPrecision']
@@ -149,25 +453,93 @@ def binance_normalize_purchase_amount(amount: t.Union[str, Decimal], symbol: str
     # the quote precision is not what we need to round by, the stepSize needs to be used instead:
     # https://github.com/sammchardy/python-binance/issues/219
     # {'filterType': 'LOT_SIZE', 'minQty': '0.10000000', 'maxQty': '9000000.00000000', 'stepSize': '0.10000000'},
-    step_size = next(Decimal(f["stepSize"]) for f in symbol_info["filters"] if f["filterType"] == "LOT_SIZE")
+    step_size = binance_symbol_filters(symbol).step_size
     amount = Decimal(amount)
 
     # normalize removes trailing zeros, which modifies the precision that quantize uses for rounding
     # https://stackoverflow.com/questions/11227620/drop-trailing-zeros-from-decimal
-    return str(amount.quantize(Decimal(step_size).normalize(), rounding=decimal.ROUND_UP))
+    return str(amount.quantize(step_size.normalize(), rounding=decimal.ROUND_UP))
+
+
+def binance_symbol_quantizer(trading_pair: str) -> SymbolQuantizer:
+    """
+    Raises a KeyError if the trading pair does not exist
+    """
+
+    if quantizer := binance_symbol_registry().quantizer(trading_pair):
+        return quantizer
+
+    raise KeyError(f"unknown trading pair {trading_pair}")
 
 
 def binance_normalize_price(amount: t.Union[str, Decimal], symbol: str) -> str:
-    symbol_info = binance_get_symbol_info(symbol)
+    return format(Decimal(amount), f"0.{binance_symbol_quantizer(symbol).price_decimals}f")
 
-    asset_rounding_precision = symbol_info["quoteAssetPrecision"]
 
-    tick_size = next(f["tickSize"] for f in symbol_info["filters"] if f["filterType"] == "PRICE_FILTER")
-    tick_size_rounding_precision = int(round(-math.log(float(tick_size), 10), 0))
+def binance_validate_buys(
+    purchasing_currency: str, market_buys: t.List[MarketBuy], limit_prices: t.List[t.Optional[Decimal]]
+) -> t.List[t.Tuple[MarketBuy, t.Optional[Decimal]]]:
+    """
+    Check a batch of planned buys against each pair's filters before anything is submitted. An order which fails a
+    filter is rejected by binance after a signed round trip, so buys are resized to fit the filters where possible and
+    dropped otherwise.
 
-    rounding_precision = min(asset_rounding_precision, tick_size_rounding_precision)
+    Limit buys (with a price) are rounded down to the tick and step size, so the order never costs more than planned.
+    Market buys are checked against the last price from the price book, the exchange fills them at whatever quantity the
+    amount buys. Without a streamed price only the amount is checked, fetching the tickers here would cost a request.
+
+    Returns the buys to submit, each with its normalized limit price.
+    """
+
+    registry = binance_symbol_registry()
+    validated_buys = []
+
+    for buy, limit_price in zip(market_buys, limit_prices):
+        trading_pair = buy["symbol"] + purchasing_currency
+
+        if (quantizer := registry.quantizer(trading_pair)) is None:
+            log.warning("dropping buy, unknown trading pair", trading_pair=trading_pair)
+            continue
+
+        amount = quantizer.amount(buy["amount"])
+        price = limit_price if limit_price is not None else price_book.last_price(trading_pair)
+
+        if price is None:
+            # without a price only the amount can be checked
+            if amount < quantizer.min_notional:
+                log.info("dropping buy, below minimum notional", trading_pair=trading_pair, amount=buy["amount"])
+                continue
+
+            validated_buys.append((MarketBuy(symbol=buy["symbol"], amount=money.from_units(amount, quantizer.price_decimals)), None))
+            continue
+
+        price_units = quantizer.price(price)
+
+        if not quantizer.valid_price(price_units):
+            log.info("dropping buy, price outside of the price filter", trading_pair=trading_pair, price=price)
+            continue
+
+        quantity = quantizer.quantity_for(amount, price_units)
+
+        if (largest_quantity := quantizer.largest_quantity()) is not None and quantity > largest_quantity:
+            log.info("resizing buy to the maximum quantity", trading_pair=trading_pair, amount=buy["amount"], price=price)
+            quantity = largest_quantity
+            amount = quantity * price_units // 10 ** quantizer.quantity_decimals
+
+        if not quantizer.valid_quantity(quantity) or not quantizer.valid_notional(quantity, price_units):
+            log.info("dropping buy, below minimum quantity or notional", trading_pair=trading_pair, amount=buy["amount"], price=price)
+            continue
+
+        if limit_price is None:
+            # a market buy spends its amount, the exchange decides the quantity
+            validated_buys.append((MarketBuy(symbol=buy["symbol"], amount=money.from_units(amount, quantizer.price_decimals)), None))
+        else:
+            # the quantity of a limit buy is calculated from its amount and price (see `make_market_buy`), so the amount is
+            # exactly the cost of the rounded quantity at the rounded price
+            cost = money.from_units(quantity * price_units, quantizer.quantity_decimals + quantizer.price_decimals)
+            validated_buys.append((MarketBuy(symbol=buy["symbol"], amount=cost), money.from_units(price_units, quantizer.price_decimals)))
 
-    return format(Decimal(amount), f"0.{rounding_precision}f")
+    return validated_buys
 
 
 def binance_market_sell(user: User, symbol: str, purchasing_currency: str, amount: Decimal) -> ExchangeOrder:
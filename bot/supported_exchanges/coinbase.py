@@ -1,11 +1,85 @@
 # https://docs.pro.coinbase.com/#client-libraries
-import coinbasepro as cbpro
+import functools
+import typing as t
+from decimal import Decimal
 
-coinbase_public_client = cbpro.PublicClient()
-coinbase_exchange = coinbase_public_client.get_products()
+from decouple import config
+
+from .. import caching, tracing
+from ..data_types import CryptoBalance
+from ..user import User
+
+# new listings are rare
+PRODUCTS_CACHE_TIMEOUT = 60 * 60 * 6
+
+CLIENT_POOL_MAX_SIZE = config("COINBASE_CLIENT_POOL_MAX_SIZE", default=256, cast=int)
+CLIENT_POOL_TIMEOUT = config("COINBASE_CLIENT_POOL_TIMEOUT", default=60 * 60, cast=int)
+
+
+class CoinbaseClientPool(caching.ClientPool):
+    "clients are reused across `User` instances with the same credentials, like the binance client pool"
+
+    def create_client(self, *credentials: str):
+        import coinbasepro as cbpro
+
+        api_key, secret_key, passphrase = credentials
+        client = cbpro.AuthenticatedClient(api_key, secret_key, passphrase)
+        tracing.trace_session(client.session)
+        return client
+
+
+coinbase_client_pool = CoinbaseClientPool(max_size=CLIENT_POOL_MAX_SIZE, timeout=CLIENT_POOL_TIMEOUT)
+
+
+@functools.cache
+def coinbase_public_client():
+    import coinbasepro as cbpro
+
+    client = cbpro.PublicClient()
+    tracing.trace_session(client.session)
+    return client
+
+
+def coinbase_authenticated_client(api_key: str, secret_key: str, passphrase: str):
+    return coinbase_client_pool.client(api_key, secret_key, passphrase)
+
+
+def coinbase_portfolio(user: User) -> t.List[CryptoBalance]:
+    """
+    [{'id': '7d0f7d8e-dd34-4d9c-a846-06f431c381ba', 'currency': 'BTC', 'balance': Decimal('0.0000000000000000'),
+      'hold': Decimal('0.0000000000000000'), 'available': Decimal('0.0000000000000000'), 'profile_id': '...', 'trading_enabled': True}]
+    """
+
+    return [
+        CryptoBalance(
+            symbol=account["currency"],
+            # `available` excludes holds for open orders, which matches binance's `free` balance
+            amount=Decimal(str(account["available"])),
+            usd_price=Decimal(0),
+            usd_total=Decimal(0),
+            percentage=Decimal(0),
+            target_percentage=Decimal(0),
+        )
+        for account in user.coinbase_client().get_accounts()
+        if Decimal(str(account["available"])) > 0
+    ]
+
+
+def coinbase_trading_pairs() -> t.FrozenSet[t.Tuple[str, str]]:
+    """
+    (base_currency, quote_currency) of every product on coinbase.
+
+    The product catalogue is loaded on first use, not on import, so processes that never touch coinbase never
+    pay for the request.
+    """
+
+    return caching.cached_result(
+        "coinbase_trading_pairs",
+        lambda: frozenset((product["base_currency"], product["quote_currency"]) for product in coinbase_public_client().get_products()),
+        timeout=PRODUCTS_CACHE_TIMEOUT,
+        stale_timeout=60 * 60,
+    )
 
 
 def can_buy_in_coinbase(symbol, purchasing_currency):
-    for coin in coinbase_exchange:
-        if coin["base_currency"] == symbol and coin["quote_currency"] == purchasing_currency:
-            return True
+    return (symbol, purchasing_currency) in coinbase_trading_pairs()
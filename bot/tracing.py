@@ -0,0 +1,130 @@
+import contextlib
+import contextvars
+import threading
+import time
+import typing as t
+
+from . import caching
+from .utils import log
+
+# binance reports the weight used by the IP in the current minute on every response
+# https://binance-docs.github.io/apidocs/spot/en/#limits
+USED_WEIGHT_HEADERS = ("x-mbx-used-weight-1m", "x-mbx-used-weight")
+
+
+class Span:
+    """
+    Timing and API usage for a single stage of a run. Outbound HTTP calls made while the span is active are attributed
+    to it and all of its parents. Cache hits/misses are the change in the process-wide `caching.cache_statistics`.
+    """
+
+    def __init__(self, name: str, parent: t.Optional["Span"] = None):
+        self.name = name
+        self.parent = parent
+        self.children: t.List["Span"] = []
+
+        self.started_at = time.time()
+        self.duration: t.Optional[float] = None
+        self.http_calls = 0
+        # the last used weight reported by binance while the span was active
+        self.used_weight: t.Optional[int] = None
+        self.cache: t.Dict[str, int] = {}
+        # anything else worth recording about the stage, i.e. why a run was skipped
+        self.tags: t.Dict[str, t.Any] = {}
+
+        self._started = time.perf_counter()
+        self._cache_statistics = caching.cache_statistics()
+        # HTTP calls can be made from multiple threads, i.e. when submitting orders concurrently
+        self._lock = threading.Lock()
+
+    def record_response(self, response):
+        used_weight = next((int(response.headers[header]) for header in USED_WEIGHT_HEADERS if header in response.headers), None)
+
+        span: t.Optional[Span] = self
+
+        while span:
+            with span._lock:
+                span.http_calls += 1
+
+                if used_weight is not None:
+                    span.used_weight = used_weight
+
+            span = span.parent
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+
+        cache_statistics = caching.cache_statistics()
+        self.cache = {
+            key: count - self._cache_statistics.get(key, 0) for key, count in cache_statistics.items() if count != self._cache_statistics.get(key, 0)
+        }
+
+    def as_dict(self) -> t.Dict[str, t.Any]:
+        return {
+            "name": self.name,
+            "duration": self.duration,
+            "http_calls": self.http_calls,
+            "used_weight": self.used_weight,
+            "cache": self.cache,
+            "tags": self.tags,
+        }
+
+    def summary(self) -> t.Dict[str, t.Any]:
+        "this span and all of its children as a JSON-serializable dict, i.e. to store the results of a run"
+
+        return self.as_dict() | {"started_at": self.started_at, "spans": [child.summary() for child in self.children]}
+
+
+_current_span: contextvars.ContextVar[t.Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+@contextlib.contextmanager
+def span(name: str) -> t.Iterator[Span]:
+    """
+    Record a stage of a run. Spans nest: a span opened while another is active is added to its children.
+    Every span is logged when it finishes.
+    """
+
+    parent = _current_span.get()
+    current = Span(name, parent)
+
+    if parent:
+        parent.children.append(current)
+
+    token = _current_span.set(current)
+
+    try:
+        yield current
+    finally:
+        _current_span.reset(token)
+        current.finish()
+
+        log.info(
+            "span",
+            span=name,
+            duration=current.duration,
+            http_calls=current.http_calls,
+            used_weight=current.used_weight,
+            cache=current.cache,
+            **current.tags,
+        )
+
+
+def current_span() -> t.Optional[Span]:
+    return _current_span.get()
+
+
+def record_response(response, *args, **kwargs):
+    "`requests` response hook, attributes the request to the active span"
+
+    if current := _current_span.get():
+        current.record_response(response)
+
+    return response
+
+
+def trace_session(session):
+    "add the tracing hook to a `requests.Session`"
+
+    session.hooks["response"].append(record_response)
+    return session
@@ -1,5 +1,4 @@
 import decimal
-import functools
 import typing as t
 
 from .data_types import (
@@ -22,6 +21,14 @@ def user_from_env():
     user.binance_api_key = t.cast(str, config("USER_BINANCE_API_KEY"))
     user.binance_secret_key = t.cast(str, config("USER_BINANCE_SECRET_KEY"))
 
+    user.coinbase_api_key = t.cast(str, config("USER_COINBASE_API_KEY", default=""))
+    user.coinbase_secret_key = t.cast(str, config("USER_COINBASE_SECRET_KEY", default=""))
+    user.coinbase_passphrase = t.cast(str, config("USER_COINBASE_PASSPHRASE", default=""))
+
+    # i.e. `binance,coinbase`
+    if exchanges := t.cast(str, config("USER_EXCHANGES", default="")):
+        user.exchanges = [SupportedExchanges(exchange.strip()) for exchange in exchanges.split(",")]
+
     user.livemode = t.cast(str, config("USER_LIVEMODE", "false")).lower() == "true"
     user.convert_stablecoins = t.cast(str, config("USER_CONVERT_STABLECOINS", "false")).lower() == "true"
     user.cancel_stale_orders = t.cast(str, config("USER_CANCEL_STALE_ORDERS", "false")).lower() == "true"
@@ -46,6 +53,9 @@ class User:
     buy_strategy: MarketBuyStrategy = MarketBuyStrategy.MARKET
     binance_api_key: t.Optional[str] = ""
     binance_secret_key: t.Optional[str] = ""
+    coinbase_api_key: t.Optional[str] = ""
+    coinbase_secret_key: t.Optional[str] = ""
+    coinbase_passphrase: t.Optional[str] = ""
     external_portfolio: t.List[CryptoBalance] = []
     convert_stablecoins: bool = True
     index_limit: t.Optional[int] = None
@@ -63,10 +73,25 @@ class User:
     def __init__(self):
         pass
 
-    @functools.cache
     def binance_client(self):
-        from binance.client import Client
+        # clients are pooled across `User` instances, each celery task creates a new user
+        from .supported_exchanges.binance import binance_client_pool
 
         # TODO error check for empty keys?
 
-        return Client(self.binance_api_key, self.binance_secret_key, tld="us")
+        return binance_client_pool.client(self.binance_api_key or "", self.binance_secret_key or "")
+
+    def has_exchange_credentials(self, exchange: SupportedExchanges) -> bool:
+        if exchange == SupportedExchanges.COINBASE:
+            return bool(self.coinbase_api_key and self.coinbase_secret_key and self.coinbase_passphrase)
+
+        # buys are only made on binance, missing binance keys are reported by the exchange
+        return True
+
+    def coinbase_client(self):
+        from .supported_exchanges.coinbase import coinbase_authenticated_client
+
+        # users without credentials are skipped before any coinbase calls are made, see `has_exchange_credentials`
+        assert self.coinbase_api_key and self.coinbase_secret_key and self.coinbase_passphrase, "missing coinbase credentials"
+
+        return coinbase_authenticated_client(self.coinbase_api_key, self.coinbase_secret_key, self.coinbase_passphrase)
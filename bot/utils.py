@@ -29,30 +29,36 @@ setLevel(log_level)
 
 log = structlog.get_logger()
 
-_cached_result = {}
+T = t.TypeVar("T")
+R = t.TypeVar("R")
 
 
-def cached_result(key: str, func: t.Callable):
-    if in_django_environment():
-        from django.core.cache import cache
+def concurrent_map(func: t.Callable[[T], R], items: t.Iterable[T], max_workers: int) -> t.List[R]:
+    """
+    Map `func` over `items` using a bounded thread pool and return the results in the original order.
 
-        if cached_value := cache.get(key):
-            return cached_value
+    The logging context is thread-local, so the caller's bound context (i.e. `user_id`) is copied into each thread.
+    Context variables (i.e. the active tracing span) are copied as well.
+    """
 
-        # use a 30m timeout by default for now
-        value = func()
-        cache.set(key, value, timeout=60 * 30)
-        return value
-    else:
-        # if no django, then setup a simple dict-based cache to avoid
-        # hitting the APIs too many times within a single process
-        global _cached_result
-        if key in _cached_result:
-            return _cached_result[key]
-
-        value = func()
-        _cached_result[key] = value
-        return value
+    import contextvars
+    from concurrent.futures import ThreadPoolExecutor
+
+    items = list(items)
+
+    if not items:
+        return []
+
+    logging_context = structlog.get_context(log.bind()).copy()
+    context = contextvars.copy_context()
+
+    def func_with_logging_context(item: T) -> R:
+        log.bind(**logging_context)
+        # a context can only be entered by a single thread at a time, so each item gets its own copy
+        return context.copy().run(func, item)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func_with_logging_context, items))
 
 
 def in_django_environment():
@@ -0,0 +1,175 @@
+import threading
+import time
+import typing as t
+
+from decouple import config
+
+from .tracing import USED_WEIGHT_HEADERS
+from .utils import in_django_environment, log
+
+# https://binance-docs.github.io/apidocs/spot/en/#limits
+REQUEST_WEIGHT_PER_MINUTE = config("BINANCE_REQUEST_WEIGHT_PER_MINUTE", default=1200, cast=int)
+
+# the bucket refills at this fraction of the exchange limit and allows a burst of `WEIGHT_BURST` of the limit on top.
+# Together they stay below the limit in any one minute window, leaving room for requests made outside of the bot
+WEIGHT_REFILL_RATE = config("BINANCE_WEIGHT_REFILL_RATE", default=0.8, cast=float)
+WEIGHT_BURST = config("BINANCE_WEIGHT_BURST", default=0.1, cast=float)
+
+# binance reports the weight used by the IP in the current minute, once it's this close to the limit wait for the next minute
+USED_WEIGHT_MARGIN = config("BINANCE_USED_WEIGHT_MARGIN", default=0.05, cast=float)
+
+# 429 is returned when the limit is exceeded, 418 once the IP has been banned for repeatedly exceeding it
+RATE_LIMITED_STATUS_CODES = (418, 429)
+
+REDIS_BUCKET_KEY = "binance_request_weight"
+
+
+class TokenBucket(t.NamedTuple):
+    tokens: float
+    updated_at: float
+    # no requests are made until this time, i.e. after a 429
+    blocked_until: float
+
+
+def _refill(bucket: TokenBucket, now: float, capacity: float, rate: float) -> TokenBucket:
+    elapsed = max(now - bucket.updated_at, 0)
+    return bucket._replace(tokens=min(capacity, bucket.tokens + elapsed * rate), updated_at=now)
+
+
+class LocalBucketStore:
+    "token bucket for a single process"
+
+    def __init__(self):
+        self._bucket: t.Optional[TokenBucket] = None
+        self._lock = threading.Lock()
+
+    def update(self, func: t.Callable[[t.Optional[TokenBucket], float], t.Tuple[TokenBucket, t.Any]]) -> t.Any:
+        with self._lock:
+            self._bucket, result = func(self._bucket, time.time())
+            return result
+
+
+class RedisBucketStore:
+    """
+    Token bucket shared by every process using the same redis, i.e. all celery workers. Updates are optimistic
+    transactions (WATCH/MULTI) so concurrent workers never spend the same tokens. Redis' clock is used so workers with
+    skewed clocks agree on how much the bucket has refilled.
+    """
+
+    def __init__(self, redis_client, key: str = REDIS_BUCKET_KEY):
+        self.redis_client = redis_client
+        self.key = key
+
+    def update(self, func: t.Callable[[t.Optional[TokenBucket], float], t.Tuple[TokenBucket, t.Any]]) -> t.Any:
+        result = None
+
+        def transaction(pipe):
+            nonlocal result
+
+            seconds, microseconds = pipe.time()
+            now = seconds + microseconds / 1_000_000
+
+            values = pipe.hmget(self.key, "tokens", "updated_at", "blocked_until")
+            bucket = TokenBucket(*(float(value) for value in values)) if None not in values else None
+
+            bucket, result = func(bucket, now)
+
+            pipe.multi()
+            pipe.hset(self.key, mapping=bucket._asdict())
+            # an idle bucket is full, there is no need to keep it around
+            pipe.expire(self.key, 2 * 60)
+
+        self.redis_client.transaction(transaction, self.key)
+        return result
+
+
+class RequestWeightLimiter:
+    """
+    Token bucket of request weight. `acquire` blocks until the weight of a request is available. Responses are fed back
+    through `record_response` (a `requests` response hook), so the bucket follows the weight the exchange reports as used
+    and stops all requests when the exchange rate limits us.
+    """
+
+    def __init__(self, store: t.Optional[t.Union[LocalBucketStore, RedisBucketStore]] = None, weight_per_minute: int = REQUEST_WEIGHT_PER_MINUTE):
+        self._store = store
+        self.weight_per_minute = weight_per_minute
+        self.rate = weight_per_minute * WEIGHT_REFILL_RATE / 60
+        self.capacity = weight_per_minute * WEIGHT_BURST
+
+    @property
+    def store(self) -> t.Union[LocalBucketStore, RedisBucketStore]:
+        # resolved on first use: django (and redis) may not be configured yet when this module is imported
+        if self._store is None:
+            self._store = _default_store()
+
+        return self._store
+
+    def _bucket(self, bucket: t.Optional[TokenBucket], now: float) -> TokenBucket:
+        if bucket is None:
+            return TokenBucket(tokens=self.capacity, updated_at=now, blocked_until=0)
+
+        return _refill(bucket, now, self.capacity, self.rate)
+
+    def acquire(self, weight: int):
+        def take(bucket: t.Optional[TokenBucket], now: float) -> t.Tuple[TokenBucket, float]:
+            bucket = self._bucket(bucket, now)
+
+            if now < bucket.blocked_until:
+                return bucket, bucket.blocked_until - now
+
+            # a request heavier than the burst size has to wait for a full bucket
+            needed = min(weight, self.capacity)
+
+            if bucket.tokens >= needed:
+                return bucket._replace(tokens=bucket.tokens - weight), 0
+
+            return bucket, (needed - bucket.tokens) / self.rate
+
+        while (wait := self.store.update(take)) > 0:
+            log.info("request weight limit reached, waiting", weight=weight, wait=wait)
+            time.sleep(wait)
+
+    def record_used_weight(self, used_weight: int):
+        "the weight the exchange reports as used in the current minute"
+
+        remaining = self.weight_per_minute - used_weight
+
+        def observe(bucket: t.Optional[TokenBucket], now: float) -> t.Tuple[TokenBucket, None]:
+            bucket = self._bucket(bucket, now)
+
+            # other processes (or anything else sharing the IP) used more than we accounted for
+            bucket = bucket._replace(tokens=min(bucket.tokens, remaining))
+
+            if remaining <= self.weight_per_minute * USED_WEIGHT_MARGIN:
+                # the exchange's window resets at the start of every minute
+                bucket = bucket._replace(blocked_until=max(bucket.blocked_until, now - now % 60 + 60))
+
+            return bucket, None
+
+        self.store.update(observe)
+
+    def block(self, seconds: float):
+        def block_until(bucket: t.Optional[TokenBucket], now: float) -> t.Tuple[TokenBucket, None]:
+            bucket = self._bucket(bucket, now)
+            return bucket._replace(tokens=0, blocked_until=max(bucket.blocked_until, now + seconds)), None
+
+        self.store.update(block_until)
+
+    def record_response(self, response, *args, **kwargs):
+        if response.status_code in RATE_LIMITED_STATUS_CODES:
+            retry_after = int(response.headers.get("retry-after", 60))
+            log.error("rate limited by the exchange", status_code=response.status_code, retry_after=retry_after)
+            self.block(retry_after)
+        elif used_weight := next((response.headers[header] for header in USED_WEIGHT_HEADERS if header in response.headers), None):
+            self.record_used_weight(int(used_weight))
+
+        return response
+
+
+def _default_store() -> t.Union[LocalBucketStore, RedisBucketStore]:
+    if in_django_environment():
+        from django_redis import get_redis_connection
+
+        return RedisBucketStore(get_redis_connection("default"))
+    else:
+        return LocalBucketStore()
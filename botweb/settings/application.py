@@ -34,6 +34,9 @@ ALLOWED_HOSTS = []
 FIELD_ENCRYPTION_KEY = config("DJANGO_FIELD_ENCRYPTION_KEY")
 
 CELERY_BROKER_URL = config("REDIS_URL")
+# redis redelivers a task which hasn't been acknowledged within the visibility timeout (1 hour by default). User buys are
+# delayed by up to an hour (`users.tasks.USER_BUY_INTERVAL`), a shorter timeout would run them twice
+CELERY_BROKER_TRANSPORT_OPTIONS = {"visibility_timeout": config("CELERY_VISIBILITY_TIMEOUT", default=4 * 60 * 60, cast=int)}
 
 # Application definition
 
@@ -22,7 +22,7 @@ def cli(verbose):
 def analyze():
     import bot.exchanges as exchanges
 
-    coinbase_available_coins = set([coin["base_currency"] for coin in exchanges.coinbase_exchange])
+    coinbase_available_coins = set([base_currency for base_currency, _ in exchanges.coinbase_trading_pairs()])
     binance_available_coins = set([coin["baseAsset"] for coin in exchanges.binance_all_symbol_info()])
 
     print("Available, regardless of purchasing currency:")
@@ -32,7 +32,7 @@ def analyze():
     user = user_from_env()
 
     coinbase_available_coins_in_purchasing_currency = set(
-        [coin["base_currency"] for coin in exchanges.coinbase_exchange if coin["quote_currency"] == user.purchasing_currency]
+        [base_currency for base_currency, quote_currency in exchanges.coinbase_trading_pairs() if quote_currency == user.purchasing_currency]
     )
     binance_available_coins_in_purchasing_currency = set(
         [coin["baseAsset"] for coin in exchanges.binance_all_symbol_info() if coin["quoteAsset"] == user.purchasing_currency]
@@ -88,11 +88,18 @@ def index(format, limit, strategy):
 )
 def portfolio(format):
     from bot.commands import PortfolioCommand
+    from bot.market_snapshot import warm_market_snapshot
 
     user = user_from_env()
-    portfolio = PortfolioCommand.execute(user)
+    portfolio = PortfolioCommand.execute(user, market_snapshot=warm_market_snapshot([user]))
 
-    click.echo(utils.table_output_with_format(portfolio, format))
+    # the per-exchange breakdown is a dict, display it as a single column
+    rows = [
+        balance | {"exchanges": ", ".join(f"{exchange}: {amount}" for exchange, amount in balance.get("exchanges", {}).items())}  # type: ignore
+        for balance in portfolio
+    ]
+
+    click.echo(utils.table_output_with_format(rows, format))
 
     import bot.market_buy
 
@@ -144,6 +151,7 @@ def buy(format, dry_run, purchase_balance, convert, cancel_orders):
     from decimal import Decimal
 
     from bot.commands import BuyCommand
+    from bot.market_snapshot import warm_market_snapshot
 
     if purchase_balance:
         purchase_balance = Decimal(purchase_balance)
@@ -170,7 +178,9 @@ def buy(format, dry_run, purchase_balance, convert, cancel_orders):
         user.cancel_stale_orders = False
         user.livemode = False
 
-    purchase_balance, market_buys, completed_orders = BuyCommand.execute(user, purchase_balance)
+    # market data is reused from the last run if it's recent enough, see `MARKET_SNAPSHOT_TTL`
+    # it's only loaded if there is something to buy
+    purchase_balance, market_buys, completed_orders = BuyCommand.execute(user, purchase_balance, market_snapshot=lambda: warm_market_snapshot([user]))
 
     click.secho(f"Purchasing Balance: {utils.currency_format(purchase_balance)}", fg="green")
 
@@ -183,5 +193,37 @@ def buy(format, dry_run, purchase_balance, convert, cancel_orders):
         click.secho(f"\nSuccessfully purchased: {purchased_token_list}", fg="green")
 
 
+@cli.command(help="Replay historical coinmarketcap snapshots and klines through the buy algorithm")
+@click.option(
+    "--coinmarketcap-snapshots",
+    required=True,
+    type=click.Path(exists=True, file_okay=False),
+    help="Directory of coinmarketcap listings responses",
+)
+@click.option("--klines", type=click.Path(exists=True, file_okay=False), help="Kline store directory, defaults to KLINES_DIRECTORY")
+@click.option("--deposit", type=float, default=100, show_default=True, help="Purchasing currency deposited at every step")
+@click.option("--interval", type=click.Choice(["1h", "4h", "1d"]), default="1h", show_default=True, help="Step interval")
+def backtest(coinmarketcap_snapshots, klines, deposit, interval):
+    from decimal import Decimal
+
+    import bot.backtest
+    import bot.klines
+
+    user = user_from_env()
+    store = bot.klines.KlineStore(klines) if klines else bot.klines.KlineStore()
+    snapshots = bot.backtest.load_coinmarketcap_snapshots(coinmarketcap_snapshots)
+
+    result = bot.backtest.Backtest(user, snapshots, store, deposit_amount=Decimal(str(deposit)), interval=interval).run()
+
+    click.echo(utils.table_output_with_format(result.portfolio, "md"))
+
+    click.echo(f"\nSteps: {result.steps} ({result.steps / result.elapsed:.0f}/s)")
+    click.echo(f"Orders: {result.order_count}")
+    click.echo(f"Deposited: {utils.currency_format(result.total_deposited)}")
+    click.echo(f"Final Value: {utils.currency_format(result.final_value)}")
+    click.echo(f"Tracking Error: {result.tracking_error:.2%}")
+    click.echo(f"Allocation Drift: {result.allocation_drift:.2%}")
+
+
 if __name__ == "__main__":
     cli()
@@ -43,17 +43,32 @@ def clear_functools_cache():
 
 # https://stackoverflow.com/questions/22627659/run-code-before-and-after-each-test-in-py-test
 @pytest.fixture(autouse=True)
-def clear_state():
+def clear_state(tmp_path, monkeypatch):
     clear_functools_cache()
 
+    # market snapshots written to disk by one test must not be picked up by another
+    import bot.market_snapshot
+
+    monkeypatch.setattr(bot.market_snapshot, "MARKET_SNAPSHOT_PATH", str(tmp_path / "market_snapshot.bin"))
+
     # clear redis cache
     from django.core.cache import cache
 
     cache.clear()
 
-    import bot.utils
+    import bot.caching
+
+    bot.caching.clear_cached_results()
+
+    # pooled connections are created inside of a test's VCR context, they can't be reused across tests
+    import bot.exchanges
+
+    bot.exchanges.binance_client_pool.clear()
+    bot.exchanges.coinbase_client_pool.clear()
+
+    import bot.price_book
 
-    bot.utils._cached_result = {}
+    bot.price_book.price_book.clear()
 
     yield
 
@@ -0,0 +1,97 @@
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from bot import market_buy, open_orders
+from bot.account_snapshot import AccountSnapshot
+from bot.data_types import (
+    ExchangeOrder,
+    OrderTimeInForce,
+    OrderType,
+    SupportedExchanges,
+)
+from bot.user import User
+
+STALE_ORDER = ExchangeOrder(
+    symbol="ADA",
+    trading_pair="ADAUSD",
+    quantity=Decimal("5"),
+    price=Decimal("2"),
+    created_at=1631457393,
+    time_in_force=OrderTimeInForce("GTC"),
+    type=OrderType("BUY"),
+    id="259074455",
+    exchange=SupportedExchanges.BINANCE,
+)
+
+USD_BALANCE = {"symbol": "USD", "amount": Decimal("100")}
+
+
+class TestAccountSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.user = User()
+        self.user.livemode = True
+
+    @patch("bot.exchanges.cancel_order", side_effect=lambda exchange, user, order: order)
+    @patch("bot.exchanges.portfolio", return_value=[USD_BALANCE])
+    @patch("bot.exchanges.open_orders", return_value=[STALE_ORDER])
+    def test_open_orders_loaded_once_per_run(self, open_orders_mock, portfolio_mock, _cancel_order_mock):
+        account = AccountSnapshot(self.user, SupportedExchanges.BINANCE)
+
+        cancelled_orders = open_orders.cancel_stale_open_orders(self.user, SupportedExchanges.BINANCE, account)
+        assert cancelled_orders == [STALE_ORDER]
+
+        # the cancelled order is removed locally and no longer blocks a purchase of the same coin
+        assert account.open_orders() == []
+        assert account.portfolio()[0]["amount"] == Decimal("100")
+
+        assert open_orders_mock.call_count == 1
+        assert portfolio_mock.call_count == 1
+
+    @patch("bot.exchanges.portfolio", return_value=[USD_BALANCE])
+    @patch("bot.exchanges.open_orders", return_value=[STALE_ORDER])
+    def test_cancelled_order_frees_purchasing_currency(self, _open_orders_mock, _portfolio_mock):
+        account = AccountSnapshot(self.user, SupportedExchanges.BINANCE)
+        account.portfolio()
+
+        account.record_cancelled_order(STALE_ORDER)
+
+        assert account.portfolio()[0]["amount"] == Decimal("110")
+
+    @patch("bot.exchanges.validate_buys", side_effect=lambda exchange, purchasing_currency, buys, prices: list(zip(buys, prices)))
+    @patch("bot.exchanges.market_buy", side_effect=lambda **kwargs: STALE_ORDER | {"symbol": kwargs["symbol"], "price": "0.0000"})
+    @patch("bot.exchanges.portfolio", return_value=[USD_BALANCE])
+    @patch("bot.exchanges.open_orders", return_value=[])
+    def test_placed_orders_applied_locally(self, open_orders_mock, portfolio_mock, _market_buy_mock, _validate_buys_mock):
+        account = AccountSnapshot(self.user, SupportedExchanges.BINANCE)
+        account.portfolio()
+        account.open_orders()
+
+        market_buy.make_market_buys(self.user, [{"symbol": "BTC", "amount": Decimal("30")}], account)
+
+        # market orders fill immediately, so they are never added to the open orders
+        assert account.open_orders() == []
+        assert account.portfolio()[0]["amount"] == Decimal("70")
+
+        account.record_placed_order(STALE_ORDER, Decimal("10"))
+        assert account.open_orders() == [STALE_ORDER]
+        assert account.portfolio()[0]["amount"] == Decimal("60")
+
+        assert open_orders_mock.call_count == 1
+        assert portfolio_mock.call_count == 1
+
+        account.invalidate()
+        account.portfolio()
+        assert portfolio_mock.call_count == 2
+
+    @patch("bot.exchanges.portfolio", return_value=[USD_BALANCE])
+    def test_testmode_does_not_change_account(self, _portfolio_mock):
+        self.user.livemode = False
+
+        account = AccountSnapshot(self.user, SupportedExchanges.BINANCE)
+        account.portfolio()
+
+        account.record_placed_order(STALE_ORDER, Decimal("10"))
+        account.record_cancelled_order(STALE_ORDER)
+
+        assert account.portfolio() == [USD_BALANCE]
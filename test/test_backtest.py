@@ -0,0 +1,121 @@
+import datetime
+import json
+import os
+import tempfile
+import time
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from bot import backtest, caching, exchanges
+from bot.data_types import MarketIndexStrategy
+from bot.klines import INTERVAL_MILLISECONDS, KlineStore
+from bot.user import User
+
+HOUR = INTERVAL_MILLISECONDS["1h"]
+START = 1632787200000  # 2021-09-28 00:00 UTC
+
+# symbol => (starting price, hourly change, market cap)
+COINS = {
+    "BTC": (40000.0, 0.001, 800_000_000_000),
+    "ETH": (3000.0, 0.002, 350_000_000_000),
+    "ADA": (2.0, -0.001, 70_000_000_000),
+}
+
+
+def coinmarketcap_snapshot(timestamp: int, coins=COINS):
+    return {
+        "status": {"timestamp": datetime.datetime.utcfromtimestamp(timestamp / 1000).isoformat() + ".000Z"},
+        "data": [
+            {
+                "symbol": symbol,
+                "tags": [],
+                "quote": {"USD": {"price": price, "market_cap": market_cap, "percent_change_7d": 0.0, "percent_change_30d": change * 100}},
+            }
+            for symbol, (price, change, market_cap) in coins.items()
+        ],
+    }
+
+
+class TestBacktest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = KlineStore(os.path.join(self.directory.name, "klines"))
+        self.snapshot_directory = os.path.join(self.directory.name, "coinmarketcap")
+
+        for symbol, (price, change, _) in COINS.items():
+            self.store.append(
+                symbol + "USD",
+                "1h",
+                [[START + hour * HOUR, price, price, price, price * (1 + change) ** hour, 1.0] for hour in range(48)],
+            )
+
+        os.makedirs(self.snapshot_directory)
+
+        for day in range(2):
+            timestamp = START + day * 24 * HOUR
+
+            with open(os.path.join(self.snapshot_directory, f"{timestamp}.json"), "w") as f:
+                json.dump(coinmarketcap_snapshot(timestamp), f)
+
+        self.user = User()
+        self.user.deprioritized_coins = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @patch("bot.exchanges.public_binance_client", side_effect=AssertionError("backtests should not hit the exchange"))
+    def test_replays_hourly_deposits(self, _client_mock):
+        snapshots = backtest.load_coinmarketcap_snapshots(self.snapshot_directory)
+        assert [snapshot.timestamp for snapshot in snapshots] == [START, START + 24 * HOUR]
+
+        exchange_symbol_registry = exchanges.SymbolRegistry([])
+        caching.prime("binance_symbol_registry", exchange_symbol_registry, time.time() + 60)
+
+        result = backtest.Backtest(self.user, snapshots, self.store, deposit_amount=Decimal(100)).run()
+
+        # the simulated symbols are not used outside of the backtest
+        assert exchanges.binance_symbol_registry() is exchange_symbol_registry
+
+        assert result.steps == 48
+        assert result.total_deposited == Decimal(4800)
+        assert result.order_count > 0
+
+        held_symbols = {balance["symbol"] for balance in result.portfolio}
+        assert set(COINS) <= held_symbols
+
+        assert result.final_value == sum(balance["usd_total"] for balance in result.portfolio)
+        assert 0 <= result.allocation_drift <= 1
+        assert result.tracking_error > 0
+
+    def test_value_is_conserved_without_fees_or_price_changes(self):
+        store = KlineStore(os.path.join(self.directory.name, "flat_klines"))
+
+        for symbol, (price, _, _) in COINS.items():
+            store.append(symbol + "USD", "1h", [[START + hour * HOUR, price, price, price, price, 1.0] for hour in range(24)])
+
+        snapshots = backtest.load_coinmarketcap_snapshots(self.snapshot_directory)
+        result = backtest.Backtest(self.user, snapshots, store, deposit_amount=Decimal(100), fee=Decimal(0)).run()
+
+        assert result.steps == 24
+        assert abs(result.final_value - result.total_deposited) < Decimal("0.000001")
+        assert result.tracking_error == 0
+
+    def test_pairs_without_candles_are_skipped(self):
+        import numpy as np
+
+        from bot.klines import KLINE_COLUMNS
+
+        # i.e. a new listing, or an update which was interrupted before any candles were stored
+        self.store.save("DOGEUSD", "1h", np.empty((len(KLINE_COLUMNS), 0)))
+
+        snapshots = backtest.load_coinmarketcap_snapshots(self.snapshot_directory)
+        result = backtest.Backtest(self.user, snapshots, self.store, deposit_amount=Decimal(100)).run()
+
+        assert result.steps == 48
+
+    def test_sma_strategy_is_not_supported(self):
+        self.user.index_strategy = MarketIndexStrategy.SMA
+
+        with self.assertRaises(ValueError):
+            backtest.Backtest(self.user, backtest.load_coinmarketcap_snapshots(self.snapshot_directory), self.store, deposit_amount=Decimal(100))
@@ -1,5 +1,7 @@
 import unittest
+from unittest.mock import patch
 
+import binance.client
 import pytest
 
 import bot.exchanges as exchanges
@@ -14,3 +16,98 @@ class TestBinance(unittest.TestCase):
             symbol_info_directly = exchanges.public_binance_client().get_symbol_info(target_trading_pair)
 
             assert symbol_info_from_batch == symbol_info_directly
+
+
+class TestSymbolRegistry(unittest.TestCase):
+    SYMBOL_INFO = {
+        "symbol": "ADAUSD",
+        "status": "TRADING",
+        "baseAsset": "ADA",
+        "quoteAsset": "USD",
+        "quoteAssetPrecision": 4,
+        "filters": [
+            {"filterType": "PRICE_FILTER", "minPrice": "0.00010000", "maxPrice": "1000.00000000", "tickSize": "0.00010000"},
+            {"filterType": "LOT_SIZE", "minQty": "0.10000000", "maxQty": "9000000.00000000", "stepSize": "0.10000000"},
+            {"filterType": "MIN_NOTIONAL", "minNotional": "10.00000000", "applyToMarket": True, "avgPriceMins": 5},
+        ],
+    }
+
+    def test_lookups_and_parsed_filters(self):
+        from decimal import Decimal
+
+        registry = exchanges.SymbolRegistry([self.SYMBOL_INFO])
+
+        assert registry.get("ADAUSD") == self.SYMBOL_INFO
+        assert registry.get_by_assets("ADA", "USD") == self.SYMBOL_INFO
+        assert registry.get("BTCUSD") is None
+        assert registry.get_by_assets("ADA", "USDT") is None
+
+        filters = registry.filters("ADAUSD")
+        assert filters.step_size == Decimal("0.1")
+        assert filters.tick_size == Decimal("0.0001")
+        assert filters.min_notional == Decimal("10")
+        assert filters.quote_asset_precision == 4
+
+    def test_validate_buys(self):
+        from decimal import Decimal
+
+        registry = exchanges.SymbolRegistry([self.SYMBOL_INFO])
+
+        quantizer = registry.quantizer("ADAUSD")
+        assert quantizer.price_decimals == 4
+        assert quantizer.quantity_decimals == 1
+        assert quantizer.price(Decimal("2.123456")) == 21234
+
+        with patch("bot.supported_exchanges.binance.binance_symbol_registry", return_value=registry), patch(
+            "bot.supported_exchanges.binance.price_book.last_price", return_value=Decimal("2")
+        ):
+            validated_buys = exchanges.binance_validate_buys(
+                "USD",
+                [
+                    {"symbol": "ADA", "amount": Decimal("25.123456")},
+                    # below MIN_NOTIONAL
+                    {"symbol": "ADA", "amount": Decimal("5")},
+                    {"symbol": "BTC", "amount": Decimal("25")},
+                    {"symbol": "ADA", "amount": Decimal("25")},
+                ],
+                [None, None, None, Decimal("2.123456")],
+            )
+
+        # market buys keep their amount, limit buys are rounded to a whole step at a whole tick
+        assert validated_buys == [
+            ({"symbol": "ADA", "amount": Decimal("25.1234")}, None),
+            ({"symbol": "ADA", "amount": Decimal("24.84378")}, Decimal("2.1234")),
+        ]
+
+        # the limit order quantity is calculated from the amount and price, see `make_market_buy`
+        assert Decimal("24.84378") / Decimal("2.1234") == Decimal("11.7")
+
+        # without a streamed price, market buys are only checked against the minimum notional, the tickers aren't fetched
+        with patch("bot.supported_exchanges.binance.binance_symbol_registry", return_value=registry), patch(
+            "bot.supported_exchanges.binance.price_book.last_price", return_value=None
+        ), patch("bot.supported_exchanges.binance.binance_all_prices", side_effect=AssertionError("tickers should not be fetched")):
+            validated_buys = exchanges.binance_validate_buys(
+                "USD",
+                [{"symbol": "ADA", "amount": Decimal("25.123456")}, {"symbol": "ADA", "amount": Decimal("5")}],
+                [None, None],
+            )
+
+        assert validated_buys == [({"symbol": "ADA", "amount": Decimal("25.1234")}, None)]
+
+
+class TestBinanceClientPool(unittest.TestCase):
+    @patch.object(binance.client.Client, "ping", side_effect=AssertionError("clients should not ping on creation"))
+    def test_clients_are_pooled_by_credentials(self, _ping_mock):
+        pool = exchanges.BinanceClientPool(max_size=2)
+
+        client = pool.client("key-1", "secret-1")
+        assert pool.client("key-1", "secret-1") is client
+        assert pool.client("key-1", "secret-2") is not client
+
+        # connections are shared, credentials are not
+        other_client = pool.client("key-2", "secret-2")
+        assert other_client.session is not client.session
+        assert other_client.session.get_adapter("https://api.binance.us") is client.session.get_adapter("https://api.binance.us")
+
+        # least recently used client is evicted
+        assert pool.client("key-1", "secret-1") is not client
@@ -107,3 +107,46 @@ class TestBuyCommand(unittest.TestCase):
 
     def test_not_buying_open_orders(self):
         pass
+
+
+class TestBuySkip(unittest.TestCase):
+    @patch("bot.market_cap.coins_with_market_cap")
+    @patch("bot.exchanges.portfolio")
+    def test_skips_without_loading_market_data(self, portfolio_mock, coins_with_market_cap_mock):
+        import bot.tracing
+        from bot.data_types import CryptoBalance
+
+        def balance(symbol, amount):
+            return CryptoBalance(
+                symbol=symbol,
+                amount=Decimal(amount),
+                usd_price=Decimal(0),
+                usd_total=Decimal(0),
+                percentage=Decimal(0),
+                target_percentage=Decimal(0),
+            )
+
+        user = user_from_env()
+        user.external_portfolio = []
+        user.buy_strategy = MarketBuyStrategy.MARKET
+        user.convert_stablecoins = True
+
+        market_snapshot_loader = unittest.mock.Mock()
+
+        portfolio_mock.return_value = [balance("USD", "5"), balance("USDC", "3"), balance("BTC", "1")]
+
+        with bot.tracing.span("test") as test_span:
+            purchase_balance, market_buys, completed_orders = BuyCommand.execute(user=user, market_snapshot=market_snapshot_loader)
+
+        assert purchase_balance == Decimal(4)
+        assert market_buys == completed_orders == []
+        assert test_span.children[0].tags == {"skip_reason": "below_purchase_minimum"}
+
+        market_snapshot_loader.assert_not_called()
+        coins_with_market_cap_mock.assert_not_called()
+
+        # a stablecoin balance which can be converted is enough to continue
+        from bot import market_buy
+
+        assert market_buy.buy_skip_reason(user, [balance("USDC", "50")]) is None
+        assert market_buy.buy_skip_reason(user, [balance("BTC", "1")]) == "no_purchasing_currency"
@@ -0,0 +1,72 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import bot.caching as caching
+
+
+@patch("bot.caching.in_django_environment", return_value=False)
+class TestCaching(unittest.TestCase):
+    def test_single_flight_refresh(self, _django_mock):
+        calls = []
+
+        def slow_fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return len(calls)
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(caching.cached_result("single_flight_key", slow_fetch, timeout=60))) for _ in range(5)
+        ]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [1] * 5
+        assert len(calls) == 1
+
+    def test_expiration_and_stale_values(self, _django_mock):
+        assert caching.cached_result("key", lambda: 1, timeout=0, stale_timeout=60) == 1
+
+        # another worker is refreshing the key, so the stale value is served
+        assert caching._local_cache.acquire_lock("key")
+        assert caching.cached_result("key", lambda: 2, timeout=0, stale_timeout=60) == 1
+        caching._local_cache.release_lock("key")
+
+        assert caching.cached_result("key", lambda: 3, timeout=60) == 3
+        assert caching.cache_statistics()["stale_hit"] == 1
+
+    def test_lru_eviction(self, _django_mock):
+        local_cache = caching.LocalCache(max_size=2)
+        entry = caching.CacheEntry(value=1, version="1", fresh_until=time.time() + 60, stale_until=time.time() + 60)
+
+        local_cache.set("a", entry)
+        local_cache.set("b", entry)
+        local_cache.get("a")
+        local_cache.set("c", entry)
+
+        assert local_cache.get("b") is None
+        assert local_cache.get("a") is not None
+        assert local_cache.get("c") is not None
+
+
+class TestClientPool(unittest.TestCase):
+    def test_clients_are_pooled_by_credential_fingerprint(self):
+        from bot.supported_exchanges.coinbase import CoinbaseClientPool
+
+        pool = CoinbaseClientPool(max_size=2, timeout=60)
+
+        client = pool.client("key", "secret", "passphrase")
+        assert pool.client("key", "secret", "passphrase") is client
+        assert pool.client("key", "secret", "other-passphrase") is not client
+
+        # secrets are never used as keys
+        assert not any("secret" in key for key in pool._clients._entries)
+
+        # expired clients are recreated
+        with patch("time.time", return_value=time.time() + 120):
+            assert pool.client("key", "secret", "passphrase") is not client
@@ -35,17 +35,19 @@ class TestCLI(unittest.TestCase):
         assert result.exit_code == 0
 
         # 60 should be split into two orders
+        # orders are submitted concurrently, so the order of the calls is not deterministic
         assert order_market_buy_mock.call_count == 2
+        submitted_orders = sorted((mock_call.kwargs for mock_call in order_market_buy_mock.mock_calls), key=lambda order: order["symbol"])
         assert {
             "symbol": "ADAUSD",
             "newOrderRespType": "FULL",
             "quoteOrderQty": "10.0000",
-        } == order_market_buy_mock.mock_calls[0].kwargs
+        } == submitted_orders[0]
         assert {
             "symbol": "SOLUSD",
             "newOrderRespType": "FULL",
             "quoteOrderQty": "10.0000",
-        } == order_market_buy_mock.mock_calls[1].kwargs
+        } == submitted_orders[1]
 
     def test_portfolio(self):
         runner = CliRunner()
@@ -64,9 +66,12 @@ class TestCLI(unittest.TestCase):
         self.assertIsNone(result.exception)
         assert result.exit_code == 0
 
-    def test_analyze(self):
+    # the coinbase product catalogue was loaded on import when this cassette was recorded, so it isn't in the cassette
+    @patch("bot.exchanges.coinbase_trading_pairs", return_value=frozenset([("BTC", "USD"), ("ETH", "USD"), ("ETH", "BTC")]))
+    def test_analyze(self, _coinbase_trading_pairs_mock):
         runner = CliRunner()
         result = runner.invoke(main.analyze, [])
 
         self.assertIsNone(result.exception)
         assert result.exit_code == 0
+        assert "coinbase:\t2" in result.output
@@ -0,0 +1,90 @@
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from bot.klines import INTERVAL_MILLISECONDS, KlineStore
+
+
+class FakeKlinesClient:
+    "returns a candle for every hour in the requested range, closing at the candle index"
+
+    def __init__(self, now_milliseconds: int):
+        self.now_milliseconds = now_milliseconds
+        self.requests = []
+
+    def get_klines(self, symbol, interval, startTime, limit):
+        self.requests.append(startTime)
+        interval_milliseconds = INTERVAL_MILLISECONDS[interval]
+        first_open_time = startTime - startTime % interval_milliseconds
+
+        return [
+            [open_time, "1", "1", "1", str(open_time // interval_milliseconds), "1", open_time + interval_milliseconds - 1]
+            for open_time in range(first_open_time, self.now_milliseconds, interval_milliseconds)
+        ][:limit]
+
+
+class TestKlineStore(unittest.TestCase):
+    def test_incremental_update(self):
+        store = KlineStore(tempfile.mkdtemp())
+        client = FakeKlinesClient(int(time.time() * 1000))
+
+        candles = store.update(client, "BTCUSD", "1h", window=24)
+        candle_count = candles.shape[1]
+        assert candle_count >= 24
+
+        # the latest candle is already stored, nothing to fetch
+        store.update(client, "BTCUSD", "1h", window=24)
+        assert len(client.requests) == 1
+
+        # an hour later, only the previous (incomplete) candle and the new one are requested
+        client.now_milliseconds += INTERVAL_MILLISECONDS["1h"]
+
+        with patch("time.time", return_value=client.now_milliseconds / 1000):
+            updated_candles = store.update(client, "BTCUSD", "1h", window=24)
+
+        assert client.requests[-1] == int(candles[0, -1])
+        assert updated_candles.shape[1] == candle_count + 1
+        assert len(np.unique(updated_candles[0])) == candle_count + 1
+
+    def test_simple_moving_averages(self):
+        store = KlineStore(tempfile.mkdtemp())
+        store.append("BTCUSD", "1d", [[day, "0", "0", "0", str(day), "0"] for day in range(10)])
+        store.append("ETHUSD", "1d", [[day, "0", "0", "0", "2", "0"] for day in range(2)])
+
+        moving_averages = store.simple_moving_averages(["BTCUSD", "ETHUSD", "ADAUSD"], "1d", window=4)
+
+        assert moving_averages[0] == np.mean([6, 7, 8, 9])
+        assert moving_averages[1] == 2
+        assert np.isnan(moving_averages[2])
+
+
+class TestSmaMarketCaps(unittest.TestCase):
+    def test_buyable_coins_are_updated(self):
+        from bot import market_cap
+        from bot.market_cap import CoinMarketCapListings
+
+        store = KlineStore(tempfile.mkdtemp())
+        client = FakeKlinesClient(int(time.time() * 1000))
+
+        coins = CoinMarketCapListings.from_response(
+            {
+                "data": [
+                    {"symbol": symbol, "cmc_rank": rank, "tags": [], "quote": {"USD": {"price": 2.0, "market_cap": 100.0}}}
+                    for rank, symbol in enumerate(["BTC", "ETH", "ADA"], start=1)
+                ]
+            }
+        )
+
+        with patch("bot.market_cap.klines.KlineStore", return_value=store), patch(
+            "bot.exchanges.can_buy_in_binance", side_effect=lambda symbol, purchasing_currency: symbol != "ADA"
+        ), patch("bot.exchanges.public_binance_client", return_value=client):
+            market_caps = market_cap.sma_market_caps("USD", coins, coins.market_caps)
+
+        # candles are only requested for coins which can be bought, the others keep their current market cap
+        assert store.trading_pairs(market_cap.SMA_INTERVAL) == ["BTCUSD", "ETHUSD"]
+        assert len(client.requests) == 2
+        assert market_caps[2] == 100.0
+        assert market_caps[0] == market_caps[1] != 100.0
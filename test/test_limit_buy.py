@@ -0,0 +1,144 @@
+import tempfile
+import time
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+import numpy as np
+
+from bot import limit_buy
+from bot.klines import INTERVAL_MILLISECONDS, KlineStore
+from bot.user import User
+
+ORDER_BOOK = {
+    "lastUpdateId": 1027024,
+    "bids": [["99.00", "1.0"], ["98.00", "2.0"]],
+    "asks": [["100.00", "1.0"], ["101.00", "1.0"], ["110.00", "10.0"]],
+}
+
+
+class FakeMarketClient:
+    "hourly candles whose lows step down from 100 to 77 with a volume of 100, and a fixed order book"
+
+    def __init__(self):
+        self.order_book_requests = []
+
+    def get_order_book(self, symbol, limit):
+        self.order_book_requests.append(symbol)
+        return ORDER_BOOK
+
+    def get_klines(self, symbol, interval, startTime, limit):
+        interval_milliseconds = INTERVAL_MILLISECONDS[interval]
+        now_milliseconds = int(time.time() * 1000)
+        open_times = range(
+            now_milliseconds - now_milliseconds % interval_milliseconds - 23 * interval_milliseconds, now_milliseconds, interval_milliseconds
+        )
+
+        return [[open_time, "100", "100", str(100 - hour), "100", "100"] for hour, open_time in enumerate(open_times)][:limit]
+
+
+class TestOrderBook(unittest.TestCase):
+    def test_vwap_and_slippage(self):
+        order_book = limit_buy.OrderBook(ORDER_BOOK)
+
+        assert order_book.best_ask == 100
+        assert order_book.best_bid == 99
+        assert list(order_book.ask_quote_depth) == [100, 201, 1301]
+
+        # filled entirely at the best ask
+        assert order_book.vwap(50) == 100
+        assert order_book.slippage(50) == 0
+
+        # 1 @ 100, 1 @ 101 and 0.9 @ 110
+        assert abs(order_book.vwap(300) - 300 / 2.9) < 1e-9
+        assert order_book.slippage(300) > 0.03
+
+        # deeper than the book
+        assert order_book.vwap(5000) is None
+        assert order_book.slippage(5000) is None
+
+    def test_bid_depth_ahead(self):
+        order_book = limit_buy.OrderBook(ORDER_BOOK)
+
+        # above the best bid, at each level and below the fetched levels
+        assert list(order_book.bid_depth_ahead(np.array([99.5, 99.0, 98.5, 98.0, 90.0]))) == [0, 1, 1, 3, 3]
+
+        empty_order_book = limit_buy.OrderBook({"bids": [], "asks": []})
+        assert empty_order_book.best_ask is None
+        assert empty_order_book.best_bid is None
+
+
+class TestFillModel(unittest.TestCase):
+    def test_choose_limit_prices(self):
+        lows = np.array(
+            [
+                [95.0, 90.0, 98.0, 97.0],
+                # a pair without any candles is priced at the best bid
+                [np.nan, np.nan, np.nan, np.nan],
+            ]
+        )
+
+        prices, probabilities = limit_buy.fill_probabilities(lows, order_hours=1)
+
+        assert list(prices[0]) == [90.0, 95.0, 97.0, 98.0]
+        assert list(probabilities[0]) == [0.25, 0.5, 0.75, 1.0]
+        assert np.isnan(probabilities[1]).all()
+
+        limit_prices, limit_probabilities = limit_buy.choose_limit_prices(prices, probabilities, np.array([99.0, 99.0]), fill_probability=0.5)
+        assert list(limit_prices) == [95.0, 99.0]
+        assert list(limit_probabilities) == [0.5, 1.0]
+
+        # the order stays open longer, so a lower price is expected to fill
+        prices, probabilities = limit_buy.fill_probabilities(lows, order_hours=24)
+        limit_prices, _ = limit_buy.choose_limit_prices(prices, probabilities, np.array([99.0, 99.0]), fill_probability=0.5)
+        assert limit_prices[0] == 90.0
+
+        # prices never cross the spread
+        limit_prices, _ = limit_buy.choose_limit_prices(prices, probabilities, np.array([80.0, 80.0]), fill_probability=0.5)
+        assert list(limit_prices) == [80.0, 80.0]
+
+    def test_queue_reduces_fill_probability(self):
+        lows = np.array([[95.0, 90.0, 98.0, 97.0]])
+        order_book = limit_buy.OrderBook({"bids": [["98.00", "10.0"], ["96.00", "10.0"]], "asks": []})
+        prices = limit_buy.candidate_prices(lows)
+
+        # 10 is bid ahead of 97 and 98, and 20 ahead of 90 and 95. The buy itself is 1 at 90
+        queue = limit_buy.queue_hours([order_book], prices, np.array([90.0]), np.array([[10.0, 10.0, np.nan, 10.0]]))
+        assert np.allclose(queue[0], [(20 + 1) / 10, (20 + 90 / 95) / 10, (10 + 90 / 97) / 10, (10 + 90 / 98) / 10])
+
+        _, probabilities = limit_buy.fill_probabilities(lows, order_hours=3)
+        _, queued_probabilities = limit_buy.fill_probabilities(lows, order_hours=3, queue_hours=queue)
+        # a price reached in every candle still fills
+        assert (queued_probabilities[0, :3] < probabilities[0, :3]).all()
+        assert queued_probabilities[0, 3] == probabilities[0, 3] == 1
+
+        # the order is cancelled before the bids ahead of it are filled
+        _, queued_probabilities = limit_buy.fill_probabilities(lows, order_hours=2, queue_hours=queue)
+        assert list(queued_probabilities[0, :2]) == [0.0, 0.0]
+
+        # without volume history the queue can't be estimated
+        queue = limit_buy.queue_hours([order_book], prices, np.array([90.0]), np.full((1, 4), np.nan))
+        assert list(queue[0]) == [0, 0, 0, 0]
+
+
+class TestLimitPricer(unittest.TestCase):
+    def test_price_batch(self):
+        client = FakeMarketClient()
+        user = User()
+        user.stale_order_hour_limit = 1
+
+        with patch.object(User, "binance_client", return_value=client):
+            pricer = limit_buy.LimitPricer(user, fill_probability=0.5, store=KlineStore(tempfile.mkdtemp()))
+            limit_prices = pricer.price_batch([{"symbol": "BTC", "amount": Decimal(50)}, {"symbol": "ETH", "amount": Decimal(300)}])
+
+            # the order book is cached for the run
+            pricer.price("BTC", Decimal(20))
+
+        assert sorted(client.order_book_requests) == ["BTCUSD", "ETHUSD"]
+
+        # half of the last 24 candles reached a low of 88, but the order would rest behind the bids at 99 and 98
+        # for part of the hour, so 88 is just short of a 50% chance of filling
+        assert [limit_price.price for limit_price in limit_prices] == [Decimal("89.0"), Decimal("89.0")]
+        assert 0.5 <= limit_prices[0].fill_probability < 0.55
+        assert limit_prices[0].vwap == 100
+        assert limit_prices[1].slippage > 0.03
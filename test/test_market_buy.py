@@ -0,0 +1,74 @@
+import time
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from bot import market_buy
+from bot.data_types import MarketBuyStrategy
+from bot.user import User
+
+
+class TestMakeMarketBuys(unittest.TestCase):
+    def test_results_in_original_order(self):
+        user = User()
+        user.buy_strategy = MarketBuyStrategy.MARKET
+
+        market_buys = [{"symbol": symbol, "amount": Decimal(10)} for symbol in ["BTC", "ETH", "ADA", "SOL"]]
+
+        # earlier buys take longer to submit than later buys
+        def slow_market_buy(exchange, user, symbol, purchasing_currency, amount):
+            time.sleep({"BTC": 0.3, "ETH": 0.2, "ADA": 0.1}.get(symbol, 0))
+            return None if symbol == "ADA" else {"symbol": symbol}
+
+        with patch("bot.exchanges.market_buy", side_effect=slow_market_buy) as market_buy_mock, patch(
+            "bot.exchanges.validate_buys", side_effect=lambda exchange, purchasing_currency, buys, prices: list(zip(buys, prices))
+        ):
+            orders = market_buy.make_market_buys(user, market_buys)
+
+        assert market_buy_mock.call_count == 4
+        # failed and test mode orders are dropped
+        assert [order["symbol"] for order in orders] == ["BTC", "ETH", "SOL"]
+
+
+class TestDetermineMarketBuys(unittest.TestCase):
+    @patch("bot.exchanges.open_orders", return_value=[])
+    @patch("bot.exchanges.can_buy_amount_in_exchange", return_value=True)
+    @patch("bot.exchanges.purchasing_currency_decimals", return_value=4)
+    def test_amounts_are_rounded_to_the_purchasing_currency(self, _decimals_mock, _can_buy_mock, _open_orders_mock):
+        user = User()
+        target_portfolio = [
+            {"symbol": "BTC", "percentage": Decimal("33.33333333"), "market_cap": Decimal(0), "change_7d": 0, "change_30d": 0},
+            {"symbol": "ETH", "percentage": Decimal("66.66666667"), "market_cap": Decimal(0), "change_7d": 0, "change_30d": 0},
+        ]
+        current_portfolio = [{"symbol": "USD", "usd_total": Decimal("15.123456")}, {"symbol": "ETH", "usd_total": Decimal("75")}]
+
+        # less than two minimum purchases are available, so the entire balance is spent on the first coin
+        market_buys = market_buy.determine_market_buys(user, target_portfolio, current_portfolio, target_portfolio, Decimal("15.123456"))
+
+        assert market_buys == [{"symbol": "BTC", "amount": Decimal("15.1234")}]
+
+
+class TestCalculateMarketBuyPreferences(unittest.TestCase):
+    def test_duplicate_symbols_keep_their_order(self):
+        target_index = [
+            {"symbol": "BTC", "percentage": Decimal(40), "market_cap": Decimal(1), "change_7d": 0, "change_30d": -5},
+            {"symbol": "ETH", "percentage": Decimal(20), "market_cap": Decimal(0), "change_7d": 0, "change_30d": -10},
+            {"symbol": "BTC", "percentage": Decimal(40), "market_cap": Decimal(2), "change_7d": 0, "change_30d": -5},
+            {"symbol": "ADA", "percentage": Decimal(5), "market_cap": Decimal(0), "change_7d": 0, "change_30d": -10},
+        ]
+
+        # the first balance of a duplicated symbol is used, the second would put BTC over its target
+        current_portfolio = [
+            {"symbol": "BTC", "percentage": Decimal(10)},
+            {"symbol": "BTC", "percentage": Decimal(50)},
+        ]
+
+        sorted_buys = market_buy.calculate_market_buy_preferences(target_index, current_portfolio, deprioritized_coins=[])
+
+        # duplicated coins tie on every criteria and stay in the order of the target index
+        assert [(coin["symbol"], coin["market_cap"]) for coin in sorted_buys] == [
+            ("ETH", Decimal(0)),
+            ("ADA", Decimal(0)),
+            ("BTC", Decimal(1)),
+            ("BTC", Decimal(2)),
+        ]
@@ -0,0 +1,67 @@
+import json
+import pickle
+import unittest
+
+from bot.market_cap import CoinMarketCapListings
+
+LISTINGS_RESPONSE = {
+    "status": {"timestamp": "2021-09-28T20:34:07.000Z", "error_code": 0},
+    "data": [
+        {
+            "id": 1,
+            "name": "Bitcoin",
+            "symbol": "BTC",
+            "cmc_rank": 1,
+            "tags": ["mineable", "pow"],
+            "platform": None,
+            "circulating_supply": 18830000,
+            "quote": {
+                "USD": {"price": 43210.12, "volume_24h": 1e10, "market_cap": 812345678901.5, "percent_change_7d": 1.5, "percent_change_30d": -3.25}
+            },
+        },
+        {
+            "id": 825,
+            "name": "Tether",
+            "symbol": "USDT",
+            "cmc_rank": 2,
+            "tags": ["stablecoin"],
+            "platform": {"id": 1027, "name": "Ethereum", "symbol": "ETH", "token_address": "0xdac17f958d2ee523a2206206994597c13d831ec7"},
+            "quote": {"USD": {"price": 1.0001, "market_cap": 68000000000, "percent_change_7d": None, "percent_change_30d": 0.01}},
+        },
+    ],
+}
+
+
+class TestCoinMarketCapListings(unittest.TestCase):
+    def test_projection_from_raw_response(self):
+        listings = CoinMarketCapListings.from_json(json.dumps(LISTINGS_RESPONSE))
+
+        assert len(listings) == 2
+        assert listings.timestamp == "2021-09-28T20:34:07.000Z"
+        assert listings.symbols == ["BTC", "USDT"]
+        assert listings.row("USDT") == 1
+        assert listings.row("ETH") is None
+
+        # only the projected fields are kept, missing values are zero
+        assert listings.coin(1) == {
+            "symbol": "USDT",
+            "tags": ["stablecoin"],
+            "cmc_rank": 2,
+            "quote": {"USD": {"price": 1.0001, "market_cap": 68000000000.0, "percent_change_7d": 0.0, "percent_change_30d": 0.01}},
+        }
+
+        # decoded responses project to the same table
+        assert CoinMarketCapListings.from_response(LISTINGS_RESPONSE) == listings
+        assert CoinMarketCapListings.from_response(listings.as_response()) == listings
+
+    def test_take_and_pickle(self):
+        listings = CoinMarketCapListings.from_response(LISTINGS_RESPONSE)
+
+        subset = listings.take([1])
+        assert subset.symbols == ["USDT"]
+        assert list(subset.market_caps) == [68000000000.0]
+        assert subset.row("BTC") is None
+
+        unpickled = pickle.loads(pickle.dumps(listings))
+        assert unpickled == listings
+        assert unpickled.row("BTC") == 0
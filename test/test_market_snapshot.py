@@ -0,0 +1,108 @@
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+import bot.market_snapshot as market_snapshot
+from bot.market_cap import CoinMarketCapListings
+from bot.user import User
+
+COINMARKETCAP_DATA = CoinMarketCapListings.from_response(
+    {"data": [{"symbol": "BTC", "quote": {"USD": {"price": Decimal("43210.12"), "market_cap": Decimal("812345678901")}}}]}
+)
+PRICES = {"BTCUSD": Decimal("43210.12")}
+
+
+@patch("bot.market_cap.coins_with_market_cap", return_value=[{"symbol": "BTC", "percentage": Decimal(100)}])
+@patch("bot.market_cap.coinmarketcap_data", return_value=COINMARKETCAP_DATA)
+@patch("bot.exchanges.binance_all_prices", return_value=PRICES)
+@patch("bot.exchanges.binance_symbol_registry", return_value=None)
+class TestMarketSnapshotFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "market_snapshot.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self, *_mocks):
+        snapshot = market_snapshot.build_market_snapshot([User()])
+        market_snapshot.write_market_snapshot(snapshot, self.path)
+
+        loaded_snapshot = market_snapshot.read_market_snapshot(self.path, ttl=60)
+
+        assert loaded_snapshot.created_at == snapshot.created_at
+        assert loaded_snapshot.coinmarketcap_data == COINMARKETCAP_DATA
+        assert loaded_snapshot.prices == PRICES
+        assert loaded_snapshot.target_indexes == snapshot.target_indexes
+
+    def test_expired_and_invalid_snapshots_are_ignored(self, *_mocks):
+        assert market_snapshot.read_market_snapshot(self.path, ttl=60) is None
+
+        snapshot = market_snapshot.MarketSnapshot()
+        snapshot.created_at -= 120
+        market_snapshot.write_market_snapshot(snapshot, self.path)
+
+        assert market_snapshot.read_market_snapshot(self.path, ttl=60) is None
+        assert market_snapshot.read_market_snapshot(self.path, ttl=0) is None
+
+        with patch("bot.market_snapshot.MARKET_SNAPSHOT_VERSION", market_snapshot.MARKET_SNAPSHOT_VERSION + 1):
+            assert market_snapshot.read_market_snapshot(self.path, ttl=600) is None
+
+        with open(self.path, "wb") as f:
+            f.write(b"CIFB")
+
+        assert market_snapshot.read_market_snapshot(self.path, ttl=600) is None
+
+        open(self.path, "wb").close()
+        assert market_snapshot.read_market_snapshot(self.path, ttl=600) is None
+
+    def test_snapshots_writable_by_other_users_are_ignored(self, *_mocks):
+        snapshot = market_snapshot.build_market_snapshot([User()])
+        market_snapshot.write_market_snapshot(snapshot, self.path)
+        assert market_snapshot.read_market_snapshot(self.path, ttl=60) is not None
+
+        # a snapshot is a pickle, anyone who can replace it can run code in the bot
+        os.chmod(self.path, 0o666)
+        assert market_snapshot.read_market_snapshot(self.path, ttl=60) is None
+
+        os.chmod(self.path, 0o600)
+        os.chmod(self.directory.name, 0o777)
+        assert market_snapshot.read_market_snapshot(self.path, ttl=60) is None
+
+        os.remove(self.path)
+        market_snapshot.write_market_snapshot(snapshot, self.path)
+        assert not os.path.exists(self.path)
+
+    def test_warm_start(self, _registry_mock, _prices_mock, coinmarketcap_mock, coins_with_market_cap_mock):
+        market_snapshot.warm_market_snapshot([User()], self.path)
+        assert coinmarketcap_mock.call_count == 1
+        assert coins_with_market_cap_mock.call_count == 1
+
+        # the second process loads market data and the target index from disk
+        market_snapshot.warm_market_snapshot([User()], self.path)
+        assert coinmarketcap_mock.call_count == 1
+        assert coins_with_market_cap_mock.call_count == 1
+
+        # a user with different index preferences is added to the snapshot on disk
+        user = User()
+        user.index_limit = 10
+
+        market_snapshot.warm_market_snapshot([user], self.path)
+        assert coins_with_market_cap_mock.call_count == 2
+        assert len(market_snapshot.read_market_snapshot(self.path).target_indexes) == 2
+
+    @patch("bot.portfolio.exchange_portfolio", return_value=[])
+    def test_portfolio_command_installs_snapshot(self, _exchange_portfolio_mock, *_mocks):
+        from bot.commands import PortfolioCommand
+
+        market_snapshot.warm_market_snapshot([User()], self.path)
+        loaded_snapshot = market_snapshot.read_market_snapshot(self.path)
+
+        with patch.object(market_snapshot.MarketSnapshot, "install", autospec=True) as install_mock:
+            user_portfolio = PortfolioCommand.execute(User(), market_snapshot=loaded_snapshot)
+
+        # the target index is already in the snapshot, market data must still be served from it
+        install_mock.assert_called_once_with(loaded_snapshot)
+        assert [balance["symbol"] for balance in user_portfolio] == ["BTC"]
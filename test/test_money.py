@@ -0,0 +1,34 @@
+import unittest
+from decimal import Decimal
+
+from bot import money
+
+
+class TestMoney(unittest.TestCase):
+    def test_conversions_round_down_once(self):
+        assert money.to_units(Decimal("12.345678"), 4) == 123456
+        assert money.to_units("12.345678", 4) == 123456
+        assert money.to_units("0.01000000", 8) == 1000000
+        assert money.to_units("-1.5", 2) == -150
+        assert money.to_units("1E-5", 8) == 1000
+        assert money.to_units(10, 4) == 100000
+        assert money.to_units(0.1, 4) == 1000
+
+        assert money.from_units(123456, 4) == Decimal("12.3456")
+        assert str(money.from_units(100000, 4)) == "10.0000"
+
+    def test_exchange_strings(self):
+        assert money.format_units(123456, 4) == "12.3456"
+        assert money.format_units(5, 8) == "0.00000005"
+        assert money.format_units(-150, 2) == "-1.50"
+        assert money.format_units(42, 0) == "42"
+
+        assert money.decimals_for_step(Decimal("0.00100000")) == 3
+        assert money.decimals_for_step(Decimal("1.00000000")) == 0
+        assert money.decimals_for_step(Decimal(0)) == money.DEFAULT_DECIMALS
+
+    def test_share_of(self):
+        percentage = money.to_units(Decimal("33.33333333"), money.PERCENTAGE_DECIMALS)
+
+        assert percentage == 3333333333
+        assert money.share_of(900000, percentage) == 299999
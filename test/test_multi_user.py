@@ -5,6 +5,7 @@ import pytest
 
 import bot.commands
 import users.tasks
+from bot.market_cap import CoinMarketCapListings
 from users.models import User
 
 # Specifying `@pytest.mark.usefixtures('celery_session_worker')` causes issues with database cleaning
@@ -12,8 +13,9 @@ from users.models import User
 
 @pytest.mark.django_db
 class TestMultiUser(unittest.TestCase):
+    @patch("users.tasks.store_market_snapshot", return_value=None)
     @patch.object(bot.commands.BuyCommand, "execute")
-    def test_performs_market_buy(self, buy_command_mock):
+    def test_performs_market_buy(self, buy_command_mock, _market_snapshot_mock):
         user_1 = User.objects.create(name="user 1")
         user_2 = User.objects.create(name="user 2")
 
@@ -21,6 +23,128 @@ class TestMultiUser(unittest.TestCase):
 
         assert buy_command_mock.call_count == 2
 
+        # both users were checked, running the scheduler again doesn't buy for them twice
+        assert User.objects.filter(date_checked__isnull=False).count() == 2
+
+        users.tasks.initiate_user_buys.delay()
+        assert buy_command_mock.call_count == 2
+
+    def test_user_buys_are_spread_across_the_hour(self):
+        import datetime
+
+        import django.utils.timezone
+
+        now = django.utils.timezone.now()
+        scheduled_users = [User(id=user_id) for user_id in range(1, 101)]
+        schedule = users.tasks.schedule_user_buys(scheduled_users, now)
+
+        offsets = sorted((scheduled_at - now).total_seconds() for _, scheduled_at in schedule)
+        assert len(offsets) == 100
+        assert offsets[-1] < users.tasks.USER_BUY_INTERVAL
+        # no more than a handful of users land in the same minute
+        assert max(sum(1 for offset in offsets if minute * 60 <= offset < (minute + 1) * 60) for minute in range(60)) < 10
+
+        # a user's slot is stable across runs
+        assert users.tasks.user_buy_offset(1) == users.tasks.user_buy_offset(1)
+
+        # recently checked users are skipped
+        scheduled_users[0].date_checked = now
+        assert len(users.tasks.schedule_user_buys(scheduled_users, now)) == 99
+
+        # as are users which are already scheduled by an overlapping run
+        scheduled_users[1].date_scheduled = now + datetime.timedelta(minutes=30)
+        assert len(users.tasks.schedule_user_buys(scheduled_users, now)) == 98
+
+        # a buy which was scheduled, but never finished, is scheduled again in the next run
+        assert len(users.tasks.schedule_user_buys(scheduled_users, now + datetime.timedelta(seconds=users.tasks.USER_BUY_INTERVAL))) == 100
+
+    @patch("users.tasks.store_market_snapshot", return_value=None)
+    @patch.object(bot.commands.BuyCommand, "execute", side_effect=RuntimeError("exchange unavailable"))
+    def test_failed_buy_is_not_checked(self, _buy_command_mock, _market_snapshot_mock):
+        user = User.objects.create(name="user 1")
+
+        with pytest.raises(RuntimeError):
+            users.tasks.initiate_user_buys.delay()
+
+        user.refresh_from_db()
+        assert user.date_scheduled is not None
+        assert user.date_checked is None
+
+    def test_user_buy_slots(self):
+        from django_redis import get_redis_connection
+
+        redis_client = get_redis_connection("default")
+        slot_key, token = users.tasks.acquire_user_buy_slot(1)
+
+        # the buy outlived the slot timeout and another buy took the slot
+        redis_client.set(slot_key, "2:token")
+        users.tasks.release_user_buy_slot(slot_key, token)
+        assert redis_client.get(slot_key) == b"2:token"
+
+        users.tasks.release_user_buy_slot(slot_key, "2:token")
+        assert redis_client.get(slot_key) is None
+
+    @patch("users.tasks._user_buy")
+    @patch("users.tasks.acquire_user_buy_slot", return_value=None)
+    def test_user_buy_retries_are_limited(self, _acquire_slot_mock, user_buy_mock):
+        from celery.exceptions import Retry
+
+        with pytest.raises(Retry):
+            users.tasks.user_buy.apply((1,))
+
+        # the last attempt gives up instead of retrying again
+        result = users.tasks.user_buy.apply((1,), retries=users.tasks.USER_BUY_MAX_RETRIES)
+        assert result.successful()
+
+        user_buy_mock.assert_not_called()
+
+    @patch("bot.market_cap.coins_with_market_cap", return_value=[])
+    @patch("bot.market_cap.coinmarketcap_data", return_value=CoinMarketCapListings.from_response({"data": []}))
+    @patch("bot.exchanges.binance_all_prices", return_value={})
+    @patch("bot.exchanges.binance_symbol_registry", return_value=None)
+    def test_market_snapshot_shared_across_users(self, _registry_mock, _prices_mock, _coinmarketcap_mock, coins_with_market_cap_mock):
+        from bot.market_snapshot import build_market_snapshot
+
+        user_1 = User.objects.create(name="user 1")
+        user_2 = User.objects.create(name="user 2")
+        user_3 = User.objects.create(name="user 3", preferences={"index_strategy": "sqrt_market_cap"})
+
+        market_snapshot = build_market_snapshot([user.bot_user() for user in [user_1, user_2, user_3]])
+
+        # users with identical index preferences share a single target index
+        assert len(market_snapshot.target_indexes) == 2
+        assert coins_with_market_cap_mock.call_count == 2
+
+    @patch("bot.market_cap.coins_with_market_cap", return_value=[])
+    @patch("bot.market_cap.coinmarketcap_data", return_value=CoinMarketCapListings.from_response({"data": []}))
+    @patch("bot.exchanges.binance_all_prices", return_value={})
+    @patch("bot.exchanges.binance_symbol_registry", return_value=None)
+    def test_expired_market_snapshot_is_rebuilt(self, _registry_mock, _prices_mock, _coinmarketcap_mock, coins_with_market_cap_mock):
+        from django.core.cache import cache
+
+        from bot.market_snapshot import MARKET_SNAPSHOT_MAX_AGE, build_market_snapshot
+
+        bot_user = User.objects.create(name="user 1").bot_user()
+        market_snapshot_key = "market_snapshot:test"
+
+        market_snapshot = build_market_snapshot([bot_user])
+        cache.set(market_snapshot_key, market_snapshot)
+
+        loaded_snapshot = users.tasks.load_market_snapshot(market_snapshot_key, bot_user)
+        assert loaded_snapshot.created_at == market_snapshot.created_at
+        assert coins_with_market_cap_mock.call_count == 1
+
+        # a user late in the run gets a fresh snapshot, which replaces the expired one for other workers
+        for expired_snapshot in [market_snapshot, loaded_snapshot]:
+            expired_snapshot.created_at -= MARKET_SNAPSHOT_MAX_AGE + 1
+        cache.set(market_snapshot_key, market_snapshot)
+
+        rebuilt_snapshot = users.tasks.load_market_snapshot(market_snapshot_key, bot_user)
+
+        assert not rebuilt_snapshot.expired()
+        assert coins_with_market_cap_mock.call_count == 2
+        assert cache.get(market_snapshot_key).created_at == rebuilt_snapshot.created_at
+
     def test_external_portfolio(self):
         from decimal import Decimal
 
@@ -0,0 +1,93 @@
+import threading
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from bot import portfolio
+from bot.data_types import CryptoBalance, CryptoData, SupportedExchanges
+from bot.user import User
+
+
+def balance(symbol: str, amount: str) -> CryptoBalance:
+    return CryptoBalance(
+        symbol=symbol,
+        amount=Decimal(amount),
+        usd_price=Decimal(0),
+        usd_total=Decimal(0),
+        percentage=Decimal(0),
+        target_percentage=Decimal(0),
+    )
+
+
+def target(symbol: str, percentage: str) -> CryptoData:
+    return CryptoData(symbol=symbol, market_cap=Decimal(0), percentage=Decimal(percentage), change_7d=0, change_30d=0)
+
+
+class TestPortfolio(unittest.TestCase):
+    def test_merge_portfolio(self):
+        merged = portfolio.merge_portfolio(
+            [balance("BTC", "1"), balance("ETH", "2")],
+            [balance("ETH", "0.5"), balance("ADA", "100")],
+        )
+
+        assert [(b["symbol"], b["amount"]) for b in merged] == [("BTC", Decimal("1")), ("ETH", Decimal("2.5")), ("ADA", Decimal("100"))]
+
+    def test_targets_and_missing_assets(self):
+        portfolio_target = [target("BTC", "60"), target("ETH", "30"), target("ADA", "10")]
+
+        user_portfolio = portfolio.Portfolio([balance("ETH", "1"), balance("DOGE", "1000")])
+        user_portfolio = user_portfolio.with_missing_assets(portfolio_target, lambda symbol: Decimal(5)).with_targets(portfolio_target)
+
+        assert [b["symbol"] for b in user_portfolio] == ["ETH", "DOGE", "BTC", "ADA"]
+        assert user_portfolio.get("ETH")["target_percentage"] == Decimal(30)
+        # held, but not part of the index
+        assert user_portfolio.get("DOGE")["target_percentage"] == Decimal(0)
+        assert user_portfolio.get("BTC")["amount"] == Decimal(0)
+        assert user_portfolio.get("BTC")["usd_price"] == Decimal(5)
+
+    def test_duplicate_target_symbols(self):
+        # two listings can share a ticker, the first one in the index is used
+        portfolio_target = [target("BTC", "60"), target("ETH", "30"), target("BTC", "10")]
+
+        user_portfolio = portfolio.Portfolio([balance("BTC", "1")]).with_targets(portfolio_target)
+
+        assert user_portfolio.get("BTC")["target_percentage"] == Decimal(60)
+
+    def test_exchange_portfolio(self):
+        user = User()
+        user.exchanges = [SupportedExchanges.BINANCE, "coinbase"]
+        user.coinbase_api_key, user.coinbase_secret_key, user.coinbase_passphrase = "key", "secret", "passphrase"
+
+        exchange_balances = {
+            SupportedExchanges.BINANCE: [balance("BTC", "1"), balance("USD", "10")],
+            SupportedExchanges.COINBASE: [balance("BTC", "0.5"), balance("ETH", "2")],
+        }
+
+        # exchanges are fetched concurrently: each fetch waits until both are in flight, a sequential fetch times out
+        both_exchanges_fetching = threading.Barrier(len(exchange_balances), timeout=5)
+
+        def concurrent_portfolio(exchange, user):
+            both_exchanges_fetching.wait()
+            return exchange_balances[exchange]
+
+        with patch("bot.exchanges.portfolio", side_effect=concurrent_portfolio):
+            user_portfolio = portfolio.exchange_portfolio(user)
+
+        assert [(b["symbol"], b["amount"]) for b in user_portfolio] == [("BTC", Decimal("1.5")), ("USD", Decimal("10")), ("ETH", Decimal("2"))]
+        assert user_portfolio[0]["exchanges"] == {"binance": Decimal("1"), "coinbase": Decimal("0.5")}
+        assert user_portfolio[2]["exchanges"] == {"coinbase": Decimal("2")}
+
+        # the breakdown is kept when externally held assets are merged in
+        merged = portfolio.merge_portfolio(user_portfolio, [balance("BTC", "3")])
+        assert merged[0]["amount"] == Decimal("4.5")
+        assert merged[0]["exchanges"] == {"binance": Decimal("1"), "coinbase": Decimal("0.5")}
+
+    def test_exchanges_without_credentials_are_skipped(self):
+        user = User()
+        user.exchanges = [SupportedExchanges.BINANCE, SupportedExchanges.COINBASE]
+
+        with patch("bot.exchanges.portfolio", return_value=[balance("BTC", "1")]) as portfolio_mock:
+            user_portfolio = portfolio.exchange_portfolio(user)
+
+        portfolio_mock.assert_called_once_with(SupportedExchanges.BINANCE, user)
+        assert user_portfolio[0]["exchanges"] == {"binance": Decimal("1")}
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import time
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from websockets.legacy.server import serve
+
+from bot.price_book import PriceBook, PriceBookStream
+
+# recorded from the combined `!miniTicker@arr/!bookTicker` stream
+RECORDED_MESSAGES = [
+    {
+        "stream": "!miniTicker@arr",
+        "data": [
+            {
+                "e": "24hrMiniTicker",
+                "E": 1632860000000,
+                "s": "BTCUSD",
+                "c": "41825.3600",
+                "o": "42120.1100",
+                "h": "42790.0000",
+                "l": "40900.0000",
+                "v": "812.2",
+                "q": "34018236.1",
+            },
+            {
+                "e": "24hrMiniTicker",
+                "E": 1632860000000,
+                "s": "ADAUSD",
+                "c": "2.1037",
+                "o": "2.1500",
+                "h": "2.2010",
+                "l": "2.0600",
+                "v": "913237.1",
+                "q": "1931321.8",
+            },
+        ],
+    },
+    {"stream": "!bookTicker", "data": {"u": 400900217, "s": "BTCUSD", "b": "41824.1200", "B": "0.12", "a": "41826.0100", "A": "0.4"}},
+    {"stream": "!bookTicker", "data": {"u": 400900218, "s": "ADAUSD", "b": "2.1030", "B": "2012.1", "a": "2.1041", "A": "88.2"}},
+    {
+        "stream": "!miniTicker@arr",
+        "data": [
+            {
+                "e": "24hrMiniTicker",
+                "E": 1632860001000,
+                "s": "BTCUSD",
+                "c": "41830.0000",
+                "o": "42120.1100",
+                "h": "42790.0000",
+                "l": "40900.0000",
+                "v": "812.3",
+                "q": "34022419.1",
+            },
+        ],
+    },
+]
+
+
+class TestPriceBook(unittest.TestCase):
+    def test_merges_ticker_and_book_updates(self):
+        price_book = PriceBook()
+
+        for message in RECORDED_MESSAGES:
+            price_book.handle_message(message)
+
+        assert len(price_book) == 2
+
+        btc_quote = price_book.quote("BTCUSD")
+        assert btc_quote.last == Decimal("41830.0000")
+        assert btc_quote.bid == Decimal("41824.1200")
+        assert btc_quote.ask == Decimal("41826.0100")
+
+        assert price_book.last_price("ADAUSD") == Decimal("2.1037")
+        assert price_book.last_price("ETHUSD") is None
+
+    def test_stale_quotes_are_ignored(self):
+        price_book = PriceBook()
+        price_book.update("BTCUSD", last=Decimal(1), updated_at=time.time() - 120)
+
+        assert price_book.quote("BTCUSD", max_age=60) is None
+        assert price_book.quote("BTCUSD", max_age=600).last == Decimal(1)
+
+    def test_consumes_local_stream(self):
+        price_book = PriceBook()
+
+        async def replay(websocket, path):
+            for message in RECORDED_MESSAGES:
+                await websocket.send(json.dumps(message))
+
+        async def consume_replayed_stream():
+            async with serve(replay, "127.0.0.1", 0) as server:
+                port = server.sockets[0].getsockname()[1]
+                await PriceBookStream(price_book, f"ws://127.0.0.1:{port}").consume()
+
+        asyncio.run(consume_replayed_stream())
+
+        assert price_book.last_price("BTCUSD") == Decimal("41830.0000")
+        assert price_book.quote("ADAUSD").ask == Decimal("2.1041")
+
+    def test_background_stream_reconnects(self):
+        price_book = PriceBook()
+        stream = PriceBookStream(price_book)
+        connections = []
+
+        async def replay(websocket, path):
+            connections.append(path)
+            await websocket.send(json.dumps(RECORDED_MESSAGES[len(connections) - 1]))
+
+        async def replay_stream():
+            async with serve(replay, "127.0.0.1", 0) as server:
+                # the server closes the connection after each message, the stream must reconnect to receive the next one
+                stream.url = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+                with patch("bot.price_book.RECONNECT_MIN_DELAY", 0.01):
+                    stream.start()
+
+                    while len(price_book) < 2 or price_book.quote("BTCUSD").bid is None:
+                        await asyncio.sleep(0.01)
+
+                    await asyncio.get_running_loop().run_in_executor(None, stream.stop)
+
+        asyncio.run(asyncio.wait_for(replay_stream(), timeout=10))
+
+        assert len(connections) >= 2
+        assert not stream._thread.is_alive()
+
+    @patch("bot.supported_exchanges.binance.binance_all_prices", side_effect=AssertionError("REST prices should not be requested"))
+    def test_price_of_symbol_reads_price_book(self, _all_prices_mock):
+        import bot.exchanges
+        from bot.price_book import price_book
+
+        try:
+            price_book.handle_message(RECORDED_MESSAGES[0])
+            assert bot.exchanges.price_of_symbol("BTC", "USD") == Decimal("41825.3600")
+        finally:
+            price_book.clear()
@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from bot import caching, tracing, utils
+
+
+def binance_response(used_weight: str):
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["X-MBX-USED-WEIGHT-1M"] = used_weight
+    return response
+
+
+@patch("bot.caching.in_django_environment", return_value=False)
+class TestTracing(unittest.TestCase):
+    def test_nested_spans(self, _django_mock):
+        with tracing.span("run") as run_span:
+            with tracing.span("stage") as stage_span:
+                assert tracing.current_span() is stage_span
+
+            assert tracing.current_span() is run_span
+
+        assert tracing.current_span() is None
+        assert run_span.children == [stage_span]
+        assert run_span.duration >= stage_span.duration
+
+        summary = run_span.summary()
+        assert summary["name"] == "run"
+        assert [child["name"] for child in summary["spans"]] == ["stage"]
+
+    def test_http_calls_are_attributed_to_parents(self, _django_mock):
+        session = tracing.trace_session(requests.Session())
+
+        with tracing.span("run") as run_span:
+            with tracing.span("stage") as stage_span:
+                for hook in session.hooks["response"]:
+                    hook(binance_response("12"))
+
+            for hook in session.hooks["response"]:
+                hook(binance_response("15"))
+
+        assert stage_span.http_calls == 1
+        assert stage_span.used_weight == 12
+        assert run_span.http_calls == 2
+        assert run_span.used_weight == 15
+
+        # responses outside of a span are ignored
+        tracing.record_response(binance_response("1"))
+
+    def test_cache_statistics_difference(self, _django_mock):
+        with tracing.span("cached") as span:
+            caching.cached_result("tracing_key", lambda: 1, timeout=60)
+            caching.cached_result("tracing_key", lambda: 1, timeout=60)
+
+        assert span.cache == {"miss": 1, "local_hit": 1}
+
+    def test_spans_propagate_to_threads(self, _django_mock):
+        with tracing.span("run") as run_span:
+            utils.concurrent_map(lambda _: tracing.record_response(binance_response("1")), range(10), max_workers=4)
+
+        assert run_span.http_calls == 10
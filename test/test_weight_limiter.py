@@ -0,0 +1,80 @@
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+import requests
+
+from bot import weight_limiter
+from bot.exchanges import binance_request_weight
+
+
+def response_with(status_code: int = 200, **headers) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update({header.replace("_", "-"): value for header, value in headers.items()})
+    return response
+
+
+class TestRequestWeight(unittest.TestCase):
+    def test_endpoint_weights(self):
+        assert binance_request_weight("get", "https://api.binance.us/api/v3/depth", {"symbol": "BTCUSD", "limit": 100}) == 1
+        assert binance_request_weight("get", "https://api.binance.us/api/v3/depth", {"symbol": "BTCUSD", "limit": 5000}) == 50
+        assert binance_request_weight("get", "https://api.binance.us/api/v3/openOrders", {"symbol": "BTCUSD"}) == 3
+        assert binance_request_weight("get", "https://api.binance.us/api/v3/openOrders") == 40
+        assert binance_request_weight("post", "https://api.binance.us/api/v3/order", {"symbol": "BTCUSD"}) == 1
+        assert binance_request_weight("get", "https://api.binance.us/api/v3/exchangeInfo") == 10
+        assert binance_request_weight("get", "https://api.binance.us/sapi/v1/capital/config/getall") == 1
+
+
+class TestRequestWeightLimiter(unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+
+    def limiter(self) -> weight_limiter.RequestWeightLimiter:
+        return weight_limiter.RequestWeightLimiter(weight_limiter.RedisBucketStore(self.redis), weight_per_minute=1200)
+
+    def tokens(self) -> float:
+        return float(self.redis.hget(weight_limiter.REDIS_BUCKET_KEY, "tokens"))
+
+    def test_workers_share_a_bucket(self):
+        first_worker, second_worker = self.limiter(), self.limiter()
+
+        first_worker.acquire(100)
+        assert self.tokens() < first_worker.capacity - 100 + 1
+
+        # the second worker only has what the first left over
+        with patch("bot.weight_limiter.time.sleep") as sleep_mock:
+            sleep_mock.side_effect = lambda seconds: self.redis.hset(weight_limiter.REDIS_BUCKET_KEY, "tokens", second_worker.capacity)
+            second_worker.acquire(100)
+
+        assert sleep_mock.call_count == 1
+        # 80 of the 100 tokens are missing, refilled at 16 per second
+        assert 4.5 < sleep_mock.call_args[0][0] <= 5
+
+    def test_used_weight_header_drains_the_bucket(self):
+        limiter = self.limiter()
+
+        limiter.record_response(response_with(x_mbx_used_weight_1m="1150"))
+        assert self.tokens() <= 50
+
+        # close enough to the limit that nothing is sent until the next minute
+        limiter.record_response(response_with(x_mbx_used_weight_1m="1190"))
+        blocked_until = float(self.redis.hget(weight_limiter.REDIS_BUCKET_KEY, "blocked_until"))
+        assert blocked_until % 60 == 0
+
+    def test_rate_limited_response_blocks_every_worker(self):
+        self.limiter().record_response(response_with(429, retry_after="30"))
+
+        with patch("bot.weight_limiter.time.sleep", side_effect=InterruptedError) as sleep_mock:
+            with self.assertRaises(InterruptedError):
+                self.limiter().acquire(1)
+
+        assert 29 < sleep_mock.call_args[0][0] <= 30
+
+    def test_local_store(self):
+        limiter = weight_limiter.RequestWeightLimiter(weight_limiter.LocalBucketStore(), weight_per_minute=1200)
+        limiter.acquire(100)
+
+        with patch("bot.weight_limiter.time.sleep", side_effect=InterruptedError):
+            with self.assertRaises(InterruptedError):
+                limiter.acquire(100)
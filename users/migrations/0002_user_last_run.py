@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2021-10-18 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='last_run',
+            field=models.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.6 on 2021-10-18 18:32
+
+import encrypted_model_fields.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_last_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='coinbase_api_key',
+            field=encrypted_model_fields.fields.EncryptedCharField(null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='coinbase_passphrase',
+            field=encrypted_model_fields.fields.EncryptedCharField(null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='coinbase_secret_key',
+            field=encrypted_model_fields.fields.EncryptedCharField(null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_user_coinbase_credentials'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='date_scheduled',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -18,11 +18,18 @@ class User(models.Model):
     # django requires an explicit field length; the key sizes here are probably much smaller
     binance_api_key = EncryptedCharField(max_length=100, null=True)
     binance_secret_key = EncryptedCharField(max_length=100, null=True)
+    coinbase_api_key = EncryptedCharField(max_length=100, null=True)
+    coinbase_secret_key = EncryptedCharField(max_length=100, null=True)
+    coinbase_passphrase = EncryptedCharField(max_length=100, null=True)
 
     external_portfolio = models.JSONField(default=dict, decoder=CustomJSONDecoder)
     preferences = models.JSONField(default=dict)
     name = models.CharField(max_length=100)
     date_checked = models.DateTimeField(null=True)
+    # when the next buy was scheduled to run, so overlapping scheduler runs don't schedule it twice
+    date_scheduled = models.DateTimeField(null=True)
+    # timing and API usage of each stage of the most recent run, see `bot.tracing`
+    last_run = models.JSONField(null=True)
 
     def bot_user(self):
         # copy all fields to the other instance of user currently used by the bot
@@ -34,6 +41,9 @@ class User(models.Model):
         bot_user = BotUser()
         bot_user.binance_api_key = self.binance_api_key
         bot_user.binance_secret_key = self.binance_secret_key
+        bot_user.coinbase_api_key = self.coinbase_api_key
+        bot_user.coinbase_secret_key = self.coinbase_secret_key
+        bot_user.coinbase_passphrase = self.coinbase_passphrase
         bot_user.external_portfolio = self.external_portfolio
 
         for k, v in self.preferences.items():
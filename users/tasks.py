@@ -1,9 +1,17 @@
+import datetime
+import hashlib
 import os
+import random
+import typing as t
+import uuid
 
 import django.utils.timezone
 from celery import Celery
+from decouple import config
 
 from bot.commands import BuyCommand
+from bot.market_snapshot import MarketSnapshot
+from bot.user import User as BotUser
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "botweb.settings.development")
@@ -17,7 +25,7 @@ from django_structlog.celery.steps import DjangoStructLogInitStep
 assert app.steps is not None
 app.steps["worker"].add(DjangoStructLogInitStep)
 
-from celery.signals import setup_logging
+from celery.signals import setup_logging, worker_process_init
 
 
 @setup_logging.connect
@@ -27,25 +35,248 @@ def receiver_setup_logging(loglevel, logfile, format, colorize, **kwargs):  # pr
     pass
 
 
+@worker_process_init.connect
+def start_price_book_stream(**kwargs):  # pragma: no cover
+    import bot.price_book
+
+    # each worker process keeps its own price book so pricing doesn't require any requests
+    if bot.price_book.PRICE_BOOK_STREAM:
+        bot.price_book.start_price_book_stream()
+
+
+@worker_process_init.connect
+def install_market_snapshot(**kwargs):  # pragma: no cover
+    from bot.market_snapshot import read_market_snapshot
+
+    # a new worker can serve market data from the last run on disk instead of refetching it
+    if market_snapshot := read_market_snapshot():
+        market_snapshot.install()
+
+
 assert app.on_after_configure is not None
 
 
+# users are spread across the interval between scheduler runs. Buys are delayed by up to the whole interval, which must
+# be well below the broker's visibility timeout (`CELERY_BROKER_TRANSPORT_OPTIONS`) or delayed buys are redelivered
+USER_BUY_INTERVAL = 60 * 60
+# random delay added to each user's slot so users with nearby slots don't hit the exchange at the same moment
+USER_BUY_JITTER = config("USER_BUY_JITTER", default=60, cast=int)
+# users checked (or scheduled) more recently than this are skipped, i.e. when the scheduler is run manually
+USER_BUY_MIN_INTERVAL = config("USER_BUY_MIN_INTERVAL", default=30 * 60, cast=int)
+# maximum number of users buying at the same time across all workers
+USER_BUY_CONCURRENCY = config("USER_BUY_CONCURRENCY", default=8, cast=int)
+# a slot is released when its buy finishes, the timeout only matters if the worker dies while holding it
+USER_BUY_SLOT_TIMEOUT = 10 * 60
+# a buy waiting for a slot is retried after this delay (plus jitter), doubling on each attempt up to the maximum
+USER_BUY_RETRY_DELAY = 30
+USER_BUY_MAX_RETRY_DELAY = 10 * 60
+# the retries add up to less than an hour, a user who still can't get a slot is picked up by the next run
+USER_BUY_MAX_RETRIES = config("USER_BUY_MAX_RETRIES", default=8, cast=int)
+
+
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
     # this method has a *lot* of kw params that can modify functionality
-    sender.add_periodic_task(60 * 60, initiate_user_buys.s(), name="check all accounts every hour for updates")
+    sender.add_periodic_task(USER_BUY_INTERVAL, initiate_user_buys.s(), name="check all accounts every hour for updates")
+
+
+# market snapshots only need to live for a single hourly run
+MARKET_SNAPSHOT_TIMEOUT = 60 * 60
+
+# snapshots loaded by this worker process, only the most recent is kept
+_loaded_market_snapshots: t.Dict[str, MarketSnapshot] = {}
+
+
+def store_market_snapshot(bot_users: t.List[BotUser]) -> t.Optional[str]:
+    """
+    Build the market data shared by all users (coinmarketcap, tickers, exchange info, target indexes) once per run
+    and store it so each `user_buy` task only performs account-specific work.
+    """
+
+    from django.core.cache import cache
+
+    import bot.utils
+    from bot.market_snapshot import warm_market_snapshot
+
+    try:
+        market_snapshot = warm_market_snapshot(bot_users)
+    except Exception as e:
+        # each user will pull market data on their own
+        bot.utils.log.error("failed to build market snapshot", error=e)
+        return None
+
+    market_snapshot_key = f"market_snapshot:{uuid.uuid4().hex}"
+    cache.set(market_snapshot_key, market_snapshot, timeout=MARKET_SNAPSHOT_TIMEOUT)
+
+    return market_snapshot_key
+
+
+def load_market_snapshot(market_snapshot_key: t.Optional[str], bot_user: t.Optional[BotUser] = None) -> t.Optional[MarketSnapshot]:
+    """
+    The snapshot stored for this run. A snapshot older than `MARKET_SNAPSHOT_MAX_AGE` is rebuilt and replaced under the
+    same key, so users late in the run don't buy against stale market data.
+    """
+
+    from django.core.cache import cache
+
+    if market_snapshot_key is None:
+        return None
+
+    if market_snapshot_key not in _loaded_market_snapshots:
+        _loaded_market_snapshots.clear()
+
+        if market_snapshot := cache.get(market_snapshot_key):
+            _loaded_market_snapshots[market_snapshot_key] = market_snapshot
+
+    market_snapshot = _loaded_market_snapshots.get(market_snapshot_key)
+
+    if market_snapshot is not None and market_snapshot.expired():
+        _loaded_market_snapshots.clear()
+
+        # another worker may have rebuilt it already
+        market_snapshot = cache.get(market_snapshot_key)
+
+        if market_snapshot is None or market_snapshot.expired():
+            market_snapshot = rebuild_market_snapshot(market_snapshot_key, [bot_user] if bot_user else [])
+
+        if market_snapshot is not None:
+            _loaded_market_snapshots[market_snapshot_key] = market_snapshot
+
+    return market_snapshot
+
+
+def rebuild_market_snapshot(market_snapshot_key: str, bot_users: t.List[BotUser]) -> t.Optional[MarketSnapshot]:
+    from django.core.cache import cache
+
+    import bot.utils
+    from bot.market_snapshot import build_market_snapshot, write_market_snapshot
+
+    bot.utils.log.info("market snapshot expired, rebuilding", market_snapshot_key=market_snapshot_key)
+
+    try:
+        # target indexes for other index preferences are added as users need them
+        market_snapshot = build_market_snapshot(bot_users)
+        write_market_snapshot(market_snapshot)
+    except Exception as e:
+        bot.utils.log.error("failed to rebuild market snapshot", error=e)
+        return None
+
+    cache.set(market_snapshot_key, market_snapshot, timeout=MARKET_SNAPSHOT_TIMEOUT)
+
+    return market_snapshot
+
+
+def user_buy_offset(user_id: int) -> float:
+    """
+    Seconds into the interval at which a user's buy runs. Derived from a hash of the ID (`hash` is salted per process),
+    so a user keeps the same slot every hour and users are spread evenly across the interval.
+    """
+
+    fraction = int.from_bytes(hashlib.sha256(str(user_id).encode()).digest()[:8], "big") / 2 ** 64
+    return fraction * max(USER_BUY_INTERVAL - USER_BUY_JITTER, 0)
+
+
+def schedule_user_buys(users: t.Iterable, now: datetime.datetime) -> t.List[t.Tuple[t.Any, datetime.datetime]]:
+    """
+    When each user's buy should run. Users checked, or already scheduled, within `USER_BUY_MIN_INTERVAL` of their next run
+    are skipped. A buy which failed doesn't update `date_checked`, so it's retried once its scheduled time is far enough
+    in the past.
+    """
+
+    min_interval = datetime.timedelta(seconds=USER_BUY_MIN_INTERVAL)
+    schedule = []
+
+    for user in users:
+        scheduled_at = now + datetime.timedelta(seconds=user_buy_offset(user.id) + random.uniform(0, USER_BUY_JITTER))
+
+        if any(last_buy and scheduled_at - last_buy < min_interval for last_buy in (user.date_checked, user.date_scheduled)):
+            continue
+
+        schedule.append((user, scheduled_at))
+
+    return schedule
+
+
+def acquire_user_buy_slot(user_id: int) -> t.Optional[t.Tuple[str, str]]:
+    """
+    Returns the slot key and a token identifying this buy, which is needed to release the slot. Slots are plain redis
+    keys so they can be released atomically with a transaction, see `release_user_buy_slot`.
+    """
+
+    from django_redis import get_redis_connection
+
+    redis_client = get_redis_connection("default")
+    token = f"{user_id}:{uuid.uuid4().hex}"
+
+    # slots are tried in a random order so buys don't all contend for the first slot
+    for slot in random.sample(range(USER_BUY_CONCURRENCY), USER_BUY_CONCURRENCY):
+        slot_key = f"user_buy_slot:{slot}"
+
+        if redis_client.set(slot_key, token, nx=True, ex=USER_BUY_SLOT_TIMEOUT):
+            return slot_key, token
+
+    return None
+
+
+def release_user_buy_slot(slot_key: str, token: str):
+    "a buy which outlived `USER_BUY_SLOT_TIMEOUT` may have lost its slot to another buy, which must keep it"
+
+    from django_redis import get_redis_connection
+
+    def release(pipe):
+        if pipe.get(slot_key) == token.encode():
+            pipe.multi()
+            pipe.delete(slot_key)
+
+    get_redis_connection("default").transaction(release, slot_key)
 
 
 @app.task
 def initiate_user_buys():
+    import bot.utils
+
     from .models import User
 
-    for user in User.objects.iterator():
-        user_buy.delay(user.id)
+    now = django.utils.timezone.now()
+    schedule = schedule_user_buys(User.objects.all(), now)
 
+    bot.utils.log.info("scheduling user buys", users=len(schedule))
 
-@app.task
-def user_buy(user_id):
+    if not schedule:
+        return
+
+    market_snapshot_key = store_market_snapshot([user.bot_user() for user, _ in schedule])
+
+    # recording the scheduled time keeps an overlapping run from scheduling the same buys again
+    for user, scheduled_at in schedule:
+        user.date_scheduled = scheduled_at
+
+    User.objects.bulk_update([user for user, _ in schedule], ["date_scheduled"])
+
+    for user, scheduled_at in schedule:
+        user_buy.apply_async((user.id, market_snapshot_key), countdown=(scheduled_at - now).total_seconds())
+
+
+@app.task(bind=True, max_retries=USER_BUY_MAX_RETRIES)
+def user_buy(self, user_id, market_snapshot_key=None):
+    import bot.utils
+
+    if not (slot := acquire_user_buy_slot(user_id)):
+        if self.request.retries >= self.max_retries:
+            bot.utils.log.error("user buy concurrency limit reached, skipping until the next run", user_id=user_id)
+            return
+
+        retry_delay = min(USER_BUY_RETRY_DELAY * 2 ** self.request.retries, USER_BUY_MAX_RETRY_DELAY)
+        bot.utils.log.info("user buy concurrency limit reached, retrying", user_id=user_id, retry_delay=retry_delay)
+        raise self.retry(countdown=retry_delay + random.uniform(0, USER_BUY_JITTER))
+
+    try:
+        _user_buy(user_id, market_snapshot_key)
+    finally:
+        release_user_buy_slot(*slot)
+
+
+def _user_buy(user_id, market_snapshot_key=None):
     import bot.utils
 
     from .models import User
@@ -60,7 +291,14 @@ def user_buy(user_id):
     bot.utils.log.bind(user_id=user.id)
     bot.utils.log.info("initiating buys for user")
 
-    BuyCommand.execute(bot_user)
+    import bot.caching
+    import bot.tracing
+
+    with bot.tracing.span("user_buy") as run_span:
+        BuyCommand.execute(bot_user, market_snapshot=lambda: load_market_snapshot(market_snapshot_key, bot_user))
+
+    bot.utils.log.info("cache statistics", **bot.caching.cache_statistics())
 
     user.date_checked = django.utils.timezone.now()
-    user.save()
+    user.last_run = run_span.summary()
+    user.save(update_fields=["date_checked", "last_run"])